@@ -1,13 +1,41 @@
 #!/usr/bin/env python3
 """Klasser för att lagra bokföringsdata från en SI-fil"""
 
+import io
+import os
+import zlib
 from datetime import datetime
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
 from itertools import takewhile
 
+import stats
+
+# Hur ofta (antal rader eller verifikationer) progress-funktioner anropas
+PROGRESS_INTERVAL = 1000
+
+# Antal datum som sparas i varje datumcache. En fil har sällan fler än några
+# hundra olika datum.
+DATE_CACHE_SIZE = 4096
+
+def _escape(text):
+    """
+    Put a backslash before \\ and " in a field, as it is written within quotes.
+    The checksum is computed on the fields escaped like this.
+    """
+    if '"' in text or '\\' in text:
+        return text.replace('\\', '\\\\').replace('"', '\\"')
+    return text
+
+def _needs_quotes(text):
+    return not text or ' ' in text or '"' in text or '\\' in text
+
 def _quote(fields, leave_trailing=True):
     """
-    Wrap each field in quotes if it contains a space or is empty.
+    Wrap each field in quotes if it is empty or contains a space, a quote or
+    a backslash. Quotes and backslashes within quotes are escaped.
     leave_trailing: If True, do not quote empty fields at the end of the list.
     Ex. If True: ['a b', 'c', '', ''] becomes ['"a b"', 'c', '', ''].
     If false: ['"a b"', 'c', '""', '""']
@@ -16,7 +44,8 @@ def _quote(fields, leave_trailing=True):
         trailing = len(list(takewhile(lambda f: not f, reversed(fields))))
         return _quote(fields[:len(fields)-trailing], False) + ([''] * trailing)
     else:
-        return ['"' + str(f) + '"' if ' ' in str(f) or not str(f) else f for f in fields]
+        return ['"' + _escape(str(f)) + '"' if _needs_quotes(str(f)) else f
+                for f in fields]
 
 def _format_float(num, comma_decimal=False):
     """Use comma instead of dot. Remove trailing zeroes"""
@@ -26,6 +55,70 @@ def _format_float(num, comma_decimal=False):
     return result
 
 
+class ConversionCancelled(Exception):
+    """Kastas av en progress-funktion för att avbryta inläsning/konvertering"""
+
+
+class NothingToExport(Exception):
+    """Kastas när alla verifikationer eller batcher redan har exporterats"""
+
+
+class ChecksumMismatch(Exception):
+    """Kastas när #KSUMMA i en SI-fil inte stämmer med innehållet"""
+
+
+def checksum_bytes(text, crc=0):
+    """
+    Uppdatera kontrollsumman för #KSUMMA, CRC-32, med text. text är
+    etiketter och fältinnehåll utan mellanrum, citattecken, klamrar och
+    radslut, som räknas på kodat i cp437.
+    """
+    return zlib.crc32(text.encode('cp437', 'replace'), crc)
+
+def format_checksum(crc):
+    """Kontrollsumman som den skrivs i #KSUMMA, ett tal utan tecken"""
+    return str(crc & 0xffffffff)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+@stats.timed('Date parsing')
+def parse_sie_date(datestring):
+    """
+    Tolka ett datum YYYYMMDD och returnera det som heltalet YYYYMMDD,
+    eller 0 om det inte är ett giltigt datum.
+    """
+    if not datestring:
+        return 0
+    if len(datestring) == 8 and datestring.isdigit():
+        try:
+            packed = int(datestring)
+            datetime(packed // 10000, packed // 100 % 100, packed % 100)
+        except ValueError:
+            return 0
+        return packed
+    try:
+        date = datetime.strptime(datestring, "%Y%m%d")
+    except ValueError:
+        return 0
+    return date.year * 10000 + date.month * 100 + date.day
+
+def petra_to_sie_date(datestring):
+    """Gör om ett Petradatum dd/mm/yyyy till YYYYMMDD"""
+    return datestring[6:10] + datestring[3:5] + datestring[:2]
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def format_date(packed, format_string):
+    """Formatera ett datum lagrat som heltalet YYYYMMDD, '' om det saknas"""
+    if not packed:
+        return ''
+    year, month, day = packed // 10000, packed // 100 % 100, packed % 100
+    if format_string == "%d/%m/%Y":
+        return '{:02}/{:02}/{:04}'.format(day, month, year)
+    if format_string == "%Y-%m":
+        return '{:04}-{:02}'.format(year, month)
+    return datetime(year, month, day).strftime(format_string)
+
+
 class SieData:
     """Lagrar datan som behövs i en SI-fil"""
     single_fields = ['#FLAGGA', '#PROGRAM', '#FORMAT', '#GEN', '#SIETYP',
@@ -48,61 +141,167 @@ class SieData:
 
     def __init__(self):
         self.data = defaultdict(list)
+        self._index = None
 
     def __repr__(self):
+        output = io.StringIO()
+        SieIO.writeRecords(self.records(), output)
+        return output.getvalue()
+
+    def records(self):
+        """Alla poster i den ordning de ska skrivas till en SI-fil"""
         fields = (self.ident_fields + self.account_fields + self.balance_fields
                   + self.control_fields)
-        res = ''
         for field in fields:
-            for line in self.data[field]:
-                res += '{}\n'.format(line)
-
-        return res
+            yield from self.data.get(field, [])
 
     def add_data(self, field):
         """Spara SieField field. #VER läggs till en lista."""
         if field.name in self.single_fields and self.data[field.name]:
             raise ValueError("This field is set already: ", field.name)
         self.data[field.name].append(field)
+        if self._index is not None and field.name == '#VER':
+            self._index.add(field)
 
     def get_data(self, name):
         """Läs data från posten name"""
         return self.data[name]
 
+    def _get_index(self):
+        """Bygg index över verifikationerna första gången de behövs"""
+        if self._index is None:
+            self._index = SieIndex(self.data.get('#VER', []))
+        return self._index
+
+    def find_verifications(self, serie, vernr):
+        """Alla verifikationer med serie och nummer vernr"""
+        return self._get_index().by_number.get((serie, vernr), [])
+
+    def verifications_between(self, first, last):
+        """Verifikationer med verdatum från first till och med last (YYYYMMDD)"""
+        return self._get_index().between(parse_sie_date(str(first)),
+                                         parse_sie_date(str(last)))
+
+    def transactions_by_account(self, kontonr):
+        """Alla (verifikation, transaktion) som bokförts på kontonr"""
+        return self._get_index().by_account.get(kontonr, [])
+
+    def transactions_by_object(self, dim, objekt):
+        """Alla (verifikation, transaktion) med objektet objekt i dimension dim"""
+        return self._get_index().by_object.get((dim, objekt), [])
+
+    def to_numpy(self):
+        """Transaktionerna som en numpy structured array, se columnar"""
+        import columnar
+        return columnar.to_numpy(self)
+
+    def to_arrow(self):
+        """Transaktionerna som en pyarrow Table, se columnar"""
+        import columnar
+        return columnar.to_arrow(self)
+
     def is_complete(self):
         """True om all information som specifikationen kräver är sparad"""
         return all([self.data[field] for field in self.needed_fields])
 
 
+class SieIndex:
+    """
+    Index över verifikationer och transaktioner i en SieData. Byggs en gång
+    och uppdateras sedan för varje verifikation som läggs till.
+    """
+    def __init__(self, verifications):
+        self.by_number = defaultdict(list)
+        self.by_account = defaultdict(list)
+        self.by_object = defaultdict(list)
+        # (verdatum, löpnummer, verifikation), sorteras först när den behövs
+        self._by_date = []
+        self._date_keys = []
+        self._sorted = True
+        for ver in verifications:
+            self.add(ver)
+
+    def add(self, ver):
+        """Lägg till en verifikation och dess transaktioner i indexen"""
+        self.by_number[(ver.serie, ver.vernr)].append(ver)
+        date = ver.verdatum.packed
+        if self._date_keys and date < self._date_keys[-1]:
+            self._sorted = False
+        self._by_date.append((date, len(self._by_date), ver))
+        self._date_keys.append(date)
+        for trans in ver.trans_list:
+            self.by_account[trans.kontonr].append((ver, trans))
+            objects = iter(trans.objekt)
+            for dim in objects:
+                self.by_object[(dim, next(objects, ''))].append((ver, trans))
+
+    def between(self, first, last):
+        """Verifikationer med verdatum mellan heltalen first och last"""
+        if not self._sorted:
+            self._by_date.sort(key=lambda entry: entry[:2])
+            self._date_keys = [entry[0] for entry in self._by_date]
+            self._sorted = True
+        start = bisect_left(self._date_keys, first)
+        end = bisect_right(self._date_keys, last)
+        return [entry[2] for entry in self._by_date[start:end]]
+
+
 class SieField:
     """
     Stores a SIE field, like #FLAGGA, #KONTO or #VER.
     All fields added to a SieData should be a subclass of SieField.
     """
+    __slots__ = ('name', 'value')
+
     def __init__(self, name, value):
         self.name = name
         self.value = value
 
-    def name(self):
-        """Get the name"""
-        return self.name
-
     def __repr__(self):
-        formatting = '{} "{}"' if ' ' in self.value else "{} {}"
-        return formatting.format(self.name, self.value)
+        if self.value and _needs_quotes(self.value):
+            return '{} "{}"'.format(self.name, _escape(self.value))
+        return "{} {}".format(self.name, self.value)
+
+    def lines(self):
+        """Raderna som posten skrivs som i en SI-fil, utan radslut"""
+        yield repr(self)
+
+    def checksum_text(self):
+        """Etiketten och fältinnehållet som #KSUMMA räknas på"""
+        return self.name + _escape(self.value)
 
 class DataField(SieField):
     # pylint: disable=too-few-public-methods
     """Lagrar en post beskriven av en rad"""
+    __slots__ = ('data',)
+
     def __init__(self, line):
         self.name = line[0]
         self.data = line[1:]
 
     def __repr__(self):
-        return ' '.join([self.name] + _quote(self.data))
+        # Objektlistor, som i #PSALDO, skrivs som {1 "K 1"}
+        quoted = _quote(['{}' if isinstance(f, list) else f for f in self.data])
+        return ' '.join([self.name] + [
+            '{' + ' '.join(_quote(f, False)) + '}' if isinstance(f, list) else q
+            for f, q in zip(self.data, quoted)])
+
+    def checksum_text(self):
+        """Etiketten och fältinnehållet som #KSUMMA räknas på"""
+        return self.name + ''.join(
+            ''.join(map(_escape, f)) if isinstance(f, list) else _escape(str(f))
+            for f in self.data)
 
 class Verification(SieField):
-    """Lagrar datan för en verifikation"""
+    """
+    Lagrar datan för en verifikation.
+    Summorna av debet- och kreditbeloppen hålls som heltal öre i debet_ore och
+    kredit_ore och uppdateras av add_trans, så transaktioner ska läggas till
+    med add_trans.
+    """
+    __slots__ = ('serie', 'vernr', 'verdatum', 'vertext', 'regdatum', 'sign',
+                 'trans_list', 'debet_ore', 'kredit_ore')
+
     def __init__(self, serie, vernr, verdatum, vertext='', regdatum='',
                  sign=''):
         # pylint: disable=too-many-arguments
@@ -114,20 +313,36 @@ class Verification(SieField):
         self.regdatum = MaybeDate(regdatum)
         self.sign = sign
         self.trans_list = []
+        self.debet_ore = 0
+        self.kredit_ore = 0
 
     def __repr__(self):
+        return '\n'.join(self.lines())
+
+    def lines(self):
+        """Raderna som verifikationen skrivs som i en SI-fil, utan radslut"""
         quoted = _quote([self.serie, self.vernr, self.verdatum, self.vertext,
             self.regdatum, self.sign])
-        res = '#VER {} {} {} {} {} {}'.format(*quoted)
-        res += '\n{\n'
+        yield '#VER {} {} {} {} {} {}'.format(*quoted)
+        yield '{'
         for trans in self.trans_list:
-            res += '   {}\n'.format(trans)
-        res += '}'
-        return res
+            yield '   {}'.format(trans)
+        yield '}'
+
+    def checksum_text(self):
+        """Etiketten och fältinnehållet som #KSUMMA räknas på, med transaktionerna"""
+        return ''.join(['#VER', _escape(self.serie), _escape(self.vernr),
+                        str(self.verdatum), _escape(self.vertext),
+                        str(self.regdatum), _escape(self.sign)] +
+                       [trans.checksum_text() for trans in self.trans_list])
 
     def add_trans(self, trans):
         """Lägg till en transaktion till verifikationen"""
         self.trans_list.append(trans)
+        if trans.ore > 0:
+            self.debet_ore += trans.ore
+        else:
+            self.kredit_ore += trans.ore
 
     def is_complete(self):
         """True om det finns transaktioner inlagda"""
@@ -135,83 +350,171 @@ class Verification(SieField):
 
     def in_balance(self):
         """True om summan av debit och kredit är noll"""
-        return self.sum_debit() + self.sum_credit() == 0
+        return self.debet_ore + self.kredit_ore == 0
 
     def sum_debit(self):
-        """Addera alla positiva belopp"""
-        return round(sum([trans.belopp for trans in self.trans_list
-                          if trans.belopp > 0]), 2)
+        """Summan av alla positiva belopp, i kronor"""
+        return self.debet_ore / 100
 
     def sum_credit(self):
-        """Addera alla negativa belopp"""
-        return round(sum([trans.belopp for trans in self.trans_list
-                          if -1 * trans.belopp > 0]), 2)
+        """Summan av alla negativa belopp, i kronor"""
+        return self.kredit_ore / 100
 
 
+def parse_ore(belopp):
+    """
+    Ett belopp i kronor som heltal öre. Text räknas om exakt, utan flyttal,
+    och avrundas till närmaste öre med halva öre bort från noll. Flyttal görs
+    om till text först, så 0.125 ger 13 öre precis som '0.125'.
+    """
+    if belopp.__class__ is int:
+        return belopp * 100
+    if belopp.__class__ is not str:
+        belopp = str(belopp)
+    whole, _, fraction = belopp.partition('.')
+    digits = whole[1:] if whole[:1] in ('-', '+') else whole
+    # Vanliga belopp, som -15099.82 eller 12750, utan Decimal
+    if ((digits.isdigit() or not digits and fraction) and len(fraction) <= 2
+            and (fraction.isdigit() or not fraction)):
+        return int(whole + fraction.ljust(2, '0'))
+    try:
+        ore = Decimal(belopp).scaleb(2).to_integral_value(ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError('Inte ett belopp: {!r}'.format(belopp)) from None
+    return int(ore)
+
+def _format_ore(ore):
+    """Format an amount in öre like _format_float, without trailing zeroes"""
+    whole, fraction = divmod(abs(ore), 100)
+    sign = '-' if ore < 0 else ''
+    if fraction:
+        return '{}{}.{:02}'.format(sign, whole, fraction).rstrip('0')
+    return '{}{}'.format(sign, whole)
+
 class Transaction:
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
-    """Lagrar datan för en transaktion"""
+    """
+    Lagrar datan för en transaktion.
+    Beloppet lagras som ett heltal öre i ore och datumet som ett heltal
+    YYYYMMDD, belopp, transdat, debit och credit räknas fram när de läses.
+    """
+    __slots__ = ('kontonr', 'objekt', 'ore', '_transdat', 'transtext',
+                 'kvantitet', 'sign')
+
     def __init__(self, kontonr, objekt, belopp, transdat='', transtext='',
                  kvantitet=0.0, sign=''):
         # pylint: disable=too-many-arguments
         self.kontonr = kontonr
         self.objekt = objekt
-        self.belopp = float(belopp)
-        self.transdat = MaybeDate(transdat)
+        self.ore = parse_ore(belopp)
+        self._transdat = parse_sie_date(transdat)
         self.transtext = transtext
-        self.kvantitet = float(kvantitet)
+        self.kvantitet = float(kvantitet) or 0.0
         self.sign = sign
 
-        if self.belopp < 0:
-            self.debit = '0'
-            self.credit = _format_float(-1*self.belopp, True)
-        else:
-            self.credit = '0'
-            self.debit = _format_float(self.belopp, True)
+    @property
+    def belopp(self):
+        """
+        Beloppet i kronor. Det kan inte ändras, eftersom verifikationens
+        debet_ore och kredit_ore räknas fram när transaktionen läggs till.
+        """
+        return self.ore / 100
+
+    @property
+    def transdat(self):
+        """Transaktionsdatum som MaybeDate"""
+        return MaybeDate.from_packed(self._transdat)
+
+    @property
+    def debit(self):
+        """Debetbelopp formaterat för utskrift, '0' för kreditbelopp"""
+        return _format_ore(self.ore) if self.ore >= 0 else '0'
+
+    @property
+    def credit(self):
+        """Kreditbelopp formaterat för utskrift, '0' för debetbelopp"""
+        return _format_ore(-self.ore) if self.ore < 0 else '0'
 
     def __repr__(self):
         kvantitet = _format_float(self.kvantitet) if self.kvantitet else ''
-        belopp = _format_float(self.belopp)
-        quoted = _quote([self.kontonr]) + [' '.join(self.objekt)] + _quote([
+        belopp = _format_ore(self.ore)
+        objekt = ' '.join(_quote(self.objekt, False))
+        quoted = _quote([self.kontonr]) + [objekt] + _quote([
             belopp, self.transdat, self.transtext, kvantitet, self.sign])
         return "#TRANS {} {{{}}} {} {} {} {} {}".format(*quoted)
 
+    def checksum_text(self):
+        """Etiketten och fältinnehållet som #KSUMMA räknas på"""
+        kvantitet = _format_float(self.kvantitet) if self.kvantitet else ''
+        return ''.join(['#TRANS', _escape(self.kontonr)] + [
+            _escape(obj) for obj in self.objekt] + [
+            _format_ore(self.ore), str(self._transdat or ''), _escape(self.transtext),
+            kvantitet, _escape(self.sign)])
+
     def __eq__(self, other):
         return all(
             [self.kontonr == other.kontonr, self.objekt == other.objekt,
-             self.belopp == other.belopp, self.transdat == other.transdat,
+             self.ore == other.ore, self._transdat == other._transdat,
              self.transtext == other.transtext,
              self.kvantitet == other.kvantitet, self.sign == other.sign])
 
 class MaybeDate:
-    """Parsar och lagrar ett datum om det finns, annars bara en tom sträng"""
+    """
+    Parsar och lagrar ett datum om det finns, annars bara en tom sträng.
+    Datumet lagras som heltalet YYYYMMDD i packed, 0 om det saknas.
+    """
     # pylint: disable=too-few-public-methods
+    __slots__ = ('packed',)
+
     def __init__(self, datestring):
-        try:
-            self.date = datetime.strptime(datestring, "%Y%m%d")
-            self.year = self.date.year
-            self.month = self.date.month
-            self.day = self.date.day
-            self.has_date = True
-        except ValueError:
-            self.date = self.year = self.month = None
-            self.has_date = False
+        self.packed = parse_sie_date(datestring)
+
+    @classmethod
+    def from_packed(cls, packed):
+        """Skapa en MaybeDate från ett heltal YYYYMMDD, 0 betyder inget datum"""
+        maybe_date = cls.__new__(cls)
+        maybe_date.packed = packed
+        return maybe_date
+
+    @property
+    def has_date(self):
+        """True om det finns ett datum"""
+        return self.packed != 0
+
+    @property
+    def year(self):
+        """Året, None om det saknas"""
+        return self.packed // 10000 if self.packed else None
+
+    @property
+    def month(self):
+        """Månaden, None om det saknas"""
+        return self.packed // 100 % 100 if self.packed else None
+
+    @property
+    def day(self):
+        """Dagen, None om det saknas"""
+        return self.packed % 100 if self.packed else None
+
+    @property
+    def date(self):
+        """Datumet som datetime, None om det saknas"""
+        if self.packed:
+            return datetime(self.year, self.month, self.day)
+        return None
 
     def __repr__(self):
-        if self.date:
-            return self.date.strftime("%Y%m%d")
+        if self.packed:
+            return str(self.packed)
         else:
             return ''
 
     def format(self, format_string):
         """Format the date, return an empty string if there is no date"""
-        if self.date:
-            return self.date.strftime(format_string)
-        else:
-            return ''
+        return format_date(self.packed, format_string)
 
     def __eq__(self, other):
-        return self.date.__eq__(other.date)
+        return self.packed == other.packed
 
 
 class SieIO:
@@ -222,14 +525,73 @@ class SieIO:
             return file_handle.readlines()
 
     @staticmethod
-    def writeSie(sie_data, filename, overwrite=False):
-        """Write SIE to file, abort if it already exists"""
-        writemode = 'w' if overwrite else 'x'
-        if not sie_data.is_complete():
-            raise Exception("SIE-filen är inte komplett.")
-        try:
-            with open(filename, writemode, encoding='cp437', errors='replace') as file_handle:
-                file_handle.write(repr(sie_data))
-        except FileExistsError:
+    def iterSie(filename):
+        """Yield the lines of a SIE file one at a time"""
+        with open(filename, 'r', encoding='cp437') as file_handle:
+            yield from file_handle
+
+    @staticmethod
+    @stats.timed('SieIO.writeSie')
+    def writeSie(sie_data, filename, overwrite=False, checksum=True):
+        """
+        Write SIE to file, abort if it already exists. The file is replaced
+        first when everything has been written.
+        sie_data is either a SieData or an iterable of SieFields in file order,
+        like SieParser.iter_records(), which is written as it is consumed.
+        With checksum the file gets #KSUMMA records, see writeRecords.
+        """
+        if not overwrite and os.path.exists(filename):
             raise Exception("Kan inte skriva " + filename + ", filen finns redan.")
+        if isinstance(sie_data, SieData):
+            if not sie_data.is_complete():
+                raise Exception("SIE-filen är inte komplett.")
+            records = sie_data.records()
+        else:
+            records = sie_data
+        # Skriv till en tillfällig fil som ersätter filename när allt är skrivet
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'w', encoding='cp437', errors='replace') as file_handle:
+                seen = SieIO.writeRecords(records, file_handle, checksum)
+            if not seen.issuperset(SieData.needed_fields):
+                raise Exception("SIE-filen är inte komplett.")
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+        if stats.enabled:
+            stats.count('SIE bytes written', os.path.getsize(filename))
 
+    @staticmethod
+    def writeRecords(records, file_handle, checksum=False):
+        """
+        Write SieFields to a text stream one record at a time.
+        Returns the set of field names written.
+        #KSUMMA records in records are left out, since they would not match
+        what is written. With checksum an empty #KSUMMA is written after
+        #FLAGGA and #KSUMMA with the CRC-32 of the following records at the
+        end. The checksum is updated as each record is written.
+        """
+        seen = set()
+        write = file_handle.write
+        crc = None
+        for record in records:
+            if record.name == '#KSUMMA':
+                continue
+            if checksum and crc is None and record.name != '#FLAGGA':
+                write('#KSUMMA\n')
+                crc = 0
+            seen.add(record.name)
+            write('\n'.join(record.lines()))
+            write('\n')
+            if crc is not None:
+                crc = checksum_bytes(record.checksum_text(), crc)
+        if checksum:
+            if crc is None:
+                write('#KSUMMA\n')
+                crc = 0
+            write('#KSUMMA {}\n'.format(format_checksum(crc)))
+        return seen
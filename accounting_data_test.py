@@ -0,0 +1,84 @@
+"""Tests for the accounting data classes"""
+
+import pytest
+
+from accounting_data import SieData, Verification, MaybeDate, Transaction
+from accounting_data import parse_sie_date, petra_to_sie_date, format_date
+
+def test_parse_sie_date():
+    """Valid dates are packed, anything else gives 0"""
+    assert parse_sie_date('20120425') == 20120425
+    assert parse_sie_date('20120229') == 20120229
+    assert parse_sie_date('20110229') == 0
+    assert parse_sie_date('20121301') == 0
+    assert parse_sie_date('') == 0
+    assert parse_sie_date('2012-04-25') == 0
+    # strptime accepts single digit months and days
+    assert parse_sie_date('201245') == 20120405
+
+def test_format_date():
+    """The fast formats give the same result as strftime"""
+    date = MaybeDate('20120405')
+    assert date.format("%d/%m/%Y") == date.date.strftime("%d/%m/%Y")
+    assert date.format("%Y-%m") == date.date.strftime("%Y-%m")
+    assert date.format("%y%m%d") == '120405'
+    assert MaybeDate('').format("%d/%m/%Y") == ''
+    assert format_date(0, "%Y-%m") == ''
+
+def test_petra_to_sie_date():
+    """Petra dates are dd/mm/yyyy"""
+    assert petra_to_sie_date('05/04/2012') == '20120405'
+
+def test_transaction_amounts():
+    """Amounts are stored in öre and formatted without trailing zeroes"""
+    trans = Transaction('1930', [], '-15099.80', '20120425')
+    assert trans.ore == -1509980
+    assert trans.belopp == -15099.8
+    assert (trans.debit, trans.credit) == ('0', '15099.8')
+    assert Transaction('1930', [], 12750).debit == '12750'
+    assert trans.transdat.year == 2012
+    assert repr(trans) == '#TRANS 1930 {} -15099.8 20120425   '
+    # Amounts are not rounded through binary floating point
+    assert Transaction('1930', [], '-0.125').ore == -13
+    assert Transaction('1930', [], '0.005').ore == 1
+    assert Transaction('1930', [], '12345678901234567.89').ore == 1234567890123456789
+    assert Transaction('1930', [], 1e3).ore == 100000
+    with pytest.raises(AttributeError):
+        trans.belopp = 100
+
+def test_verification_totals():
+    """Debit and credit totals are kept exactly in öre as transactions are added"""
+    ver = Verification('A', '1', '20120425')
+    for _ in range(1000):
+        ver.add_trans(Transaction('3010', [], '0.10'))
+    assert not ver.in_balance()
+    ver.add_trans(Transaction('1930', [], '-100.00'))
+    assert ver.in_balance()
+    assert (ver.debet_ore, ver.kredit_ore) == (10000, -10000)
+    assert (ver.sum_debit(), ver.sum_credit()) == (100.0, -100.0)
+
+def test_sie_data_index():
+    """Lookups find verifications and transactions, also ones added later"""
+    sie_data = SieData()
+    ver1 = Verification('A', '1', '20170105')
+    ver1.add_trans(Transaction('1930', ['1', 'K1', '6', 'P-1'], '-100'))
+    ver1.add_trans(Transaction('3010', [], '100'))
+    sie_data.add_data(ver1)
+    ver2 = Verification('B', '1', '20170102')
+    ver2.add_trans(Transaction('1930', ['1', 'K2'], '50'))
+    sie_data.add_data(ver2)
+
+    assert sie_data.find_verifications('A', '1') == [ver1]
+    assert sie_data.verifications_between('20170101', '20170105') == [ver2, ver1]
+
+    ver3 = Verification('A', '2', '20170103')
+    ver3.add_trans(Transaction('3010', ['1', 'K2'], '-50'))
+    sie_data.add_data(ver3)
+
+    assert sie_data.find_verifications('A', '2') == [ver3]
+    assert sie_data.find_verifications('C', '1') == []
+    assert sie_data.verifications_between(20170103, 20170110) == [ver3, ver1]
+    assert [v for v, _ in sie_data.transactions_by_account('1930')] == [ver1, ver2]
+    assert [t.ore for _, t in sie_data.transactions_by_account('3010')] == [10000, -5000]
+    assert [v for v, _ in sie_data.transactions_by_object('1', 'K2')] == [ver2, ver3]
+    assert len(sie_data.transactions_by_object('6', 'P-1')) == 1
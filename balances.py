@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Balance records computed from the verifications of a SieData: #UB and #RES
+per account and #PSALDO per account and month, for result accounts also per
+object. The computed records can be compared with the balance records that
+are already in the file.
+All transactions are summed in one pass over integer coded accounts, months
+and objects, with numpy when it is installed and with plain integers
+otherwise. Amounts are öre throughout.
+"""
+
+import sys
+import argparse
+from collections import defaultdict
+
+from accounting_data import DataField, parse_ore, _format_ore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# #KTYP for tillgångar and skulder, the other types are kostnader and intäkter
+BALANCE_TYPES = ('T', 'S')
+# Without #KTYP, accounts in class 1 and 2 of the BAS chart are balance accounts
+BALANCE_CLASSES = ('1', '2')
+
+CHECKED_FIELDS = ('#UB', '#RES', '#PSALDO')
+
+
+def _sum_by_key(keys, amounts):
+    """{key: sum of the amounts with that key} for integer keys"""
+    if numpy is not None:
+        unique, inverse = numpy.unique(numpy.asarray(keys, dtype=numpy.int64),
+                                       return_inverse=True)
+        sums = numpy.zeros(len(unique), dtype=numpy.int64)
+        numpy.add.at(sums, inverse, numpy.asarray(amounts, dtype=numpy.int64))
+        return dict(zip(unique.tolist(), sums.tolist()))
+    sums = defaultdict(int)
+    for key, amount in zip(keys, amounts):
+        sums[key] += amount
+    return sums
+
+def _coded(codes):
+    """The values of a {value: code} dict, ordered by code"""
+    return sorted(codes, key=codes.get)
+
+
+class Balances:
+    """
+    Account balances for year (the årsnr of the SIE file, '0' is the current
+    year) summed from the verifications of sie_data. Only verifications within
+    #RAR for the year are counted, if the file has it. #IB for the year is the
+    opening balance of the balance accounts.
+    period_totals holds {(kontonr, YYYYMM): öre}, object_totals
+    {(kontonr, YYYYMM, dim, objekt): öre} and account_totals {kontonr: öre}
+    for the whole year.
+    """
+    def __init__(self, sie_data, year='0'):
+        self.sie_data = sie_data
+        self.year = str(year)
+        self.opening = {field.data[1]: parse_ore(field.data[2])
+                        for field in self._year_records('#IB')}
+        self.account_types = {field.data[0]: field.data[1].upper()
+                              for field in sie_data.get_data('#KTYP')}
+        self.period_totals = {}
+        self.object_totals = {}
+        self.account_totals = {}
+        self._months = None
+        self._sum()
+
+    def _year_records(self, name):
+        return [field for field in self.sie_data.get_data(name)
+                if field.data and field.data[0] == self.year]
+
+    def _date_range(self):
+        """First and last date of the year as YYYYMMDD, None if unknown"""
+        for field in self._year_records('#RAR'):
+            return int(field.data[1]), int(field.data[2])
+        return None
+
+    def _sum(self):
+        # pylint: disable=too-many-locals
+        date_range = self._date_range()
+        account_codes, period_codes, object_codes = {}, {}, {}
+        accounts, periods, amounts = [], [], []
+        # Row in the columns above and object code, for each object of a transaction
+        object_rows, objects = [], []
+        for ver in self.sie_data.get_data('#VER'):
+            date = ver.verdatum.packed
+            if date_range and not date_range[0] <= date <= date_range[1]:
+                continue
+            period = period_codes.setdefault(date // 100, len(period_codes))
+            for trans in ver.trans_list:
+                objekt = trans.objekt
+                for idx in range(0, len(objekt) - 1, 2):
+                    if objekt[idx + 1]:
+                        object_rows.append(len(amounts))
+                        objects.append(object_codes.setdefault(
+                            (objekt[idx], objekt[idx + 1]), len(object_codes)))
+                accounts.append(account_codes.setdefault(trans.kontonr,
+                                                         len(account_codes)))
+                periods.append(period)
+                amounts.append(trans.ore)
+
+        n_periods = len(period_codes)
+        n_objects = len(object_codes)
+        if numpy is not None:
+            keys = (numpy.asarray(accounts, dtype=numpy.int64) * n_periods
+                    + numpy.asarray(periods, dtype=numpy.int64))
+            rows = numpy.asarray(object_rows, dtype=numpy.int64)
+            object_keys = keys[rows] * n_objects + numpy.asarray(objects, dtype=numpy.int64)
+            object_amounts = numpy.asarray(amounts, dtype=numpy.int64)[rows]
+        else:
+            keys = [a * n_periods + p for a, p in zip(accounts, periods)]
+            object_keys = [keys[row] * n_objects + obj
+                           for row, obj in zip(object_rows, objects)]
+            object_amounts = [amounts[row] for row in object_rows]
+
+        account_list = _coded(account_codes)
+        period_list = _coded(period_codes)
+        object_list = _coded(object_codes)
+        self.period_totals = {
+            (account_list[key // n_periods], period_list[key % n_periods]): ore
+            for key, ore in _sum_by_key(keys, amounts).items()}
+        self.object_totals = {
+            (account_list[key // n_objects // n_periods],
+             period_list[key // n_objects % n_periods])
+            + object_list[key % n_objects]: ore
+            for key, ore in _sum_by_key(object_keys, object_amounts).items()}
+        account_totals = defaultdict(int)
+        for (kontonr, _), ore in self.period_totals.items():
+            account_totals[kontonr] += ore
+        self.account_totals = dict(account_totals)
+
+    def is_balance_account(self, kontonr):
+        """True for tillgångar and skulder, False for kostnader and intäkter"""
+        if kontonr in self.account_types:
+            return self.account_types[kontonr] in BALANCE_TYPES
+        return kontonr.startswith(BALANCE_CLASSES)
+
+    def closing(self, kontonr):
+        """Opening balance plus all transactions of the year"""
+        return self.opening.get(kontonr, 0) + self.account_totals.get(kontonr, 0)
+
+    def balance_at(self, kontonr, period):
+        """Opening balance plus the transactions up to and including period"""
+        if self._months is None:
+            self._months = defaultdict(list)
+            for (account, month), ore in sorted(self.period_totals.items()):
+                self._months[account].append((month, ore))
+        return self.opening.get(kontonr, 0) + sum(
+            ore for month, ore in self._months.get(kontonr, []) if month <= period)
+
+    def records(self, result_only=False):
+        """
+        #UB and #RES per account and #PSALDO per account and month as
+        DataFields in file order. #PSALDO is the balance at the end of the
+        month for balance accounts and the change during the month for result
+        accounts, which also get a #PSALDO per object. With result_only only
+        the records for result accounts are made, for data without #IB.
+        """
+        totals = self.account_totals
+        for kontonr in sorted(set(totals) | set(self.opening)):
+            if self.is_balance_account(kontonr) and not result_only:
+                yield DataField(['#UB', self.year, kontonr,
+                                 _format_ore(self.closing(kontonr))])
+        for kontonr in sorted(totals):
+            if not self.is_balance_account(kontonr):
+                yield DataField(['#RES', self.year, kontonr,
+                                 _format_ore(totals[kontonr])])
+        running = dict(self.opening)
+        for kontonr, period in sorted(self.period_totals):
+            ore = self.period_totals[(kontonr, period)]
+            if self.is_balance_account(kontonr):
+                if result_only:
+                    continue
+                running[kontonr] = running.get(kontonr, 0) + ore
+                ore = running[kontonr]
+            yield DataField(['#PSALDO', self.year, str(period), kontonr, [],
+                             _format_ore(ore)])
+        for kontonr, period, dim, objekt in sorted(self.object_totals):
+            if not self.is_balance_account(kontonr):
+                yield DataField(['#PSALDO', self.year, str(period), kontonr,
+                                 [dim, objekt], _format_ore(
+                                     self.object_totals[(kontonr, period, dim, objekt)])])
+
+    def _computed(self, name, kontonr, period=None, objekt=()):
+        """The computed öre for a balance record, None if it is not computed"""
+        balance_account = self.is_balance_account(kontonr)
+        if name == '#UB':
+            return self.closing(kontonr)
+        if name == '#RES':
+            return self.account_totals.get(kontonr, 0)
+        if not objekt:
+            if balance_account:
+                return self.balance_at(kontonr, period)
+            return self.period_totals.get((kontonr, period), 0)
+        if len(objekt) == 2 and not balance_account:
+            return self.object_totals.get((kontonr, period) + tuple(objekt), 0)
+        # Balances per object need #OIB, which is not read
+        return None
+
+    def compare(self):
+        """
+        Differences between the #UB, #RES and #PSALDO records for the year in
+        the file and the computed ones, as (record, öre in the file, computed
+        öre) tuples sorted on record. Records are (name, kontonr) for #UB and
+        #RES and (name, kontonr, YYYYMM, objekt) for #PSALDO. Records that
+        are only computed have None in the file, and only count for record
+        types that the file has.
+        """
+        differences = []
+        in_file = set()
+        for name in CHECKED_FIELDS:
+            for field in self._year_records(name):
+                if name == '#PSALDO':
+                    _, period, kontonr, objekt, saldo = field.data[:5]
+                    key = (name, kontonr, int(period), tuple(objekt))
+                    computed = self._computed(name, kontonr, int(period), objekt)
+                else:
+                    _, kontonr, saldo = field.data[:3]
+                    key = (name, kontonr)
+                    computed = self._computed(name, kontonr)
+                in_file.add(key)
+                if computed is not None and computed != parse_ore(saldo):
+                    differences.append((key, parse_ore(saldo), computed))
+        names = {key[0] for key in in_file}
+        for field in self.records():
+            if field.name not in names:
+                continue
+            if field.name == '#PSALDO':
+                key = (field.name, field.data[2], int(field.data[1]),
+                       tuple(field.data[3]))
+            else:
+                key = (field.name, field.data[1])
+            if key not in in_file and parse_ore(field.data[-1]):
+                differences.append((key, None, parse_ore(field.data[-1])))
+        return sorted(differences)
+
+    def add_to(self, sie_data, result_only=False):
+        """Replace the #UB, #RES and #PSALDO records of the year in sie_data"""
+        for name in CHECKED_FIELDS:
+            sie_data.data[name] = [field for field in sie_data.get_data(name)
+                                   if not (field.data and field.data[0] == self.year)]
+        for field in self.records(result_only):
+            sie_data.data[field.name].append(field)
+
+
+if __name__ == "__main__":
+    from sie_parse import SieParser
+    ARGPARSER = argparse.ArgumentParser(
+        description='Räkna fram saldon ur verifikationerna i en SIE-fil och '
+        'jämför dem med filens #UB, #RES och #PSALDO')
+    ARGPARSER.add_argument('siefile', help='The SIE file to check')
+    ARGPARSER.add_argument('--year', default='0', help='Årsnr to check')
+    ARGPARSER.add_argument('--print', action='store_true',
+                           help='Print the computed balance records')
+    ARGS = ARGPARSER.parse_args()
+    PARSER = SieParser(ARGS.siefile)
+    PARSER.parse()
+    BALANCES = Balances(PARSER.result, ARGS.year)
+    if ARGS.print:
+        for FIELD in BALANCES.records():
+            print(FIELD)
+    DIFFERENCES = BALANCES.compare()
+    for RECORD, IN_FILE, COMPUTED in DIFFERENCES:
+        print('{}: {} i filen, {} beräknat'.format(
+            ' '.join(str(part) for part in RECORD),
+            '-' if IN_FILE is None else _format_ore(IN_FILE), _format_ore(COMPUTED)))
+    sys.exit(1 if DIFFERENCES else 0)
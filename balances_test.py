@@ -0,0 +1,102 @@
+"""Tests for the balance records"""
+
+from tempfile import NamedTemporaryFile
+
+import pytest
+
+import balances
+from balances import Balances
+from sie_parse import SieParser
+
+SIE = """#FLAGGA 0
+#RAR 0 20170101 20171231
+#KONTO 1930 "Bank"
+#KONTO 2440 "Leverantörsskulder"
+#KONTO 3010 "Gåvor"
+#KONTO 5010 "Lokalhyra"
+#KTYP 2440 S
+#IB 0 1930 1000.00
+#IB 0 2440 -200.00
+#IB -1 1930 500.00
+#UB 0 1930 850.25
+#RES 0 3010 -99.00
+#PSALDO 0 201701 1930 {} 1100.00
+#PSALDO 0 201702 5010 {1 "K1"} 300.00
+#VER A 1 20170105 "Gåva"
+{
+   #TRANS 1930 {} 100.00
+   #TRANS 3010 {1 "K1"} -100.00
+}
+#VER A 2 20170210 "Hyra"
+{
+   #TRANS 5010 {1 "K1" 6 "P1"} 249.75
+   #TRANS 1930 {} -249.75
+}
+#VER A 3 20161231 "Förra året"
+{
+   #TRANS 5010 {} 10
+   #TRANS 1930 {} -10
+}
+"""
+
+@pytest.fixture(params=['numpy', 'python'])
+def sie_data(request, monkeypatch):
+    """The test file, summed with numpy and with plain integers"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(balances, 'numpy', None)
+    with NamedTemporaryFile('w', suffix='.si', encoding='cp437') as siefile:
+        siefile.write(SIE)
+        siefile.flush()
+        parser = SieParser(siefile.name)
+        parser.parse()
+    return parser.result
+
+def test_totals(sie_data):
+    """Transactions are summed per account, month and object within #RAR"""
+    result = Balances(sie_data)
+    assert result.period_totals == {('1930', 201701): 10000,
+                                    ('3010', 201701): -10000,
+                                    ('5010', 201702): 24975,
+                                    ('1930', 201702): -24975}
+    assert result.object_totals == {('3010', 201701, '1', 'K1'): -10000,
+                                    ('5010', 201702, '1', 'K1'): 24975,
+                                    ('5010', 201702, '6', 'P1'): 24975}
+    assert result.closing('1930') == 85025
+    assert result.closing('2440') == -20000
+    assert result.balance_at('1930', 201701) == 110000
+
+def test_records(sie_data):
+    """#UB, #RES and #PSALDO records in file order"""
+    assert [repr(field) for field in Balances(sie_data).records()] == [
+        '#UB 0 1930 850.25',
+        '#UB 0 2440 -200',
+        '#RES 0 3010 -100',
+        '#RES 0 5010 249.75',
+        '#PSALDO 0 201701 1930 {} 1100',
+        '#PSALDO 0 201702 1930 {} 850.25',
+        '#PSALDO 0 201701 3010 {} -100',
+        '#PSALDO 0 201702 5010 {} 249.75',
+        '#PSALDO 0 201701 3010 {1 K1} -100',
+        '#PSALDO 0 201702 5010 {1 K1} 249.75',
+        '#PSALDO 0 201702 5010 {6 P1} 249.75']
+
+def test_compare(sie_data):
+    """Records that differ from the computed ones, or are missing, are found"""
+    assert Balances(sie_data).compare() == [
+        (('#PSALDO', '1930', 201702, ()), None, 85025),
+        (('#PSALDO', '3010', 201701, ()), None, -10000),
+        (('#PSALDO', '3010', 201701, ('1', 'K1')), None, -10000),
+        (('#PSALDO', '5010', 201702, ()), None, 24975),
+        (('#PSALDO', '5010', 201702, ('1', 'K1')), 30000, 24975),
+        (('#PSALDO', '5010', 201702, ('6', 'P1')), None, 24975),
+        (('#RES', '3010'), -9900, -10000),
+        (('#RES', '5010'), None, 24975),
+        (('#UB', '2440'), None, -20000)]
+
+def test_add_to(sie_data):
+    """The computed records replace those of the year, which then agree"""
+    Balances(sie_data).add_to(sie_data)
+    assert len(sie_data.get_data('#UB')) == 2
+    assert Balances(sie_data).compare() == []
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Convert many files at once: SIE files to Petra csv files and Petra csv
+exports to SIE files. The translation tables are read once and handed to a
+pool of worker processes, each converting one file at a time.
+Run with: python batch_convert.py SIE/ --tables TABELLER
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+from accounting_data import SieIO, NothingToExport
+from csv_dict import CSVDict, CSVKeyMissing
+from export_state import ExportState
+from sie_parse import SieParser
+from petra_output import PetraOutput
+from visma_output import PetraParser
+
+# Table attribute and file name, as in the table directory of the GUI
+TABLES = [('kto_acct', 'Kto_Acct.csv'), ('re_cc', 'Re_CC.csv'),
+          ('proj_cc', 'Proj_CC.csv'), ('acct_kto', 'Acct_Kto.csv'),
+          ('cc_re_proj', 'CC_Re_Proj.csv'), ('sie_defaults', 'SIE_defaults.csv'),
+          ('sie_dims', 'SIE_dims.csv'), ('sie_units', 'SIE_units.csv')]
+
+SIE_SUFFIXES = ('.si', '.se', '.sie')
+PETRA_SUFFIXES = ('.csv', '.txt')
+
+
+class Tables:
+    """
+    All translation tables of a table directory, loaded once, and for
+    incremental conversion the verifications and batches to skip.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, directory):
+        for attr, filename in TABLES:
+            setattr(self, attr, CSVDict(os.path.join(directory, filename)))
+        self.skip_verifications = None
+        self.skip_batches = None
+
+    def petra_output(self, sie_data):
+        """A PetraOutput for sie_data using these tables"""
+        return PetraOutput(sie_data, self.kto_acct, self.re_cc, self.proj_cc,
+                           skip=self.skip_verifications)
+
+    def petra_parser(self, petra_csv):
+        """A PetraParser for the Petra csv file using these tables"""
+        return PetraParser(petra_csv, self.acct_kto, self.cc_re_proj,
+                           self.sie_defaults, self.sie_dims, self.sie_units,
+                           self.kto_acct, self.re_cc, self.proj_cc,
+                           skip_batches=self.skip_batches)
+
+
+def is_sie_file(filename):
+    """True for SIE files, which are converted to Petra csv"""
+    return filename.lower().endswith(SIE_SUFFIXES)
+
+def find_files(patterns):
+    """
+    The files to convert, for a list of file names, directories and glob
+    patterns. Directories give every SIE and Petra file directly in them.
+    """
+    found = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = sorted(os.path.join(pattern, name)
+                           for name in os.listdir(pattern))
+            found.extend(name for name in names if os.path.isfile(name)
+                         and name.lower().endswith(SIE_SUFFIXES + PETRA_SUFFIXES))
+        elif os.path.isfile(pattern):
+            found.append(pattern)
+        else:
+            found.extend(sorted(glob.glob(pattern)))
+    return [name for name in found if not (name in seen or seen.add(name))]
+
+def output_filename(filename, output_dir=None):
+    """
+    Where the conversion of filename is written. Without an output directory
+    a SIE file in SIE/ goes to a sibling CSV/ directory if there is one, like
+    in the GUI, and everything else next to its input.
+    """
+    base, _ = os.path.splitext(os.path.basename(filename))
+    name = base + ('.csv' if is_sie_file(filename) else '.SI')
+    if output_dir is None:
+        directory = os.path.dirname(os.path.abspath(filename))
+        output_dir = directory
+        if is_sie_file(filename) and os.path.basename(directory) == 'SIE':
+            csv_dir = os.path.join(os.path.dirname(directory), 'CSV')
+            if os.path.isdir(csv_dir):
+                output_dir = csv_dir
+    return os.path.join(output_dir, name)
+
+def path_key(filename):
+    """A path as compared for collisions, also on case-insensitive file systems"""
+    return os.path.normcase(os.path.abspath(filename)).lower()
+
+def check_jobs(jobs):
+    """
+    The (filename, output, overwrite) jobs that must not run, as {filename:
+    reason}: those whose output is also an input, like x.SI from x.csv next
+    to x.si, and those whose output would also be written by another job.
+    """
+    inputs = {path_key(filename) for filename, _, _ in jobs}
+    writers = defaultdict(list)
+    for filename, output, _ in jobs:
+        writers[path_key(output)].append(filename)
+    rejected = {}
+    for filename, output, _ in jobs:
+        key = path_key(output)
+        if key in inputs:
+            rejected[filename] = 'utfilen {} är också en infil'.format(output)
+        elif len(writers[key]) > 1:
+            rejected[filename] = 'utfilen {} skrivs också av {}'.format(
+                output, ', '.join(other for other in writers[key] if other != filename))
+    return rejected
+
+def missing_message(csverr):
+    """The missing keys of a CSVKeyMissing, per table file"""
+    return 'saknas i ' + ', '.join(
+        '{}: {}'.format(os.path.basename(csv_dict.csv_filename), ', '.join(keys))
+        for csv_dict, keys in csverr.missing)
+
+def convert_file(tables, filename, output, overwrite=False):
+    """
+    Convert one file. Returns the number of verifications or journals and
+    what was exported: (serie, vernr) for a SIE file, batch keys for Petra.
+    A SIE file whose #KSUMMA does not match raises ChecksumMismatch and
+    nothing is written, since nobody is there to see a warning.
+    """
+    if os.path.exists(output) and not overwrite:
+        raise Exception("Kan inte skriva " + output + ", filen finns redan.")
+    if is_sie_file(filename):
+        parser = SieParser(filename, skip=tables.skip_verifications,
+                           strict_checksum=True)
+        p_output = tables.petra_output(parser.iter_records())
+        p_output.write_stream(output, True, collect_missing=True)
+        return p_output.verification_count, p_output.exported
+    petra_parser = tables.petra_parser(filename)
+    petra_parser.make_sie_data(collect_missing=True)
+    SieIO.writeSie(petra_parser.sie_data, output, True)
+    return len(petra_parser.sie_data.get_data('#VER')), petra_parser.batches
+
+
+_WORKER_TABLES = None
+
+def _init_worker(tables):
+    global _WORKER_TABLES # pylint: disable=global-statement
+    _WORKER_TABLES = tables
+
+def _convert_job(job):
+    """
+    Convert in a worker process. Returns (filename, output, verifications,
+    seconds, error message or None, exported), since exceptions may not
+    pickle. output is None if there was nothing new to export.
+    """
+    filename, output, overwrite = job
+    start = time.perf_counter()
+    count, error, exported = 0, None, []
+    try:
+        count, exported = convert_file(_WORKER_TABLES, filename, output, overwrite)
+    except NothingToExport:
+        output = None
+    except CSVKeyMissing as csverr:
+        error = missing_message(csverr)
+    except Exception as err: # pylint: disable=broad-except
+        error = str(err) or type(err).__name__
+    return filename, output, count, time.perf_counter() - start, error, exported
+
+def convert_files(tables, jobs, processes=None):
+    """
+    Convert (filename, output, overwrite) jobs, yielding the result of each
+    file as it is done. A pool is only started for more than one process.
+    """
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    if processes <= 1:
+        _init_worker(tables)
+        for job in jobs:
+            yield _convert_job(job)
+        return
+    with multiprocessing.Pool(processes, _init_worker, (tables,)) as pool:
+        yield from pool.imap_unordered(_convert_job, jobs)
+
+def main(argv=None):
+    """Run the batch conversion, returns the exit status"""
+    argparser = argparse.ArgumentParser(
+        description='Konvertera många SIE-filer till Petra och Petra-filer till SIE')
+    argparser.add_argument('files', nargs='+',
+                           help='Files, directories or glob patterns to convert')
+    argparser.add_argument('--tables', default='TABELLER',
+                           help='Directory with the translation tables')
+    argparser.add_argument('--output', metavar='DIR',
+                           help='Write all converted files to DIR')
+    argparser.add_argument('--overwrite', action='store_true',
+                           help='Replace converted files that already exist')
+    argparser.add_argument('--processes', type=int,
+                           help='Worker processes, defaults to the number of CPUs')
+    argparser.add_argument('--incremental', action='store_true',
+                           help='Skip verifications and batches that have been '
+                           'exported before, and remember the new ones. The '
+                           'files are converted one at a time')
+    args = argparser.parse_args(argv)
+
+    filenames = find_files(args.files)
+    if not filenames:
+        print('Inga filer att konvertera', file=sys.stderr)
+        return 2
+    tables = Tables(args.tables)
+    state = None
+    if args.incremental:
+        state = ExportState.in_directory(args.tables)
+        tables.skip_verifications = state.exported_verifications()
+        tables.skip_batches = state.exported_batches()
+    jobs = [(filename, output_filename(filename, args.output), args.overwrite)
+            for filename in filenames]
+    rejected = check_jobs(jobs)
+    failed = []
+    for filename, reason in sorted(rejected.items()):
+        print('FEL    {}: {}'.format(filename, reason))
+        failed.append(filename)
+    total = len(jobs)
+    jobs = [job for job in jobs if job[0] not in rejected]
+    # Incremental runs convert one file at a time in this process, so that
+    # what one file exports is skipped in the files after it
+    processes = 1 if state is not None else args.processes
+    for filename, output, count, seconds, error, exported in convert_files(
+            tables, jobs, processes):
+        if error is None and output is None:
+            print('INGET  {}: inget nytt att exportera'.format(filename))
+        elif error is None:
+            if state is not None and is_sie_file(filename):
+                state.add_verifications(exported)
+                tables.skip_verifications.update(exported)
+            elif state is not None:
+                state.add_batches(exported)
+                tables.skip_batches.update(exported)
+            print('OK     {} -> {} ({} verifikationer, {:.2f} s)'.format(
+                filename, output, count, seconds))
+        else:
+            print('FEL    {}: {}'.format(filename, error))
+            failed.append(filename)
+    if state is not None:
+        state.close()
+    print('{} av {} filer konverterade'.format(total - len(failed), total))
+    if failed:
+        print('Misslyckades:', file=sys.stderr)
+        for filename in failed:
+            print('  ' + filename, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Tests for the batch conversion"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import generate_data
+import batch_convert
+from accounting_data import SieIO
+from export_state import ExportState
+from sie_parse import SieParser
+
+def _setup(directory):
+    chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+    tables = os.path.join(directory, 'TABELLER')
+    os.mkdir(tables)
+    generate_data.write_tables(tables, chart)
+    for folder in ['SIE', 'CSV']:
+        os.mkdir(os.path.join(directory, folder))
+    return chart, tables
+
+def test_convert_directory(capsys):
+    """Every file is converted, a failing file is reported and gives status 1"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        sie_dir = os.path.join(directory, 'SIE')
+        for num in range(3):
+            generate_data.write_sie(os.path.join(sie_dir, 'm{}.si'.format(num)),
+                                    20, 3, chart, seed=num)
+        other = generate_data.Chart(accounts=10, seed=1)
+        generate_data.write_sie(os.path.join(sie_dir, 'bad.si'), 5, 3, other)
+
+        status = batch_convert.main([sie_dir, '--tables', tables,
+                                     '--processes', '2'])
+        out = capsys.readouterr().out
+        assert status == 1
+        assert '3 av 4 filer konverterade' in out
+        assert 'FEL    ' + os.path.join(sie_dir, 'bad.si') + ': saknas i' in out
+        assert 'Kto_Acct.csv: ' in out
+        converted = sorted(os.listdir(os.path.join(directory, 'CSV')))
+        assert converted == ['m0.csv', 'm1.csv', 'm2.csv']
+
+        # The existing outputs are not replaced without --overwrite
+        status = batch_convert.main([os.path.join(sie_dir, 'm*.si'),
+                                     '--tables', tables, '--processes', '1'])
+        assert status == 1
+        assert 'finns redan' in capsys.readouterr().out
+
+def test_convert_petra_files():
+    """Petra csv files are converted to SIE files in the output directory"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        petra = os.path.join(directory, 'p.csv')
+        generate_data.write_petra(petra, 12, 3, chart)
+        status = batch_convert.main([petra, '--tables', tables,
+                                     '--output', os.path.join(directory, 'SIE')])
+        assert status == 0
+        assert os.path.isfile(os.path.join(directory, 'SIE', 'p.SI'))
+
+def test_colliding_outputs_are_rejected(capsys):
+    """Outputs that are inputs or written twice are refused before converting"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        generate_data.write_sie(os.path.join(directory, 'x.si'), 5, 3, chart)
+        generate_data.write_petra(os.path.join(directory, 'x.csv'), 5, 3, chart)
+        other = os.path.join(directory, 'CSV')
+        generate_data.write_sie(os.path.join(other, 'y.si'), 5, 3, chart)
+        generate_data.write_sie(os.path.join(directory, 'SIE', 'y.si'), 5, 3, chart)
+        generate_data.write_sie(os.path.join(directory, 'SIE', 'z.si'), 5, 3, chart)
+        with open(os.path.join(directory, 'x.si'), 'rb') as original:
+            content = original.read()
+
+        os.mkdir(os.path.join(directory, 'out'))
+        status = batch_convert.main([directory, other, os.path.join(directory, 'SIE'),
+                                     '--tables', tables, '--overwrite',
+                                     '--output', os.path.join(directory, 'out')])
+        out = capsys.readouterr().out
+        assert status == 1
+        assert '3 av 5 filer konverterade' in out
+        assert out.count('skrivs också av') == 2
+        assert sorted(os.listdir(os.path.join(directory, 'out'))) == [
+            'x.SI', 'x.csv', 'z.csv']
+
+        status = batch_convert.main([directory, '--tables', tables, '--overwrite'])
+        out = capsys.readouterr().out
+        assert status == 1
+        assert out.count('är också en infil') == 2
+        with open(os.path.join(directory, 'x.si'), 'rb') as original:
+            assert original.read() == content
+
+def test_checksum_mismatch_is_an_error(capsys):
+    """A SIE file with a #KSUMMA that does not match is not converted or exported"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        plain = os.path.join(directory, 'plain.si')
+        generate_data.write_sie(plain, 5, 3, chart)
+        siefile = os.path.join(directory, 'SIE', 'k.si')
+        SieIO.writeSie(SieParser(plain).iter_records(), siefile)
+        with open(siefile, encoding='cp437') as written:
+            text = written.read()
+        with open(siefile, 'w', encoding='cp437') as tampered:
+            tampered.write(text.replace('#VER A 2 ', '#VER A 12 '))
+
+        status = batch_convert.main([siefile, '--tables', tables, '--incremental'])
+        assert status == 1
+        assert 'FEL    ' + siefile + ': Kontrollsumman #KSUMMA' in capsys.readouterr().out
+        assert os.listdir(os.path.join(directory, 'CSV')) == []
+        with ExportState.in_directory(tables) as state:
+            assert not state.exported_verifications()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the parsing and conversion steps.
+Run a benchmark with: python benchmark.py lexer --size 100000
+The suite benchmark times and memory-profiles every conversion step and can
+save the results with --json, to compare runs.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shlex
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+import generate_data
+from sie_parse import SieParser, split_line
+from accounting_data import Transaction, MaybeDate, SieIO, _format_float, _quote
+from petra_output import PetraOutput
+from visma_output import PetraParser
+from export_state import ExportState
+
+
+def _best_time(func, *args, repeat=3):
+    """Run func repeat times and return the fastest wall time in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _sie_lines(verifications, trans_per_ver=4):
+    """The lines of a synthetic SIE 4 file"""
+    return list(generate_data.sie_lines(verifications, trans_per_ver))
+
+def _write_sie_file(verifications):
+    """Write a synthetic SIE file and return its name. Remove it when done."""
+    with NamedTemporaryFile(suffix='.si', delete=False) as siefile:
+        pass
+    generate_data.write_sie(siefile.name, verifications)
+    return siefile.name
+
+def _shlex_tokens(line):
+    """The tokenizer used before split_line, for comparison"""
+    tokens = shlex.split(line)
+    if not tokens or tokens[0] != '#TRANS':
+        return tokens
+    if tokens[2] == '{}':
+        return tokens[:2] + [[]] + tokens[3:]
+    if tokens[2].endswith('}'):
+        return tokens[:2] + [[tokens[2][1:-1]]] + tokens[3:]
+    objekt = [tokens[2][1:]]
+    for idx, token in enumerate(tokens[3:]):
+        if token.endswith('}'):
+            objekt.append(token[:-1])
+            return tokens[:2] + [objekt] + tokens[4+idx:]
+        objekt.append(token)
+    return tokens
+
+def bench_lexer(size):
+    """Line throughput of split_line compared to shlex.split"""
+    lines = _sie_lines(size)
+    results = {}
+    for name, tokenizer in [('shlex', _shlex_tokens), ('split_line', split_line)]:
+        seconds = _best_time(lambda: [tokenizer(line) for line in lines])
+        results[name] = len(lines) / seconds
+    print('{} lines'.format(len(lines)))
+    for name, lines_per_second in results.items():
+        print('{:>12}: {:>12,.0f} lines/s'.format(name, lines_per_second))
+    print('     speedup: {:.1f}x'.format(results['split_line'] / results['shlex']))
+
+class _DictTransaction:
+    """The Transaction layout used before __slots__ and öre, for comparison"""
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, kontonr, objekt, belopp, transdat='', transtext='',
+                 kvantitet=0.0, sign=''):
+        # pylint: disable=too-many-arguments
+        self.kontonr = kontonr
+        self.objekt = objekt
+        self.belopp = float(belopp)
+        self.transdat = _DictMaybeDate(transdat)
+        self.transtext = transtext
+        self.kvantitet = float(kvantitet)
+        self.sign = sign
+        if self.belopp < 0:
+            self.debit = '0'
+            self.credit = _format_float(-1*self.belopp, True)
+        else:
+            self.credit = '0'
+            self.debit = _format_float(self.belopp, True)
+
+class _DictMaybeDate:
+    """The MaybeDate layout used before packed dates, for comparison"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, datestring):
+        try:
+            self.date = datetime.strptime(datestring, "%Y%m%d")
+            self.year = self.date.year
+            self.month = self.date.month
+            self.day = self.date.day
+            self.has_date = True
+        except ValueError:
+            self.date = self.year = self.month = None
+            self.has_date = False
+
+def _bytes_per_transaction(transaction_class, rows):
+    """Allocated bytes per transaction when all rows are kept in memory"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    transactions = [transaction_class(*row) for row in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(transactions)
+
+def bench_memory(size):
+    """Bytes per transaction for the old and the compact Transaction"""
+    rows = [split_line(line)[1:] for line in _sie_lines(size)
+            if line.lstrip().startswith('#TRANS')]
+    print('{} transactions'.format(len(rows)))
+    for name, transaction_class in [('dict', _DictTransaction),
+                                    ('slots', Transaction)]:
+        print('{:>12}: {:>8.1f} bytes/transaction'.format(
+            name, _bytes_per_transaction(transaction_class, rows)))
+
+def bench_dates(size):
+    """Date parsing and formatting with strptime compared to MaybeDate"""
+    dates = ['2017{:02}{:02}'.format(num % 12 + 1, num % 28 + 1)
+             for num in range(size)]
+    def with_strptime():
+        for date in dates:
+            datetime.strptime(date, "%Y%m%d").strftime("%d/%m/%Y")
+    def with_maybe_date():
+        for date in dates:
+            MaybeDate(date).format("%d/%m/%Y")
+    print('{} dates'.format(size))
+    for name, func in [('strptime', with_strptime),
+                       ('MaybeDate', with_maybe_date)]:
+        print('{:>12}: {:>12,.0f} dates/s'.format(name, size / _best_time(func)))
+
+def bench_parallel(size):
+    """SieParser.parse compared to parse_parallel"""
+    siefile = _write_sie_file(size)
+    try:
+        serial = _best_time(lambda: SieParser(siefile).parse(), repeat=1)
+        parallel = _best_time(lambda: SieParser(siefile).parse_parallel(),
+                              repeat=1)
+    finally:
+        os.remove(siefile)
+    print('{} verifications, {} processes'.format(size, os.cpu_count()))
+    print('{:>12}: {:>8.2f} s'.format('parse', serial))
+    print('{:>12}: {:>8.2f} s'.format('parallel', parallel))
+
+def _concat_repr(sie_data):
+    """How SieData.__repr__ built the file text before writeRecords"""
+    fields = (sie_data.ident_fields + sie_data.account_fields
+              + sie_data.balance_fields + sie_data.control_fields)
+    res = ''
+    for field in fields:
+        for record in sie_data.data.get(field, []):
+            if record.name == '#VER':
+                quoted = _quote([record.serie, record.vernr, record.verdatum,
+                                 record.vertext, record.regdatum, record.sign])
+                text = '#VER {} {} {} {} {} {}'.format(*quoted)
+                text += '\n{\n'
+                for trans in record.trans_list:
+                    text += '   {}\n'.format(trans)
+                text += '}'
+            else:
+                text = repr(record)
+            res += '{}\n'.format(text)
+    return res
+
+def _time_and_peak(func):
+    """Best wall time in seconds and peak allocated bytes of func()"""
+    elapsed = _best_time(func)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def bench_write(size):
+    """Writing a SieData through repr concatenation compared to writeRecords"""
+    siefile = _write_sie_file(size)
+    parser = SieParser(siefile)
+    parser.parse()
+    os.remove(siefile)
+    def with_repr():
+        with open(os.devnull, 'w', encoding='cp437', errors='replace') as out:
+            out.write(_concat_repr(parser.result))
+    def with_stream():
+        with open(os.devnull, 'w', encoding='cp437', errors='replace') as out:
+            SieIO.writeRecords(parser.result.records(), out)
+    print('{} verifications'.format(size))
+    for name, func in [('repr', with_repr), ('writeRecords', with_stream)]:
+        elapsed, peak = _time_and_peak(func)
+        print('{:>12}: {:>8.2f} s {:>10,.0f} kB peak'.format(
+            name, elapsed, peak / 1024))
+
+def bench_incremental(size):
+    """Full conversion compared to one where 90 % is already exported"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart()
+        tables = dict(zip(generate_data.TABLE_FILES,
+                          generate_data.write_tables(directory, chart)))
+        siefile = os.path.join(directory, 'bench.si')
+        generate_data.write_sie(siefile, size, chart=chart)
+        output = os.path.join(directory, 'output.csv')
+        with ExportState.in_directory(directory) as state:
+            state.add_verifications(('A', str(num)) for num in range(1, size * 9 // 10 + 1))
+            exported = state.exported_verifications()
+        def convert(skip):
+            PetraOutput(SieParser(siefile, skip=skip).iter_records(),
+                        tables['Kto_Acct.csv'], tables['Re_CC.csv'],
+                        tables['Proj_CC.csv']).write_stream(output, True)
+        print('{} verifications, {} exported before'.format(size, len(exported)))
+        for name, skip in [('full', None), ('incremental', exported)]:
+            print('{:>12}: {:>8.2f} s'.format(
+                name, _best_time(convert, skip, repeat=1)))
+
+def _suite_stages(directory, size):
+    """(name, setup, run) for each step, setup() returns the argument to run"""
+    chart = generate_data.Chart()
+    tables = dict(zip(generate_data.TABLE_FILES,
+                      generate_data.write_tables(directory, chart)))
+    siefile = os.path.join(directory, 'bench.si')
+    petrafile = os.path.join(directory, 'bench_petra.csv')
+    generate_data.write_sie(siefile, size, chart=chart)
+    generate_data.write_petra(petrafile, size, chart=chart)
+    parsed = SieParser(siefile)
+    parsed.parse()
+
+    def petra_output():
+        return PetraOutput(parsed.result, tables['Kto_Acct.csv'],
+                           tables['Re_CC.csv'], tables['Proj_CC.csv'])
+    def populated():
+        p_output = petra_output()
+        p_output.populate_output_table()
+        return p_output
+    def petra_parser():
+        return PetraParser(petrafile, *[tables[name] for name in [
+            'Acct_Kto.csv', 'CC_Re_Proj.csv', 'SIE_defaults.csv',
+            'SIE_dims.csv', 'SIE_units.csv', 'Kto_Acct.csv', 'Re_CC.csv',
+            'Proj_CC.csv']])
+    output = os.path.join(directory, 'output')
+    return [
+        ('SieParser.parse', lambda: SieParser(siefile), lambda p: p.parse()),
+        ('PetraOutput.populate_output_table', petra_output,
+         lambda p: p.populate_output_table()),
+        ('PetraOutput.write_output', populated,
+         lambda p: p.write_output(output, True)),
+        ('PetraOutput.write_stream', lambda: PetraOutput(
+            SieParser(siefile).iter_records(), tables['Kto_Acct.csv'],
+            tables['Re_CC.csv'], tables['Proj_CC.csv']),
+         lambda p: p.write_stream(output, True)),
+        ('PetraParser.make_sie_data', petra_parser,
+         lambda p: p.make_sie_data()),
+        ('SieIO.writeSie', lambda: parsed.result,
+         lambda sie_data: SieIO.writeSie(sie_data, output, True)),
+    ]
+
+def bench_suite(size):
+    """Time and memory-profile every conversion step on synthetic data"""
+    results = {'size': size, 'date': datetime.now().isoformat(),
+               'python': sys.version.split()[0], 'machine': platform.machine(),
+               'stages': {}}
+    with TemporaryDirectory() as directory:
+        for name, setup, run in _suite_stages(directory, size):
+            argument = setup()
+            seconds = _best_time(run, argument, repeat=1)
+            argument = setup()
+            gc.collect()
+            tracemalloc.start()
+            run(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results['stages'][name] = {'seconds': seconds, 'peak_kb': peak / 1024}
+            print('{:>36}: {:>8.2f} s {:>10,.0f} kB peak'.format(
+                name, seconds, peak / 1024))
+    return results
+
+BENCHMARKS = {'lexer': bench_lexer, 'memory': bench_memory,
+              'dates': bench_dates, 'parallel': bench_parallel,
+              'write': bench_write, 'incremental': bench_incremental,
+              'suite': bench_suite}
+
+if __name__ == "__main__":
+    ARGPARSER = argparse.ArgumentParser(description='Run a benchmark')
+    ARGPARSER.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    ARGPARSER.add_argument('--size', type=int, default=20000,
+                           help='Number of verifications to generate')
+    ARGPARSER.add_argument('--json', metavar='FILE',
+                           help='Save the results as json, for the suite')
+    ARGS = ARGPARSER.parse_args()
+    RESULTS = BENCHMARKS[ARGS.benchmark](ARGS.size)
+    if ARGS.json and RESULTS:
+        with open(ARGS.json, 'w') as json_file:
+            json.dump(RESULTS, json_file, indent=2)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+The transactions of a SieData as columns, one row per transaction, for
+analysis. Columns are built as lists in a single pass over the verifications
+and turned into a numpy structured array or a pyarrow Table. numpy and
+pyarrow are optional and only imported when those formats are asked for.
+"""
+
+import argparse
+
+# Column name and numpy dtype, strings get the width of the longest value
+COLUMNS = [('serie', 'U'), ('vernr', 'U'), ('verdatum', 'i4'),
+           ('vertext', 'U'), ('kontonr', 'U'), ('resultatenhet', 'U'),
+           ('projekt', 'U'), ('belopp_ore', 'i8'), ('transdat', 'i4'),
+           ('transtext', 'U'), ('kvantitet', 'f8')]
+
+# Object dimensions for cost center and project, as in PetraOutput
+COST_CENTER_DIM = '1'
+PROJECT_DIM = '6'
+
+
+def transaction_columns(sie_data):
+    """
+    {column name: list} with one entry per transaction. Dates are YYYYMMDD
+    integers, 0 if missing, and missing objects are ''.
+    """
+    # pylint: disable=too-many-locals
+    columns = {name: [] for name, _ in COLUMNS}
+    serie, vernr, verdatum, vertext = (columns['serie'], columns['vernr'],
+                                       columns['verdatum'], columns['vertext'])
+    kontonr, ore, transdat = (columns['kontonr'], columns['belopp_ore'],
+                              columns['transdat'])
+    cost_center, project = columns['resultatenhet'], columns['projekt']
+    transtext, kvantitet = columns['transtext'], columns['kvantitet']
+    for ver in sie_data.get_data('#VER'):
+        rows = len(ver.trans_list)
+        serie.extend([ver.serie] * rows)
+        vernr.extend([ver.vernr] * rows)
+        verdatum.extend([ver.verdatum.packed] * rows)
+        vertext.extend([ver.vertext] * rows)
+        for trans in ver.trans_list:
+            kontonr.append(trans.kontonr)
+            ore.append(trans.ore)
+            # pylint: disable=protected-access
+            transdat.append(trans._transdat)
+            transtext.append(trans.transtext)
+            kvantitet.append(trans.kvantitet)
+            # The objekt list alternates dimension and object
+            objekt = trans.objekt
+            trans_cc = trans_project = ''
+            for idx in range(0, len(objekt) - 1, 2):
+                if objekt[idx] == COST_CENTER_DIM:
+                    trans_cc = objekt[idx + 1]
+                elif objekt[idx] == PROJECT_DIM:
+                    trans_project = objekt[idx + 1]
+            cost_center.append(trans_cc)
+            project.append(trans_project)
+    return columns
+
+def to_numpy(sie_data):
+    """The transactions as a numpy structured array"""
+    import numpy
+    columns = transaction_columns(sie_data)
+    arrays = [numpy.array(columns[name], dtype=dtype) for name, dtype in COLUMNS]
+    table = numpy.empty(len(arrays[0]), dtype=[
+        (name, array.dtype) for (name, _), array in zip(COLUMNS, arrays)])
+    for (name, _), array in zip(COLUMNS, arrays):
+        table[name] = array
+    return table
+
+def to_arrow(sie_data):
+    """The transactions as a pyarrow Table"""
+    import pyarrow
+    types = {'U': pyarrow.string(), 'i4': pyarrow.int32(),
+             'i8': pyarrow.int64(), 'f8': pyarrow.float64()}
+    columns = transaction_columns(sie_data)
+    return pyarrow.table({name: pyarrow.array(columns[name], types[dtype])
+                          for name, dtype in COLUMNS})
+
+def write_parquet(sie_data, filename):
+    """Save the transactions as a Parquet file"""
+    import pyarrow.parquet
+    pyarrow.parquet.write_table(to_arrow(sie_data), filename)
+
+if __name__ == "__main__":
+    from sie_parse import SieParser
+    ARGPARSER = argparse.ArgumentParser(
+        description='Spara transaktionerna i en SIE-fil som en Parquet-fil')
+    ARGPARSER.add_argument('siefile', help='The SIE file to read')
+    ARGPARSER.add_argument('parquetfile', help='The Parquet file to write')
+    ARGS = ARGPARSER.parse_args()
+    PARSER = SieParser(ARGS.siefile)
+    PARSER.parse()
+    write_parquet(PARSER.result, ARGS.parquetfile)
@@ -0,0 +1,50 @@
+"""Tests for the columnar export"""
+
+from tempfile import NamedTemporaryFile
+
+import pytest
+
+import columnar
+from accounting_data import SieData, Verification, Transaction
+
+def _sie_data():
+    sie_data = SieData()
+    ver = Verification('A', '1', '20170105', 'Gåva')
+    ver.add_trans(Transaction('1930', [], '100.50', '', '', 0, ''))
+    ver.add_trans(Transaction('3010', ['1', 'K1', '6', 'P-1'], '-100.50',
+                              '20170106', 'Rad', '2'))
+    sie_data.add_data(ver)
+    ver = Verification('B', '7', '20170201')
+    ver.add_trans(Transaction('5010', ['6', 'P-2'], '10'))
+    ver.add_trans(Transaction('1930', [], '-10'))
+    sie_data.add_data(ver)
+    return sie_data
+
+def test_transaction_columns():
+    """One row per transaction, with the verification repeated"""
+    columns = columnar.transaction_columns(_sie_data())
+    assert columns['serie'] == ['A', 'A', 'B', 'B']
+    assert columns['verdatum'] == [20170105, 20170105, 20170201, 20170201]
+    assert columns['belopp_ore'] == [10050, -10050, 1000, -1000]
+    assert columns['resultatenhet'] == ['', 'K1', '', '']
+    assert columns['projekt'] == ['', 'P-1', 'P-2', '']
+    assert columns['transdat'] == [0, 20170106, 0, 0]
+    assert columns['kvantitet'] == [0.0, 2.0, 0.0, 0.0]
+
+def test_to_numpy():
+    """A structured array with a field per column"""
+    numpy = pytest.importorskip('numpy')
+    table = _sie_data().to_numpy()
+    assert table.dtype.names == tuple(name for name, _ in columnar.COLUMNS)
+    assert table['belopp_ore'].dtype == numpy.int64
+    assert table['belopp_ore'].sum() == 0
+    assert list(table['kontonr'][table['projekt'] != '']) == ['3010', '5010']
+
+def test_parquet():
+    """Saved Parquet files give the same columns back"""
+    parquet = pytest.importorskip('pyarrow.parquet')
+    sie_data = _sie_data()
+    with NamedTemporaryFile(suffix='.parquet') as parquet_file:
+        columnar.write_parquet(sie_data, parquet_file.name)
+        table = parquet.read_table(parquet_file.name)
+    assert table.to_pydict() == columnar.transaction_columns(sie_data)
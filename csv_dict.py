@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 """Access a csv file using a dictionary interface."""
 
-import collections
+import collections.abc
+import contextlib
 import csv
+import json
+import os
+import shutil
+import tempfile
+
+import stats
 
 class CSVKeyMissing(KeyError):
     def __init__(self, message, csv_dict, key):
@@ -10,17 +17,82 @@ class CSVKeyMissing(KeyError):
         self.csv_dict = csv_dict
         self.key = key
 
+    @property
+    def missing(self):
+        """The missing keys as a list of (csv_dict, keys) tuples"""
+        return [(self.csv_dict, [self.key])]
+
+
+class CSVKeysMissing(CSVKeyMissing):
+    """
+    Several keys are missing, possibly from several CSVDicts.
+    csv_dict and key refer to the first missing key, missing to all of them.
+    """
+    def __init__(self, missing):
+        count = sum(len(keys) for _, keys in missing)
+        super().__init__("{} keys missing".format(count), missing[0][0],
+                         missing[0][1][0])
+        self._missing = missing
+
+    @property
+    def missing(self):
+        """The missing keys as a list of (csv_dict, keys) tuples"""
+        return self._missing
+
+
+class MissingKeys:
+    """
+    Collects CSVKeyMissing errors, grouped by CSVDict, so that every missing
+    key can be reported at once instead of stopping at the first.
+    """
+    def __init__(self):
+        self.tables = []
+
+    def add(self, csverr):
+        """Remember the key from a CSVKeyMissing error"""
+        for csv_dict, keys in self.tables:
+            if csv_dict is csverr.csv_dict:
+                if csverr.key not in keys:
+                    keys.append(csverr.key)
+                return
+        self.tables.append((csverr.csv_dict, [csverr.key]))
+
+    def __bool__(self):
+        return bool(self.tables)
+
+    def raise_if_missing(self):
+        """Raise CSVKeysMissing if any key has been added"""
+        if self.tables:
+            raise CSVKeysMissing(self.tables)
+
 
-class CSVDict(collections.MutableMapping):
+class CSVDict(collections.abc.MutableMapping):
     """
     Access a csv file using a dictionary interface.
     Obvious flaws include utter failure if the csv is modified while it's being
     used by Python. Still, it should be useful.
     It will just die if the csv file is missing or lacks a header line.
+
+    With use_cache, the parsed table is also kept in a JSON file next to
+    the csv, which is used instead of parsing the csv as long as the csv's
+    mtime and size are unchanged. The class attribute sets the default.
     """
-    def __init__(self, csv_filename):
+    use_cache = False
+
+    @stats.timed('CSVDict load')
+    def __init__(self, csv_filename, use_cache=None):
         self.store = dict()
         self.csv_filename = csv_filename
+        self._in_batch = False
+        if use_cache is not None:
+            self.use_cache = use_cache
+        if not (self.use_cache and self._load_cache()):
+            self._read_csv()
+            if self.use_cache:
+                self._save_cache()
+
+    def _read_csv(self):
+        """Parse the csv file into fields and store"""
         with open(self.csv_filename) as csv_file:
             csv_reader = csv.reader(csv_file, delimiter=';')
             self.fields = csv_reader.__next__()
@@ -30,25 +102,38 @@ class CSVDict(collections.MutableMapping):
                     self.store[row[0]][self.fields[i + 1]] = row[i + 1]
 
     def __getitem__(self, key):
+        if stats.enabled:
+            stats.count('Lookups ' + os.path.basename(self.csv_filename))
         try:
             return self.store[key]
         except KeyError:
+            stats.count('Missing ' + os.path.basename(self.csv_filename))
             raise CSVKeyMissing("Key {} missing".format(key), self, key)
 
+    def lookup(self, key, field, missing=None):
+        """
+        The field of the row for key. If the key is missing and missing is a
+        MissingKeys, the key is added to it and None returned, otherwise
+        CSVKeyMissing is raised.
+        """
+        try:
+            return self[key][field]
+        except CSVKeyMissing as csverr:
+            if missing is None:
+                raise
+            missing.add(csverr)
+            return None
+
     def __setitem__(self, key, value):
+        values = self._row(key, value)
+        if self._in_batch:
+            self.store[key] = dict(zip(self.fields[1:], values[1:]))
+            return
         if key in self.store:
             self.__delitem__(key)
+        self._remove_cache()
         # Write to csv file
         with open(self.csv_filename, 'a', newline='') as csv_file:
-            if isinstance(value, dict):
-                value[self.fields[0]] = key
-                values = list([value.get(k, '') for k in self.fields])
-            elif isinstance(value, list):
-                values = [key] + value
-            else:
-                values = [key, value] + [''] * (len(self.fields) - 2)
-            values += [''] * (len(self.fields) - len(values))
-
             csv_writer = csv.writer(csv_file, delimiter=';',
                     quoting=csv.QUOTE_MINIMAL)
             csv_writer.writerow(values)
@@ -56,6 +141,9 @@ class CSVDict(collections.MutableMapping):
             self.store[key] = dict(zip(self.fields[1:], values[1:]))
 
     def __delitem__(self, key):
+        if self._in_batch:
+            del self.store[key]
+            return
         with open(self.csv_filename, 'r+', newline='') as csv_file:
             data = csv_file.readlines()
             csv_file.seek(0)
@@ -64,9 +152,119 @@ class CSVDict(collections.MutableMapping):
                     csv_file.write(line)
             csv_file.truncate()
         del self.store[key]
+        self._remove_cache()
+
+    def _row(self, key, value):
+        """The csv row for key, value is a dict, a list or a single value"""
+        if isinstance(value, dict):
+            value[self.fields[0]] = key
+            values = list([value.get(k, '') for k in self.fields])
+        elif isinstance(value, list):
+            values = [key] + value
+        else:
+            values = [key, value] + [''] * (len(self.fields) - 2)
+        values += [''] * (len(self.fields) - len(values))
+        return values
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Apply changes in memory only and write the whole table once, when the
+        with block ends. If the block raises, the changes are discarded.
+        """
+        if self._in_batch:
+            yield self
+            return
+        saved = {key: dict(value) for key, value in self.store.items()}
+        self._in_batch = True
+        try:
+            yield self
+        except BaseException:
+            self.store = saved
+            raise
+        finally:
+            self._in_batch = False
+        self._write_table()
+
+    def update_many(self, items):
+        """Set several keys, from a mapping or (key, value) pairs, in one write"""
+        if isinstance(items, collections.abc.Mapping):
+            items = items.items()
+        with self.batch():
+            for key, value in items:
+                self[key] = value
+
+    def _write_table(self):
+        """Write the whole table to a temporary file and move it into place"""
+        directory = os.path.dirname(os.path.abspath(self.csv_filename))
+        with tempfile.NamedTemporaryFile('w', dir=directory, newline='',
+                                         suffix='.tmp', delete=False) as tmp_file:
+            csv_writer = csv.writer(tmp_file, delimiter=';',
+                    quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(self.fields)
+            for key, value in self.store.items():
+                csv_writer.writerow([key] + [value.get(field, '')
+                                             for field in self.fields[1:]])
+        if os.path.exists(self.csv_filename):
+            shutil.copymode(self.csv_filename, tmp_file.name)
+        os.replace(tmp_file.name, self.csv_filename)
+        if self.use_cache:
+            self._save_cache()
+
+    @property
+    def cache_filename(self):
+        """The file where the parsed table is cached"""
+        return self.csv_filename + '.cache'
+
+    def _load_cache(self):
+        """
+        Read fields and store from the cache, False if it is missing, old or
+        not a cache, in which case the csv is parsed and the cache rewritten.
+        """
+        try:
+            stat = os.stat(self.csv_filename)
+            with open(self.cache_filename, encoding='utf_8') as cache_file:
+                mtime, size, fields, store = json.load(cache_file)
+        except (OSError, ValueError, TypeError):
+            return False
+        if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+            return False
+        if not (isinstance(fields, list) and isinstance(store, dict)):
+            return False
+        self.fields = fields
+        self.store = store
+        return True
+
+    def _save_cache(self):
+        """Write fields and store to the cache, tagged with the csv's stat"""
+        directory = os.path.dirname(os.path.abspath(self.csv_filename))
+        try:
+            stat = os.stat(self.csv_filename)
+            with tempfile.NamedTemporaryFile('w', encoding='utf_8', dir=directory,
+                                             suffix='.tmp', delete=False) as tmp_file:
+                json.dump([stat.st_mtime_ns, stat.st_size, self.fields,
+                           self.store], tmp_file)
+            os.replace(tmp_file.name, self.cache_filename)
+        except OSError:
+            pass
+
+    def _remove_cache(self):
+        """Remove the cache after the csv has been changed key by key"""
+        if self.use_cache:
+            try:
+                os.remove(self.cache_filename)
+            except OSError:
+                pass
 
     def __iter__(self):
         return iter(self.store)
 
     def __len__(self):
         return len(self.store)
+
+
+def open_table(table):
+    """table if it already is a CSVDict, otherwise a CSVDict for the file name"""
+    if isinstance(table, CSVDict):
+        return table
+    return CSVDict(table)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 """Tests for CSVDict."""
 
+import os
 import pytest
 from tempfile import NamedTemporaryFile
-from csv_dict import CSVDict,CSVKeyMissing
+from csv_dict import CSVDict,CSVKeyMissing,MissingKeys
 
 def test_add_items():
     with NamedTemporaryFile(mode='w') as table_file:
@@ -24,6 +25,20 @@ def test_add_items():
         assert table2['3'] == {'a': '2', 'b': '3'}
         assert table2['4']['a'] == '4'
 
+def test_lookup():
+    with NamedTemporaryFile(mode='w') as table_file:
+        table_file.write("number;a\n1;one\n")
+        table_file.flush()
+        table = CSVDict(table_file.name)
+        missing = MissingKeys()
+
+        assert table.lookup('1', 'a', missing) == 'one'
+        assert table.lookup('2', 'a', missing) is None
+        assert table.lookup('2', 'a', missing) is None
+        assert missing.tables == [(table, ['2'])]
+        with pytest.raises(CSVKeyMissing):
+            table.lookup('2', 'a')
+
 def test_remove_item():
     with NamedTemporaryFile(mode='w') as table_file:
         table_file.write("number;a;b\n")
@@ -40,3 +55,80 @@ def test_remove_item():
         with pytest.raises(CSVKeyMissing):
             _ = table['1']
             _ = table2['1']
+
+def test_batch():
+    with NamedTemporaryFile(mode='w') as table_file:
+        table_file.write("number;a;b\n")
+        table_file.write("1;data;\n")
+        table_file.write("2;more;x\n")
+        table_file.flush()
+        table = CSVDict(table_file.name)
+
+        with table.batch():
+            table['1'] = {'a': 'new', 'b': 'y'}
+            table['3'] = ['c', 'd']
+            table['2']['b'] = 'z'
+            del table['2']
+            table['2'] = '2'
+            assert table['3'] == {'a': 'c', 'b': 'd'}
+            # Nothing is written until the batch ends
+            assert CSVDict(table_file.name)['1']['a'] == 'data'
+
+        with open(table_file.name) as csv_file:
+            assert csv_file.read() == "number;a;b\n1;new;y\n3;c;d\n2;2;\n"
+
+        with pytest.raises(ValueError):
+            with table.batch():
+                table['4'] = '4'
+                table['1']['a'] = 'changed'
+                raise ValueError()
+        assert '4' not in table
+        assert table['1']['a'] == 'new'
+        assert '4' not in CSVDict(table_file.name)
+
+def test_update_many():
+    with NamedTemporaryFile(mode='w') as table_file:
+        table_file.write("number;a\n")
+        table_file.flush()
+        table = CSVDict(table_file.name)
+        table.update_many({str(n): str(n * 2) for n in range(100)})
+        table.update_many([('1', 'one')])
+
+        table2 = CSVDict(table_file.name)
+        assert len(table2) == 100
+        assert table2['1']['a'] == 'one'
+        assert table2['99']['a'] == '198'
+
+def test_cache(monkeypatch):
+    with NamedTemporaryFile(mode='w', suffix='.csv') as table_file:
+        table_file.write("number;a\n1;one\n")
+        table_file.flush()
+        table = CSVDict(table_file.name, use_cache=True)
+        assert os.path.exists(table.cache_filename)
+
+        try:
+            # A valid cache is used without parsing the csv
+            with monkeypatch.context() as patch:
+                patch.setattr(CSVDict, '_read_csv', None)
+                assert CSVDict(table_file.name, use_cache=True)['1']['a'] == 'one'
+
+            # Writes through CSVDict are seen by the next load
+            table['2'] = 'two'
+            table.update_many({'3': 'three'})
+            assert len(CSVDict(table_file.name, use_cache=True)) == 3
+
+            # So are changes made outside CSVDict
+            with open(table_file.name, 'a') as csv_file:
+                csv_file.write("4;four\n")
+            assert CSVDict(table_file.name, use_cache=True)['4']['a'] == 'four'
+
+            # A cache that can not be read is replaced
+            for garbage in ['not json', '[1, 2]', '{}', '[0, 0, 1, 2]']:
+                with open(table.cache_filename, 'w') as cache_file:
+                    cache_file.write(garbage)
+                assert CSVDict(table_file.name, use_cache=True)['4']['a'] == 'four'
+            with monkeypatch.context() as patch:
+                patch.setattr(CSVDict, '_read_csv', None)
+                assert len(CSVDict(table_file.name, use_cache=True)) == 4
+        finally:
+            os.remove(table.cache_filename)
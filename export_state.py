@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Remember which verifications and Petra batches have been exported, and
+which files watch_folder has written, in a SQLite file in the table
+directory. The exported keys are read into sets once, so that SieParser,
+PetraOutput and PetraParser can skip what has already been exported
+without translating it.
+"""
+
+import os
+import sqlite3
+import argparse
+from datetime import datetime
+
+# File name in the table directory
+STATE_FILE = 'export_state.sqlite'
+
+
+def is_numbered(serie, vernr):
+    """
+    True if serie and vernr identify a verification. Visma payroll exports
+    have #VER "" "" for every verification, so those are never remembered
+    or skipped.
+    """
+    return bool(serie and vernr)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verifications (
+    serie TEXT NOT NULL,
+    vernr TEXT NOT NULL,
+    exported TEXT NOT NULL,
+    PRIMARY KEY (serie, vernr)
+);
+CREATE TABLE IF NOT EXISTS petra_batches (
+    batch TEXT PRIMARY KEY,
+    exported TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    written TEXT NOT NULL
+);
+"""
+
+
+class ExportState:
+    """
+    Exported (serie, vernr) of Visma verifications and Petra batches, as
+    visma_output.batch_key, and the outputs written by watch_folder. The
+    primary keys are the indexes for lookups. Verifications without serie
+    or vernr are not kept, see is_numbered.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_SCHEMA)
+
+    @classmethod
+    def in_directory(cls, directory):
+        """The state kept in a table directory"""
+        return cls(os.path.join(directory, STATE_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
+
+    def exported_verifications(self):
+        """A set of all exported (serie, vernr)"""
+        return {(serie, vernr) for serie, vernr in self.connection.execute(
+            'SELECT serie, vernr FROM verifications') if is_numbered(serie, vernr)}
+
+    def exported_batches(self):
+        """A set of the keys of all exported Petra batches"""
+        return {batch for batch, in self.connection.execute(
+            'SELECT batch FROM petra_batches')}
+
+    def written_outputs(self):
+        """A set of the files watch_folder has written, as batch_convert.path_key"""
+        return {path for path, in self.connection.execute(
+            'SELECT path FROM outputs')}
+
+    def last_verifications(self):
+        """{serie: the highest exported vernr}"""
+        return dict(self.connection.execute(
+            'SELECT serie, MAX(CAST(vernr AS INTEGER)) FROM verifications '
+            'GROUP BY serie ORDER BY serie'))
+
+    def add_verifications(self, verifications):
+        """Remember that the (serie, vernr) pairs have been exported"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO verifications VALUES (?, ?, ?)',
+                ((serie, vernr, now) for serie, vernr in verifications
+                 if is_numbered(serie, vernr)))
+
+    def add_batches(self, batches):
+        """Remember that the Petra batches have been exported"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO petra_batches VALUES (?, ?)',
+                ((batch, now) for batch in batches))
+
+    def add_outputs(self, paths):
+        """Remember that watch_folder has written the files"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO outputs VALUES (?, ?)',
+                ((path, now) for path in paths))
+
+    def clear(self):
+        """
+        Forget everything that has been exported. The outputs written by
+        watch_folder are kept, so that they are still not taken as inputs.
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM verifications')
+            self.connection.execute('DELETE FROM petra_batches')
+
+if __name__ == "__main__":
+    ARGPARSER = argparse.ArgumentParser(
+        description='Visa vad som redan har exporterats')
+    ARGPARSER.add_argument('--tables', default='TABELLER',
+                           help='Directory with the translation tables')
+    ARGPARSER.add_argument('--clear', action='store_true',
+                           help='Forget everything that has been exported, '
+                           'the files written by watch_folder are kept')
+    ARGS = ARGPARSER.parse_args()
+    with ExportState.in_directory(ARGS.tables) as STATE:
+        if ARGS.clear:
+            STATE.clear()
+        for SERIE, VERNR in sorted(STATE.last_verifications().items()):
+            print('Serie {}: senaste verifikation {}'.format(SERIE, VERNR))
+        print('{} verifikationer och {} Petrabatcher exporterade'.format(
+            len(STATE.exported_verifications()), len(STATE.exported_batches())))
@@ -0,0 +1,125 @@
+"""Tests for the incremental conversion state"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import generate_data
+import batch_convert
+from export_state import ExportState
+from sie_parse import SieParser
+from petra_output import PetraOutput
+
+def test_export_state():
+    """Exported keys are kept between sessions, duplicates are ignored"""
+    with TemporaryDirectory() as directory:
+        with ExportState.in_directory(directory) as state:
+            state.add_verifications([('A', '1'), ('A', '12'), ('B', '3')])
+            state.add_verifications([('A', '1')])
+            state.add_batches(['Batch 1'])
+            state.add_outputs(['/out/a.csv'])
+        with ExportState.in_directory(directory) as state:
+            assert state.exported_verifications() == {('A', '1'), ('A', '12'),
+                                                      ('B', '3')}
+            assert state.exported_batches() == {'Batch 1'}
+            assert state.last_verifications() == {'A': 12, 'B': 3}
+            state.clear()
+            assert not state.exported_verifications()
+            assert not state.exported_batches()
+            # What watch_folder has written is still never an input
+            assert state.written_outputs() == {'/out/a.csv'}
+
+def test_parser_skips_verifications():
+    """Skipped verifications are not parsed, the rest are"""
+    with TemporaryDirectory() as directory:
+        siefile = os.path.join(directory, 'test.si')
+        generate_data.write_sie(siefile, 10)
+        parser = SieParser(siefile, skip={('A', str(num)) for num in range(1, 8)})
+        parser.parse()
+        assert [ver.vernr for ver in parser.result.get_data('#VER')] == ['8', '9', '10']
+        assert parser.skipped == 7
+        assert parser.result.get_data('#KONTO')
+
+def test_incremental_batch_convert(capsys):
+    """A second incremental run only converts what is new"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        tables = os.path.join(directory, 'TABELLER')
+        os.mkdir(tables)
+        generate_data.write_tables(tables, chart)
+        first = os.path.join(directory, 'first.si')
+        generate_data.write_sie(first, 10, chart=chart)
+        second = os.path.join(directory, 'second.si')
+        generate_data.write_sie(second, 15, chart=chart)
+        petra = os.path.join(directory, 'petra.csv')
+        generate_data.write_petra(petra, 40, chart=chart)
+
+        args = ['--tables', tables, '--incremental', '--processes', '1']
+        assert batch_convert.main([first, petra] + args) == 0
+        assert batch_convert.main([second] + args) == 0
+        assert '(5 verifikationer' in capsys.readouterr().out
+        with open(os.path.join(directory, 'second.csv')) as converted:
+            assert converted.read().count('\nJ;') == 5
+
+        os.remove(os.path.join(directory, 'petra.SI'))
+        assert batch_convert.main([petra, second] + args + ['--overwrite']) == 0
+        out = capsys.readouterr().out
+        assert 'INGET  ' + petra in out
+        assert 'INGET  ' + second in out
+        with ExportState.in_directory(tables) as state:
+            assert len(state.exported_verifications()) == 15
+            assert state.last_verifications() == {'A': 15}
+            assert len(state.exported_batches()) == 12
+
+        # Batches with the same descriptions but other journals are new
+        generate_data.write_petra(petra, 40, chart=chart, seed=1)
+        assert batch_convert.main([petra] + args + ['--overwrite']) == 0
+        assert '(40 verifikationer' in capsys.readouterr().out
+
+def test_unnumbered_verifications_are_not_skipped():
+    """Payroll files with #VER "" "" are converted every time"""
+    with TemporaryDirectory() as directory:
+        with open('tests/Lön.si', encoding='cp437') as payroll:
+            text = payroll.read()
+        siefile = os.path.join(directory, 'Lön2.si')
+        with open(siefile, 'w', encoding='cp437') as later:
+            later.write(text.replace('20120425', '20120525'))
+        tables = []
+        for name, rows in [('Kto_Acct.csv', ['V_Kto;P_Acct'] + [
+                '{0};{0}'.format(account) for account in
+                ['1930', '2710', '2940', '7010', '7210', '7385', '7399', '7510']]),
+                           ('Re_CC.csv', ['V_Re;P_CC']),
+                           ('Proj_CC.csv', ['V_Proj;P_CC'])]:
+            tables.append(os.path.join(directory, name))
+            with open(tables[-1], 'w') as table:
+                table.write('\n'.join(rows) + '\n')
+
+        with ExportState.in_directory(directory) as state:
+            state.add_verifications([('', ''), ('A', '')])
+            skip = state.exported_verifications()
+        assert not skip
+        parser = SieParser(siefile, skip={('', '')})
+        p_output = PetraOutput(parser.iter_records(), *tables, skip={('', '')})
+        p_output.write_stream(os.path.join(directory, 'Lön2.csv'))
+        assert parser.skipped == 0
+        assert p_output.verification_count == 1
+        assert p_output.exported == []
+
+def test_overlapping_files_in_one_run(capsys):
+    """A verification in two files of the same incremental run is exported once"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        tables = os.path.join(directory, 'TABELLER')
+        os.mkdir(tables)
+        generate_data.write_tables(tables, chart)
+        first = os.path.join(directory, 'first.si')
+        generate_data.write_sie(first, 10, chart=chart)
+        second = os.path.join(directory, 'second.si')
+        generate_data.write_sie(second, 15, chart=chart)
+
+        assert batch_convert.main([first, second, '--tables', tables,
+                                   '--incremental', '--processes', '2']) == 0
+        assert '(5 verifikationer' in capsys.readouterr().out
+        with open(os.path.join(directory, 'second.csv')) as converted:
+            assert converted.read().count('\nJ;') == 5
+        with ExportState.in_directory(tables) as state:
+            assert len(state.exported_verifications()) == 15
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic SIE 4 files, Petra csv files and matching translation
+tables of any size, for benchmarks and tests.
+"""
+
+import os
+import csv
+import random
+import argparse
+from datetime import date, timedelta
+
+# Table files in the table directory, as the GUI expects them
+TABLE_FILES = ['Kto_Acct.csv', 'Re_CC.csv', 'Proj_CC.csv', 'Acct_Kto.csv',
+               'CC_Re_Proj.csv', 'SIE_defaults.csv', 'SIE_dims.csv',
+               'SIE_units.csv']
+
+BANK_ACCOUNT = '1930'
+
+
+class Chart:
+    """Accounts, cost centers and projects with their Petra counterparts"""
+    def __init__(self, accounts=50, cost_centers=20, projects=30, seed=0):
+        rand = random.Random(seed)
+        numbers = rand.sample(range(3000, 9000), accounts - 1)
+        self.accounts = [BANK_ACCOUNT] + [str(n) for n in sorted(numbers)]
+        self.cost_centers = ['K{:04}'.format(n) for n in range(1, cost_centers + 1)]
+        self.projects = ['P-{:08}'.format(n) for n in range(1, projects + 1)]
+        self.petra_account = {a: str(int(a) + 1000) for a in self.accounts}
+        self.petra_cc = {k: '3{:03}'.format(n)
+                         for n, k in enumerate(self.cost_centers, 1)}
+        self.petra_cc.update({p: '4{:03}'.format(n)
+                              for n, p in enumerate(self.projects, 1)})
+
+
+def sie_lines(verifications, trans_per_ver=4, chart=None, year=2017, seed=0):
+    """Yield the lines of a balanced SIE 4 file, dated through year"""
+    # pylint: disable=too-many-locals
+    chart = chart or Chart()
+    rand = random.Random(seed)
+    yield '#FLAGGA 0\n'
+    yield '#PROGRAM "Visma Administration 2000" "2017.1"\n'
+    yield '#FORMAT PC8\n'
+    yield '#GEN {}0101\n'.format(year + 1)
+    yield '#SIETYP 4\n'
+    yield '#FNAMN "Syntetiska bolaget"\n'
+    yield '#ORGNR 555555-5555\n'
+    for account in chart.accounts:
+        yield '#KONTO {} "Konto {}"\n'.format(account, account)
+    for cost_center in chart.cost_centers:
+        yield '#OBJEKT 1 {} "Resultatenhet {}"\n'.format(cost_center, cost_center)
+    for project in chart.projects:
+        yield '#OBJEKT 6 {} "Projekt {}"\n'.format(project, project)
+
+    first = date(year, 1, 1)
+    days = (date(year + 1, 1, 1) - first).days
+    for num in range(1, verifications + 1):
+        verdatum = (first + timedelta(days=(num - 1) * days // verifications))
+        verdatum = verdatum.strftime('%Y%m%d')
+        yield '#VER A {} {} "Verifikation {}" {}\n'.format(num, verdatum, num,
+                                                          verdatum)
+        yield '{\n'
+        total = 0
+        for trans in range(trans_per_ver - 1):
+            account = rand.choice(chart.accounts[1:])
+            objects = []
+            if rand.random() < 0.8:
+                objects += ['1', '"{}"'.format(rand.choice(chart.cost_centers))]
+            if rand.random() < 0.5:
+                objects += ['6', '"{}"'.format(rand.choice(chart.projects))]
+            ore = rand.randint(-500000, 500000) or 100
+            total += ore
+            yield '   #TRANS {} {{{}}} {} {} "Rad {}"\n'.format(
+                account, ' '.join(objects), _amount(ore), verdatum, trans + 1)
+        yield '   #TRANS {} {{}} {}\n'.format(BANK_ACCOUNT, _amount(-total))
+        yield '}\n'
+
+def petra_rows(journals, trans_per_journal=4, chart=None, year=2017, seed=0):
+    """Yield the rows of a Petra csv export with one batch per month"""
+    # pylint: disable=too-many-locals
+    chart = chart or Chart()
+    rand = random.Random(seed)
+    petra_ccs = sorted(set(chart.petra_cc.values()))
+    petra_accounts = [chart.petra_account[a] for a in chart.accounts]
+    yield ['', 'CC', 'Account', 'Narrative', 'Reference', 'Date', 'Dt', 'Ct']
+    month = None
+    first = date(year, 1, 1)
+    days = (date(year + 1, 1, 1) - first).days
+    for num in range(1, journals + 1):
+        day = first + timedelta(days=(num - 1) * days // journals)
+        if day.month != month:
+            month = day.month
+            yield ['B', 'Batch {}-{:02}'.format(year, month), '0',
+                   day.strftime('%d/%m/%Y'), '', '', '', '']
+        datestring = day.strftime('%d/%m/%Y')
+        yield ['J', 'Journal {}'.format(num), 'GL', 'STD', 'SEK', '1',
+               datestring, '']
+        total = 0
+        for trans in range(trans_per_journal):
+            if trans < trans_per_journal - 1:
+                ore = rand.randint(-500000, 500000) or 100
+                account = rand.choice(petra_accounts[1:])
+            else:
+                ore = -total
+                account = petra_accounts[0]
+            total += ore
+            debit = _amount(ore, ',') if ore > 0 else '0'
+            credit = _amount(-ore, ',') if ore < 0 else '0'
+            yield ['T', rand.choice(petra_ccs), account,
+                   'Rad {}'.format(trans + 1), 'Petra {}'.format(num),
+                   datestring, debit, credit]
+
+def _amount(ore, decimal='.'):
+    """Format öre as kronor with two decimals"""
+    sign = '-' if ore < 0 else ''
+    return '{}{}{}{:02}'.format(sign, abs(ore) // 100, decimal, abs(ore) % 100)
+
+def write_sie(filename, verifications, trans_per_ver=4, chart=None, seed=0):
+    """Write a synthetic SIE 4 file"""
+    with open(filename, 'w', encoding='cp437') as siefile:
+        siefile.writelines(sie_lines(verifications, trans_per_ver, chart,
+                                     seed=seed))
+
+def write_petra(filename, journals, trans_per_journal=4, chart=None, seed=0):
+    """Write a synthetic Petra csv export"""
+    with open(filename, 'w', newline='', encoding='latin1') as petrafile:
+        csv.writer(petrafile, delimiter=';').writerows(
+            petra_rows(journals, trans_per_journal, chart, seed=seed))
+
+def write_tables(directory, chart=None):
+    """
+    Write translation tables for chart to directory.
+    Returns the table file names in the order of TABLE_FILES.
+    """
+    chart = chart or Chart()
+    rows = {
+        'Kto_Acct.csv': [['V_Kto', 'P_Acct', 'KONTO', 'KTYP', 'SRU']] + [
+            [a, chart.petra_account[a], 'Konto ' + a, '', ''] for a in chart.accounts],
+        'Re_CC.csv': [['V_Re', 'P_CC', 'Name']] + [
+            [k, chart.petra_cc[k], 'Resultatenhet ' + k] for k in chart.cost_centers],
+        'Proj_CC.csv': [['V_Proj', 'P_CC', 'Name']] + [
+            [p, chart.petra_cc[p], 'Projekt ' + p] for p in chart.projects],
+        'Acct_Kto.csv': [['P_Acct', 'V_Kto']] + [
+            [chart.petra_account[a], a] for a in chart.accounts],
+        'CC_Re_Proj.csv': [['P_CC', 'V_Re', 'V_Proj']] + [
+            [chart.petra_cc[k], k, ''] for k in chart.cost_centers] + [
+            [chart.petra_cc[p], chart.cost_centers[0], p] for p in chart.projects],
+        'SIE_defaults.csv': [['Name', 'Data'], ['FLAGGA', '0'],
+                             ['PROGRAM', 'Petra,1.0'], ['FORMAT', 'PC8'],
+                             ['SIETYP', '4'], ['FNAMN', 'Syntetiska bolaget']],
+        'SIE_dims.csv': [['Dim', 'Name'], ['1', 'Resultatenhet'], ['6', 'Projekt']],
+        'SIE_units.csv': [['Unit', 'Name']],
+    }
+    filenames = []
+    for name in TABLE_FILES:
+        filename = os.path.join(directory, name)
+        with open(filename, 'w', newline='') as table:
+            csv.writer(table, delimiter=';').writerows(rows[name])
+        filenames.append(filename)
+    return filenames
+
+if __name__ == "__main__":
+    ARGPARSER = argparse.ArgumentParser(
+        description='Skapa syntetiska SIE-filer, Petrafiler och tabeller')
+    ARGPARSER.add_argument('directory', help='Where to write the files')
+    ARGPARSER.add_argument('--verifications', type=int, default=10000,
+                           help='Verifications in the SIE file and journals '
+                           'in the Petra file')
+    ARGPARSER.add_argument('--transactions', type=int, default=4,
+                           help='Transactions per verification')
+    ARGPARSER.add_argument('--accounts', type=int, default=50)
+    ARGPARSER.add_argument('--cost-centers', type=int, default=20)
+    ARGPARSER.add_argument('--projects', type=int, default=30)
+    ARGPARSER.add_argument('--seed', type=int, default=0)
+    ARGS = ARGPARSER.parse_args()
+    CHART = Chart(ARGS.accounts, ARGS.cost_centers, ARGS.projects, ARGS.seed)
+    os.makedirs(os.path.join(ARGS.directory, 'TABELLER'), exist_ok=True)
+    write_tables(os.path.join(ARGS.directory, 'TABELLER'), CHART)
+    write_sie(os.path.join(ARGS.directory, 'synthetic.si'), ARGS.verifications,
+              ARGS.transactions, CHART, ARGS.seed)
+    write_petra(os.path.join(ARGS.directory, 'synthetic_petra.csv'),
+                ARGS.verifications, ARGS.transactions, CHART, ARGS.seed)
@@ -0,0 +1,42 @@
+"""Tests for the synthetic data generator"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import generate_data
+from sie_parse import SieParser
+from petra_output import PetraOutput
+from visma_output import PetraParser
+
+def test_generated_data_converts():
+    """Generated files are balanced and fully covered by the tables"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        tables = dict(zip(generate_data.TABLE_FILES,
+                          generate_data.write_tables(directory, chart)))
+        siefile = os.path.join(directory, 'test.si')
+        petrafile = os.path.join(directory, 'test.csv')
+        generate_data.write_sie(siefile, 50, 5, chart)
+        generate_data.write_petra(petrafile, 50, 5, chart)
+
+        parser = SieParser(siefile)
+        parser.parse()
+        verifications = parser.result.get_data('#VER')
+        assert len(verifications) == 50
+        assert all(len(ver.trans_list) == 5 and ver.in_balance()
+                   for ver in verifications)
+        p_output = PetraOutput(parser.result, tables['Kto_Acct.csv'],
+                               tables['Re_CC.csv'], tables['Proj_CC.csv'])
+        p_output.populate_output_table()
+        assert len(p_output.table) == 2 + 50 * 6
+
+        petra_parser = PetraParser(petrafile, *[tables[name] for name in [
+            'Acct_Kto.csv', 'CC_Re_Proj.csv', 'SIE_defaults.csv',
+            'SIE_dims.csv', 'SIE_units.csv', 'Kto_Acct.csv', 'Re_CC.csv',
+            'Proj_CC.csv']])
+        petra_parser.make_sie_data(balances=True)
+        assert petra_parser.sie_data.is_complete()
+        assert petra_parser.sie_data.get_data('#RES')
+        assert not petra_parser.sie_data.get_data('#UB')
+        assert all(ver.in_balance()
+                   for ver in petra_parser.sie_data.get_data('#VER'))
@@ -5,16 +5,16 @@ import platform
 import ctypes
 from pathlib import Path
 from itertools import count
-import difflib
 import PySide
 from PySide.QtCore import *
 from PySide import QtGui
 from PySide.QtGui import *
 from sie_parse import SieParser
-from accounting_data import SieIO
+from accounting_data import SieIO, ConversionCancelled, NothingToExport
 from petra_output import PetraOutput
-from csv_dict import CSVKeyMissing
+from csv_dict import CSVDict, CSVKeyMissing
 from visma_output import PetraParser
+from petra_diff import diff_files
 import signal
 import time
 import io
@@ -175,15 +175,60 @@ class VismaPetraControls(QtGui.QWidget):
             return False
 
 
+    def runInBackground(self, text, task, onSuccess, onError=None):
+        """
+        Run task(progress) in a ConversionWorker while a progress dialog with
+        a cancel button is shown. onSuccess gets the result of task.
+        onError gets any exception and returns True if it was handled.
+        """
+        self.progressDialog = QProgressDialog(text, "Avbryt", 0, 0, self)
+        self.progressDialog.setWindowModality(Qt.WindowModal)
+        self.progressDialog.setMinimumDuration(0)
+        self.worker = ConversionWorker(task, self)
+        self.progressDialog.canceled.connect(self.worker.cancel)
+        self.worker.progressed.connect(self.showProgress)
+        self.workerSuccess = onSuccess
+        self.workerError = onError
+        self.worker.succeeded.connect(self.backgroundDone)
+        self.worker.failed.connect(self.backgroundFailed)
+        self.worker.start()
+
+    def showProgress(self, done, total):
+        """Update the progress dialog, total is 0 if it is unknown"""
+        self.progressDialog.setMaximum(total)
+        if total:
+            self.progressDialog.setValue(done)
+        self.progressDialog.setLabelText("{} bearbetade".format(done))
+
+    def backgroundDone(self, result):
+        self.progressDialog.reset()
+        self.workerSuccess(result)
+
+    def backgroundFailed(self, error):
+        self.progressDialog.reset()
+        if isinstance(error, ConversionCancelled):
+            self.showMessage("Avbrutet")
+        elif isinstance(error, NothingToExport):
+            self.showMessage(str(error))
+        elif not (self.workerError and self.workerError(error)):
+            excepthook(type(error), error, error.__traceback__)
+
     def openSIE(self):
         siefile, _ = QtGui.QFileDialog.getOpenFileName(self, "Öppna sie-fil",
                             '', 'SIE (*.si *.sie);;Alla filer (*.*)')
         if siefile:
             self.siefilename = siefile
-            parser = SieParser(siefile)
-            parser.parse()
-            self.siedata = parser.result
-            self.writePetraButton.setEnabled(True)
+            def parse(progress):
+                parser = SieParser(siefile)
+                parser.parse(progress)
+                return parser
+            self.runInBackground("Läser " + siefile, parse, self.sieOpened)
+
+    def sieOpened(self, parser):
+        self.siedata = parser.result
+        if parser.checksum_error:
+            self.showMessage(parser.checksum_error, "Varning")
+        self.writePetraButton.setEnabled(True)
 
     def writeCSV(self):
         siepath = Path(self.siefilename).resolve()
@@ -196,38 +241,62 @@ class VismaPetraControls(QtGui.QWidget):
 
         self.csvfilename, _ = QtGui.QFileDialog.getSaveFileName(self,
                                 "Spara csv som...", str(csvfile))
-        retry = True
-        while self.csvfilename and retry:
-            p_output = PetraOutput(self.siedata, self.kto_acct_file,
-                    self.re_cc_file, self.proj_cc_file)
-            try:
-                p_output.populate_output_table()
-                p_output.write_output(self.csvfilename, True)
-                self.showMessage("CSV sparad till " + self.csvfilename)
-                self.diffButton.setEnabled(True)
-                retry = False
-            except CSVKeyMissing as csverr:
-                retry = self.complement_csv(csverr)
-
-    def complement_csv(self, csverr):
+        if not self.csvfilename:
+            return
+        self.p_output = PetraOutput(self.siedata, self.kto_acct_file,
+                self.re_cc_file, self.proj_cc_file)
+        self.convertCSV()
+
+    def convertCSV(self):
+        def convert(progress):
+            self.p_output.write_stream(self.csvfilename, True,
+                                       collect_missing=True, progress=progress)
+        self.runInBackground("Skriver " + self.csvfilename, convert,
+                             self.csvWritten, self.retryAfterMissing(self.convertCSV))
+
+    def csvWritten(self, _):
+        self.showMessage("CSV sparad till " + self.csvfilename)
+        self.diffButton.setEnabled(True)
+
+    def retryAfterMissing(self, retry):
         """
-        Given a CSVKeyMissing exception, prompt the user to add missing data.
+        Make an error handler that asks for missing keys and then calls retry.
         """
-        values, ok = QMultiInputDialog.getInputs(title='Ange saknad information',
-            text=self.sie_info(csverr),
-            fields=csverr.csv_dict.fields,
-            values={csverr.csv_dict.fields[0]: csverr.key})
-        if ok and values:
-            csverr.csv_dict[csverr.key] = values
+        def handleError(error):
+            if not isinstance(error, CSVKeyMissing):
+                return False
+            if self.complement_csv(error):
+                retry()
             return True
-        else:
-            return False
+        return handleError
 
-    def sie_info(self, csverr):
+    def complement_csv(self, csverr):
+        """
+        Given a CSVKeyMissing or CSVKeysMissing exception, prompt the user to
+        add all missing data. Returns False if the user cancels, and then
+        nothing is added. Each table is written once, after the last answer.
+        """
+        answers = []
+        for csv_dict, keys in csverr.missing:
+            added = {}
+            for key in keys:
+                values, ok = QMultiInputDialog.getInputs(
+                    title='Ange saknad information',
+                    text=self.sie_info(csv_dict, key),
+                    fields=csv_dict.fields,
+                    values={csv_dict.fields[0]: key})
+                if not (ok and values):
+                    return False
+                added[key] = values
+            answers.append((csv_dict, added))
+        for csv_dict, added in answers:
+            csv_dict.update_many(added)
+        return True
+
+    def sie_info(self, csv_dict, key):
         """Get info about an account, project or cc with id :key"""
-        csvfile = csverr.csv_dict.csv_filename
-        key = csverr.key
-        field = csverr.csv_dict.fields[0]
+        csvfile = csv_dict.csv_filename
+        field = csv_dict.fields[0]
         program = "Visma" if field[0] == 'P' else "Petra"
         return "Index {} saknas i {}. Ange motsvarighet i {}.".format(
                 key, csvfile, program)
@@ -235,16 +304,14 @@ class VismaPetraControls(QtGui.QWidget):
     def diffCSV(self):
         othercsv, _ = QtGui.QFileDialog.getOpenFileName(self, "Välj csv-fil att jämföra med",
                 '', 'CSV (*.csv);;Alla filer (*.*)')
-        with open(self.csvfilename) as csv1, open(othercsv, encoding='cp1252') as csv2:
-            differ = difflib.HtmlDiff()
-            csv1_lines = [l.strip() for l in csv1.readlines()
-                    if l.strip() and l.strip() != ';;;;;;;']
-            csv2_lines = [l.strip() for l in csv2.readlines()
-                    if l.strip() and l.strip() != ';;;;;;;']
-            diff = differ.make_file(csv1_lines, csv2_lines)
-        if diff:
+        if not othercsv:
+            return
+        diff = diff_files(self.csvfilename, othercsv, 'utf_8', 'cp1252')
+        if not diff:
+            self.showMessage("Filerna innehåller samma verifikationer")
+        else:
             self.textWidget = QtGui.QTextBrowser()
-            self.textWidget.setHtml(diff)
+            self.textWidget.setHtml(diff.to_html())
             self.textWidget.resize(700, 500)
             self.textWidget.setWindowTitle("Skillnad mellan program och excel")
             self.textWidget.show()
@@ -253,31 +320,76 @@ class VismaPetraControls(QtGui.QWidget):
         self.petrafile, _ = QtGui.QFileDialog.getOpenFileName(self, "Öppna petra-fil",
                 '', 'CSV (*.csv *.txt);;Alla filer (*.*)')
         if self.petrafile:
-            self.petra_parser = PetraParser(
+            def read(_):
+                return PetraParser(
                     self.petrafile, self.acct_kto_file, self.cc_re_proj_file,
                     self.sie_defaults_file, self.sie_dims_file, self.sie_units_file,
                     self.kto_acct_file, self.re_cc_file, self.proj_cc_file)
-            self.writeVismaButton.setEnabled(True)
+            self.runInBackground("Läser " + self.petrafile, read,
+                                 self.petraOpened)
+
+    def petraOpened(self, petra_parser):
+        self.petra_parser = petra_parser
+        self.writeVismaButton.setEnabled(True)
 
     def writeSIE(self):
         csvpath = Path(self.petrafile).resolve()
         siename = csvpath.with_suffix('.SI').name
         siefile = Path('.').resolve() / siename
 
-        siefilename, _ = QtGui.QFileDialog.getSaveFileName(self,
+        self.siefilename_out, _ = QtGui.QFileDialog.getSaveFileName(self,
                                 "Spara SI som...", str(siefile))
-        retry = True
-        while siefilename and retry:
-            try:
-                self.petra_parser.make_sie_data()
-                if not self.petra_parser.sie_data.is_complete():
-                    self.showMessage("Något saknas i SIE-filen")
-                else:
-                    SieIO.writeSie(self.petra_parser.sie_data, siefilename, True)
-                    self.showMessage("SI sparad till " + siefilename)
-                retry = False
-            except CSVKeyMissing as csverr:
-                retry = self.complement_csv(csverr)
+        if self.siefilename_out:
+            self.convertSIE()
+
+    def convertSIE(self):
+        def convert(progress):
+            self.petra_parser.make_sie_data(collect_missing=True,
+                                            progress=progress)
+            if not self.petra_parser.sie_data.is_complete():
+                return False
+            SieIO.writeSie(self.petra_parser.sie_data, self.siefilename_out, True)
+            return True
+        self.runInBackground("Skriver " + self.siefilename_out, convert,
+                             self.sieWritten, self.retryAfterMissing(self.convertSIE))
+
+    def sieWritten(self, complete):
+        if complete:
+            self.showMessage("SI sparad till " + self.siefilename_out)
+        else:
+            self.showMessage("Något saknas i SIE-filen")
+
+
+class ConversionWorker(QThread):
+    """
+    Runs task(progress) in a separate thread. progress(done, total) is
+    forwarded through the progressed signal and raises ConversionCancelled
+    once cancel has been called.
+    """
+    progressed = Signal(int, int)
+    succeeded = Signal(object)
+    failed = Signal(object)
+
+    def __init__(self, task, parent=None):
+        super().__init__(parent)
+        self.task = task
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, done, total=None):
+        if self.cancelled:
+            raise ConversionCancelled()
+        self.progressed.emit(done, total or 0)
+
+    def run(self):
+        try:
+            result = self.task(self.progress)
+        except Exception as error:
+            self.failed.emit(error)
+        else:
+            self.succeeded.emit(result)
 
 
 class QMultiInputDialog(QDialog):
@@ -321,6 +433,8 @@ class QMultiInputDialog(QDialog):
         return (values, result == QDialog.Accepted)
 
 def main():
+    # Keep parsed translation tables next to the csv files between runs
+    CSVDict.use_cache = True
     # Create a Qt application
     app = QApplication(sys.argv)
     # Create main window
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Compare two Petra csv files in the B/J/T layout written by PetraOutput.
+Journals are matched on their reference ("Visma Ver A170071") and
+transactions within a journal on (CC, Account, Dt/Ct), so the comparison is
+close to linear in the number of rows.
+"""
+
+import sys
+import csv
+import argparse
+import html
+from collections import defaultdict
+
+from accounting_data import parse_ore
+
+
+def _ore(amount):
+    """Parse a Petra amount like '1 234,5' to öre, None if it is not a number"""
+    amount = amount.replace(' ', '').replace('\xa0', '').replace(',', '.')
+    if not amount:
+        return 0
+    try:
+        return parse_ore(amount)
+    except ValueError:
+        return None
+
+def _journal_ref(journal_row):
+    """The reference of a J row, its text up to ' - '"""
+    return journal_row[1].split(' - ')[0]
+
+def _trans_key(row):
+    """(CC, Account, 'Dt' or 'Ct') for a T row"""
+    side = 'Ct' if _ore(row[7]) else 'Dt'
+    return (row[1], row[2], side)
+
+def _trans_value(row):
+    """What has to be equal for two matched T rows: amount and narrative"""
+    return (_ore(row[6]), _ore(row[7]), row[3])
+
+
+class PetraFile:
+    """The batch row and the journals of a Petra csv file, keyed on reference"""
+    def __init__(self, filename, encoding='utf_8'):
+        self.filename = filename
+        self.batch = None
+        # ref -> (J row, {(CC, Account, Dt/Ct): [T rows]})
+        self.journals = {}
+        with open(filename, newline='', encoding=encoding) as csv_file:
+            transactions = None
+            for row in csv.reader(csv_file, delimiter=';'):
+                row = row + [''] * (8 - len(row))
+                if row[0] == 'B':
+                    self.batch = row
+                elif row[0] == 'J':
+                    ref = _journal_ref(row)
+                    if ref in self.journals:
+                        transactions = self.journals[ref][1]
+                    else:
+                        transactions = defaultdict(list)
+                        self.journals[ref] = (row, transactions)
+                elif row[0] == 'T' and transactions is not None:
+                    transactions[_trans_key(row)].append(row)
+
+
+class PetraDiff:
+    """
+    Differences between two Petra files. added and removed hold (ref, row)
+    tuples, changed holds (ref, old row, new row) tuples. Rows of journals
+    that only exist in one of the files are all added or removed.
+    """
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self._compare()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def _compare(self):
+        if self.old.batch != self.new.batch:
+            self.changed.append(('B', self.old.batch, self.new.batch))
+        for ref, (old_journal, old_trans) in self.old.journals.items():
+            if ref not in self.new.journals:
+                self.removed.append((ref, old_journal))
+                self.removed.extend((ref, row) for rows in old_trans.values()
+                                    for row in rows)
+                continue
+            new_journal, new_trans = self.new.journals[ref]
+            if old_journal != new_journal:
+                self.changed.append((ref, old_journal, new_journal))
+            for key in list(old_trans) + [k for k in new_trans if k not in old_trans]:
+                self._compare_rows(ref, old_trans.get(key, []),
+                                   new_trans.get(key, []))
+        for ref, (new_journal, new_trans) in self.new.journals.items():
+            if ref not in self.old.journals:
+                self.added.append((ref, new_journal))
+                self.added.extend((ref, row) for rows in new_trans.values()
+                                  for row in rows)
+
+    def _compare_rows(self, ref, old_rows, new_rows):
+        """Match T rows with the same key, equal rows first"""
+        unmatched = defaultdict(list)
+        for row in new_rows:
+            unmatched[_trans_value(row)].append(row)
+        old_left = []
+        for row in old_rows:
+            equal = unmatched.get(_trans_value(row))
+            if equal:
+                equal.pop()
+            else:
+                old_left.append(row)
+        new_left = [row for rows in unmatched.values() for row in rows]
+        for old_row, new_row in zip(old_left, new_left):
+            self.changed.append((ref, old_row, new_row))
+        self.removed.extend((ref, row) for row in old_left[len(new_left):])
+        self.added.extend((ref, row) for row in new_left[len(old_left):])
+
+    def lines(self):
+        """The differences as text lines"""
+        for ref, row in self.removed:
+            yield '- {}: {}'.format(ref, ';'.join(row))
+        for ref, row in self.added:
+            yield '+ {}: {}'.format(ref, ';'.join(row))
+        for ref, old_row, new_row in self.changed:
+            yield '! {}: {}'.format(ref, ';'.join(old_row or []))
+            yield '  {}  {}'.format(' ' * len(ref), ';'.join(new_row or []))
+
+    def to_html(self):
+        """The differences as an html table"""
+        def cells(row):
+            return ''.join('<td>{}</td>'.format(html.escape(field))
+                           for field in (row or []))
+        res = ['<html><body><p>- {}<br>+ {}</p>'.format(
+            html.escape(self.old.filename), html.escape(self.new.filename))]
+        res.append('<table border="1" cellspacing="0">')
+        for ref, row in self.removed:
+            res.append('<tr bgcolor="#ffaaaa"><td>-</td><td>{}</td>{}</tr>'.format(
+                html.escape(ref), cells(row)))
+        for ref, row in self.added:
+            res.append('<tr bgcolor="#aaffaa"><td>+</td><td>{}</td>{}</tr>'.format(
+                html.escape(ref), cells(row)))
+        for ref, old_row, new_row in self.changed:
+            res.append('<tr bgcolor="#ffff77"><td>!</td><td>{}</td>{}</tr>'.format(
+                html.escape(ref), cells(old_row)))
+            res.append('<tr bgcolor="#ffff77"><td></td><td></td>{}</tr>'.format(
+                cells(new_row)))
+        res.append('</table></body></html>')
+        return '\n'.join(res)
+
+def diff_files(old_filename, new_filename, old_encoding='utf_8',
+               new_encoding='utf_8'):
+    """Compare two Petra csv files, return a PetraDiff"""
+    return PetraDiff(PetraFile(old_filename, old_encoding),
+                     PetraFile(new_filename, new_encoding))
+
+if __name__ == "__main__":
+    ARGPARSER = argparse.ArgumentParser(
+        description='Jämför två csv-filer för import till Petra')
+    ARGPARSER.add_argument('old', help='The first csv file')
+    ARGPARSER.add_argument('new', help='The second csv file')
+    ARGPARSER.add_argument('--old-encoding', default='utf_8')
+    ARGPARSER.add_argument('--new-encoding', default='cp1252')
+    ARGPARSER.add_argument('--html', action='store_true',
+                           help='Print an html table instead of text')
+    ARGS = ARGPARSER.parse_args()
+    DIFF = diff_files(ARGS.old, ARGS.new, ARGS.old_encoding, ARGS.new_encoding)
+    if ARGS.html:
+        print(DIFF.to_html())
+    else:
+        for LINE in DIFF.lines():
+            print(LINE)
+    sys.exit(1 if DIFF else 0)
@@ -0,0 +1,47 @@
+"""Tests for the Petra csv diff"""
+
+from tempfile import NamedTemporaryFile
+
+from petra_diff import diff_files
+
+OLD = """;CC;Account;Narrative;Reference;Date;Dt;Ct
+B;Imported from Visma 2017-01;150;31/01/2017;;;;
+J;Visma Ver A1 - Första;GL;STD;SEK;1;05/01/2017;
+T;3200;1000;Första;Visma Ver A1;05/01/2017;0;100
+T;3200;4000;Första;Visma Ver A1;05/01/2017;100;0
+J;Visma Ver A2 - Andra;GL;STD;SEK;1;06/01/2017;
+T;3200;1000;Andra;Visma Ver A2;06/01/2017;0;50
+T;3200;4000;Andra;Visma Ver A2;06/01/2017;50;0
+;;;;;;;
+"""
+
+NEW = """;CC;Account;Narrative;Reference;Date;Dt;Ct
+B;Imported from Visma 2017-01;150;31/01/2017;;;;
+J;Visma Ver A2 - Andra;GL;STD;SEK;1;06/01/2017;
+T;3200;4000;Andra;Visma Ver A2;06/01/2017;50,00;0
+T;3200;1000;Andra;Visma Ver A2;06/01/2017;0;40
+T;3200;1100;Andra;Visma Ver A2;06/01/2017;0;10
+J;Visma Ver A3 - Tredje;GL;STD;SEK;1;07/01/2017;
+T;3200;1000;Tredje;Visma Ver A3;07/01/2017;0;5
+"""
+
+def _csv(content):
+    csv_file = NamedTemporaryFile('w', suffix='.csv', encoding='utf_8')
+    csv_file.write(content)
+    csv_file.flush()
+    return csv_file
+
+def test_diff():
+    """Journals are matched by reference and rows by CC, account and side"""
+    with _csv(OLD) as old, _csv(NEW) as new:
+        assert not diff_files(old.name, old.name)
+        diff = diff_files(old.name, new.name)
+        assert [(ref, row[0]) for ref, row in diff.removed] == [
+            ('Visma Ver A1', 'J'), ('Visma Ver A1', 'T'), ('Visma Ver A1', 'T')]
+        assert [(ref, row[2]) for ref, row in diff.added] == [
+            ('Visma Ver A2', '1100'), ('Visma Ver A3', 'GL'),
+            ('Visma Ver A3', '1000')]
+        assert [(ref, old[7], new[7]) for ref, old, new in diff.changed] == [
+            ('Visma Ver A2', '50', '40')]
+        assert '+ Visma Ver A3' in '\n'.join(diff.lines())
+        assert '<td>Tredje</td>' in diff.to_html()
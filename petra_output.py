@@ -2,10 +2,14 @@
 """Output a CSV file that can be imported to Petra"""
 
 import os
-import sys
 import calendar
 import csv
-from csv_dict import CSVDict, CSVKeyMissing
+import shutil
+import tempfile
+from accounting_data import SieData, NothingToExport, PROGRESS_INTERVAL, _format_ore
+from csv_dict import MissingKeys, open_table
+from export_state import is_numbered
+import stats
 
 def split_csv(table_file='Tabell.csv'):
     """Split account, cost center and project into three tables"""
@@ -56,43 +60,77 @@ def _parse_trans_objects(trans):
             project = obj
     return (cost_center, project)
 
+HEADER = ['', 'CC', 'Account', 'Narrative', 'Reference', 'Date', 'Dt', 'Ct']
+
+# Buffer size for write_stream
+WRITE_BUFFER = 1 << 16
+
+
 class PetraOutput:
-    """Form an output file based on an SieData object and translation table"""
+    """
+    Form an output file based on Sie data and translation tables.
+    sie_data is a SieData or a stream of records from SieParser.iter_records(),
+    in which case each verification is translated as soon as it is read.
+    The tables are file names or already loaded CSVDicts.
+    Verifications with (serie, vernr) in skip are left out, see ExportState.
+    The (serie, vernr) of the verifications that are translated are listed in
+    exported, except for those without serie or vernr, see is_numbered.
+    """
     def __init__(self, sie_data, account_file, cost_center_file, project_file,
-                 default_petra_cc='3200'):
+                 default_petra_cc='3200', skip=None):
+        # pylint: disable=too-many-arguments
         self.sie_data = sie_data
         self.default_petra_cc = default_petra_cc
+        self.skip = skip
+        self.exported = []
 
         # self.parse_tables(account_file, cost_center_file, project_file)
-        self.account = CSVDict(account_file)
-        self.cost_center = CSVDict(cost_center_file)
-        self.project = CSVDict(project_file)
+        self.account = open_table(account_file)
+        self.cost_center = open_table(cost_center_file)
+        self.project = open_table(project_file)
 
         self.table = []
         self.ver_month = None
+        self.missing = None
+        self.verification_count = 0
+        self._start_batch()
 
-    def populate_output_table(self):
-        # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-        # pylint: disable=invalid-name
-        """Extract interesting informatin from the Sie data and form output"""
-        header = ['', 'CC', 'Account', 'Narrative', 'Reference', 'Date', 'Dt',
-                  'Ct']
-        self.table.append(header)
-
-        program = self.sie_data.get_data('#PROGRAM')[0].data[0].split()[0]
-        verifications = self.sie_data.get_data('#VER')
-        ver_date = next(v.verdatum for v in verifications if v.verdatum.has_date)
-        self.ver_month = ver_date.format("%Y-%m")
-        description = "Imported from {} {}".format(program, self.ver_month)
-        checksum = format(sum(ver.sum_debit() for ver in verifications),
-                '.2f').rstrip('0').rstrip('.').replace('.',',')
-        day = calendar.monthrange(ver_date.year, ver_date.month)[1]
-        last_date_month = "{}/{:02}/{}".format(day, ver_date.month, ver_date.year)
+    @stats.timed('PetraOutput.populate_output_table')
+    def populate_output_table(self, collect_missing=False, progress=None):
+        """
+        Extract interesting informatin from the Sie data and form output.
+        The whole table is kept in self.table, see write_stream for writing
+        without it.
+        If collect_missing is True, translation continues past missing keys
+        and a CSVKeysMissing with all of them is raised at the end, instead of
+        a CSVKeyMissing for the first one.
+        progress(verifications, total) is called every PROGRESS_INTERVAL
+        verifications, total is None for a stream. It may raise
+        ConversionCancelled to stop.
+        """
+        rows = list(self.iter_rows(collect_missing, progress))
+        self.table = [HEADER, self._batch_row()] + rows
 
-        self.table.append(['B', description, checksum, last_date_month, '', '', '',
-                           ''])
-
-        for ver in verifications:
+    def iter_rows(self, collect_missing=False, progress=None):
+        # pylint: disable=too-many-locals,invalid-name
+        """
+        Translate one verification at a time and yield its J and T rows.
+        The B row is known when all rows have been yielded, see _batch_row.
+        collect_missing and progress as for populate_output_table.
+        """
+        self.missing = MissingKeys() if collect_missing else None
+        self._start_batch()
+        self.exported = []
+        count = 0
+        total = (len(self.sie_data.get_data('#VER'))
+                 if isinstance(self.sie_data, SieData) else None)
+        for record in self._records():
+            if not self._add_to_batch(record):
+                continue
+            ver = record
+            count += 1
+            if progress is not None and not count % PROGRESS_INTERVAL:
+                progress(count, total)
             if not ver.in_balance():
                 raise Exception('Inte i balans:', ver)
             """
@@ -109,10 +147,12 @@ class PetraOutput:
             if ver.serie == 'C' and ver.vernr == '170067':
                 print(ver)
             """
+            if is_numbered(ver.serie, ver.vernr):
+                self.exported.append((ver.serie, ver.vernr))
             ref = "Visma Ver {}{}".format(ver.serie, ver.vernr)
             text = "{} - {}".format(ref, ver.vertext)
             date = ver.verdatum.format("%d/%m/%Y")
-            self.table.append(['J', text, 'GL', 'STD', 'SEK', '1', date, ''])
+            yield ['J', text, 'GL', 'STD', 'SEK', '1', date, '']
 
             narr = ver.vertext # Default
 
@@ -122,10 +162,11 @@ class PetraOutput:
                     if not visma_cc: # Use default
                         cc = self.default_petra_cc
                     else:
-                        cc = self.cost_center[str(visma_cc)]['P_CC']
+                        cc = self.cost_center.lookup(str(visma_cc), 'P_CC',
+                                                     self.missing)
                 else:
-                    cc = self.project[str(visma_proj)]['P_CC']
-                acct = self.account[str(trans.kontonr)]['P_Acct']
+                    cc = self.project.lookup(str(visma_proj), 'P_CC', self.missing)
+                acct = self.account.lookup(str(trans.kontonr), 'P_Acct', self.missing)
                 if trans.transtext and trans.kvantitet:
                     kvantitet = format(trans.kvantitet,
                             '.2f').rstrip('0').rstrip('.').replace('.',',')
@@ -134,12 +175,105 @@ class PetraOutput:
                     narr = trans.transtext
                 dt = trans.debit
                 ct = trans.credit
-                self.table.append(['T', cc, acct, narr, ref, date, dt, ct])
+                yield ['T', cc, acct, narr, ref, date, dt, ct]
+
+        if self.missing:
+            self.missing.raise_if_missing()
+        self.verification_count = count
+        stats.count('Verifications translated', count)
+
+    def _start_batch(self):
+        self._program = None
+        self._ver_date = None
+        self._ver_count = 0
+        self._total_debit_ore = 0
+
+    def _add_to_batch(self, record):
+        """Note what the B row needs from record, True if it is a #VER"""
+        if record.name == '#PROGRAM':
+            self._program = self._program or record.data[0].split()[0]
+        elif record.name == '#VER':
+            if (self.skip is not None and is_numbered(record.serie, record.vernr)
+                    and (record.serie, record.vernr) in self.skip):
+                return False
+            if self._ver_date is None and record.verdatum.has_date:
+                self._ver_date = record.verdatum
+            self._ver_count += 1
+            self._total_debit_ore += record.debet_ore
+            return True
+        return False
+
+    def _batch_row(self):
+        """The B row for the records noted by _add_to_batch, sets ver_month"""
+        if not self._ver_count:
+            raise NothingToExport("Inga verifikationer att exportera")
+        ver_date = self._ver_date
+        self.ver_month = ver_date.format("%Y-%m")
+        description = "Imported from {} {}".format(self._program, self.ver_month)
+        checksum = _format_ore(self._total_debit_ore).replace('.', ',')
+        day = calendar.monthrange(ver_date.year, ver_date.month)[1]
+        last_date_month = "{}/{:02}/{}".format(day, ver_date.month, ver_date.year)
+        return ['B', description, checksum, last_date_month, '', '', '', '']
+
+    @stats.timed('PetraOutput.write_stream')
+    def write_stream(self, filename, overwrite=False, collect_missing=False,
+                     progress=None):
+        """
+        Translate and write the csv without keeping the table, so memory is
+        bounded by one verification. collect_missing and progress as for
+        populate_output_table.
+        The B row comes before the verifications but needs all of them. For a
+        SieData it is made in a first pass that only adds up the debit total
+        of each verification. A stream can only be read once, so its J and T
+        rows are spooled to a temporary file that is copied after the B row.
+        The csv is written to a temporary file that replaces filename when
+        everything has been translated.
+        """
+        if not overwrite and os.path.exists(filename):
+            raise Exception("Kan inte skriva " + filename + ", filen finns redan.")
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'w', newline='', encoding='utf_8',
+                      buffering=WRITE_BUFFER) as csvfile:
+                csvwriter = csv.writer(csvfile, delimiter=';')
+                csvwriter.writerow(HEADER)
+                if isinstance(self.sie_data, SieData):
+                    self._start_batch()
+                    for record in self._records():
+                        self._add_to_batch(record)
+                    csvwriter.writerow(self._batch_row())
+                    csvwriter.writerows(self.iter_rows(collect_missing, progress))
+                else:
+                    with tempfile.TemporaryFile('w+', newline='', encoding='utf_8',
+                                                buffering=WRITE_BUFFER) as spool:
+                        csv.writer(spool, delimiter=';').writerows(
+                            self.iter_rows(collect_missing, progress))
+                        csvwriter.writerow(self._batch_row())
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, csvfile, WRITE_BUFFER)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+        if stats.enabled:
+            stats.count('Petra bytes written', os.path.getsize(filename))
+
+    def _records(self):
+        """The #PROGRAM and #VER records, from a SieData or a record stream"""
+        if isinstance(self.sie_data, SieData):
+            yield from self.sie_data.get_data('#PROGRAM')
+            yield from self.sie_data.get_data('#VER')
+        else:
+            yield from self.sie_data
 
     def print_output(self):
         """Print csv output to stdout"""
         print("\n".join(','.join(str(r) for r in row) for row in self.table))
 
+    @stats.timed('PetraOutput.write_output')
     def  write_output(self, filename=None, overwrite=False):
         """Write csv to file, abort if it already exists"""
         writemode = 'w' if overwrite else 'x'
@@ -151,9 +285,12 @@ class PetraOutput:
                     with open(filename, writemode, newline='', encoding=encoding) as csvfile:
                         csvwriter = csv.writer(csvfile, delimiter=';')
                         csvwriter.writerows(self.table)
+                    if stats.enabled:
+                        stats.count('Petra rows written', len(self.table))
+                        stats.count('Petra bytes written', os.path.getsize(filename))
                     # print("Encoding with ", encoding, "successful!")
                 except UnicodeEncodeError as err:
                     print("Encoding failed: ", err)
                     os.remove(filename)
         except FileExistsError:
-            sys.exit("Kan inte skriva " + filename + ", filen finns redan.")
+            raise Exception("Kan inte skriva " + filename + ", filen finns redan.")
@@ -0,0 +1,100 @@
+"""Tests for PetraOutput"""
+
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+import pytest
+
+from sie_parse import SieParser
+from petra_output import PetraOutput
+from csv_dict import CSVKeyMissing, CSVKeysMissing
+
+ACCOUNTS = ['1930', '2710', '2940', '7010', '7210', '7385', '7399', '7510']
+
+def _write_tables(directory, accounts=ACCOUNTS):
+    """Write translation tables covering tests/testfile.si"""
+    tables = Path(directory)
+    with open(str(tables / 'Kto_Acct.csv'), 'w') as table:
+        table.write('V_Kto;P_Acct\n')
+        for account in accounts:
+            table.write('{};{}\n'.format(account, '9' + account))
+    for name in ['Re_CC.csv', 'Proj_CC.csv']:
+        with open(str(tables / name), 'w') as table:
+            table.write('V_Obj;P_CC\n')
+    return [str(tables / name) for name in
+            ['Kto_Acct.csv', 'Re_CC.csv', 'Proj_CC.csv']]
+
+def test_stream_and_sie_data_give_same_table():
+    """Translating a record stream gives the same table as a parsed SieData"""
+    with TemporaryDirectory() as tabledir:
+        tables = _write_tables(tabledir)
+        parser = SieParser('tests/testfile.si')
+        parser.parse()
+        from_data = PetraOutput(parser.result, *tables)
+        from_data.populate_output_table()
+        from_stream = PetraOutput(SieParser('tests/testfile.si').iter_records(),
+                                  *tables)
+        from_stream.populate_output_table()
+
+        assert from_stream.table == from_data.table
+        assert from_data.table[1] == ['B', 'Imported from Visma 2012-04',
+                                      '63157,82', '30/04/2012', '', '', '', '']
+        assert from_data.table[3] == ['T', '3200', '91930', 'Lönekörning: '
+                                      '2012-04-25 - Ordinarie lön', 'Visma Ver ',
+                                      '25/04/2012', '0', '32934']
+
+def test_collect_missing_keys():
+    """All missing accounts are reported at once, and only once each"""
+    with TemporaryDirectory() as tabledir:
+        tables = _write_tables(tabledir, ACCOUNTS[2:])
+        parser = SieParser('tests/testfile.si')
+        parser.parse()
+        p_output = PetraOutput(parser.result, *tables)
+        with pytest.raises(CSVKeyMissing) as first_error:
+            p_output.populate_output_table()
+        assert first_error.value.key == '1930'
+
+        with pytest.raises(CSVKeysMissing) as all_errors:
+            p_output.populate_output_table(collect_missing=True)
+        assert [(d.csv_filename, keys) for d, keys in all_errors.value.missing] == [
+            (tables[0], ['1930', '2710'])]
+
+        for csv_dict, keys in all_errors.value.missing:
+            for key in keys:
+                csv_dict[key] = {'P_Acct': '9' + key}
+        p_output.populate_output_table(collect_missing=True)
+        assert len(p_output.table) == 11
+
+def test_write_stream():
+    """write_stream writes the same file as write_output, or nothing on errors"""
+    with TemporaryDirectory() as tabledir:
+        tables = _write_tables(tabledir)
+        parser = SieParser('tests/testfile.si')
+        parser.parse()
+        table = Path(tabledir) / 'table.csv'
+        p_output = PetraOutput(parser.result, *tables)
+        p_output.populate_output_table()
+        p_output.write_output(str(table))
+        expected = table.read_bytes()
+
+        from_data = Path(tabledir) / 'from_data.csv'
+        PetraOutput(parser.result, *tables).write_stream(str(from_data))
+        assert from_data.read_bytes() == expected
+        from_stream = Path(tabledir) / 'from_stream.csv'
+        p_output = PetraOutput(SieParser('tests/testfile.si').iter_records(), *tables)
+        p_output.write_stream(str(from_stream))
+        assert from_stream.read_bytes() == expected
+        assert p_output.verification_count == 1
+        assert p_output.table == []
+
+        tables = _write_tables(tabledir, ACCOUNTS[2:])
+        with pytest.raises(CSVKeysMissing):
+            PetraOutput(parser.result, *tables).write_stream(
+                str(from_data), True, collect_missing=True)
+        assert from_data.read_bytes() == expected
+        assert sorted(p.name for p in Path(tabledir).glob('*.tmp')) == []
+
+        with pytest.raises(Exception, match='filen finns redan'):
+            PetraOutput(parser.result, *tables).write_stream(str(from_data))
+        with pytest.raises(Exception, match='filen finns redan'):
+            p_output.write_output(str(table))
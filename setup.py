@@ -4,7 +4,7 @@ from cx_Freeze import setup, Executable
 # Dependencies are automatically detected, but it might need
 # fine tuning.
 buildOptions = dict(
-        packages = ['sys', 'pathlib', 'itertools', 'difflib', 'PySide', 'PySide.QtCore', 'PySide.QtGui'],
+        packages = ['sys', 'pathlib', 'itertools', 'PySide', 'PySide.QtCore', 'PySide.QtGui'],
         excludes = []
         )
 
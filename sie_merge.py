@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Merge several SIE files, such as monthly exports or one file per series,
+into one. The identification records must agree, the account plan records
+are merged and the verifications are merged in order of serie and vernr,
+the order they are exported in. Their dates need not be in order.
+The inputs are streams of records, like SieParser.iter_records(), and the
+merge is one too, so it can go straight to SieIO.writeSie. Only the records
+before the verifications are held in memory, and one verification per input.
+An input that is not in order of serie and vernr is refused when the
+verification out of order is read.
+"""
+
+import heapq
+import argparse
+from itertools import chain
+
+from accounting_data import SieIO, SieData
+from sie_parse import SieParser
+from export_state import is_numbered
+
+# Identification records that must be the same in all inputs that have them.
+# The other identification records, like #GEN, are taken from the first input.
+MATCHING_FIELDS = ('#FNAMN', '#ORGNR', '#FORMAT', '#SIETYP', '#KPTYP', '#VALUTA',
+                   '#RAR', '#TAXAR')
+
+# Number of leading fields that identify an account plan record, 1 otherwise
+KEY_FIELDS = {'#OBJEKT': 2}
+
+# Position of the amount in balance records, the fields before it identify them
+AMOUNT_FIELD = {'#IB': 2, '#UB': 2, '#RES': 2, '#OIB': 3, '#OUB': 3,
+                '#PSALDO': 4, '#PBUDGET': 4}
+
+
+class MergeConflict(Exception):
+    """The inputs can not be merged, the message says why"""
+
+
+def _field_key(field):
+    """The part of a record that identifies it among records of its kind"""
+    if field.name in AMOUNT_FIELD:
+        data = field.data[:AMOUNT_FIELD[field.name]]
+    else:
+        data = field.data[:KEY_FIELDS.get(field.name, 1)]
+    return field.name, repr(data)
+
+def _order_key(ver):
+    """Sort key for verifications, with numeric vernr in numeric order"""
+    return ver.serie, len(ver.vernr), ver.vernr
+
+
+class SieMerge:
+    """
+    Merge the record streams in sources. With skip_balances the balance
+    records, which differ between for example monthly files, are left out.
+    They can be computed for the merged file with balances.Balances.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, sources, skip_balances=False, names=None):
+        self.sources = [iter(source) for source in sources]
+        self.skip_balances = skip_balances
+        # Names of the inputs for messages, defaults to their number
+        self.names = names or [str(num) for num in range(1, len(sources) + 1)]
+        self.verification_count = 0
+
+    def _read_header(self, num, head, kept, ident_input):
+        """
+        Read the records of input num up to its first verification into
+        head, which is {name: [DataField]}. kept is {record key: (input,
+        DataField)} and ident_input {name: input} for the records in head.
+        Returns the first verification or None.
+        """
+        for record in self.sources[num]:
+            if record.name == '#VER':
+                return record
+            if record.name in SieData.control_fields:
+                continue
+            if record.name in AMOUNT_FIELD and self.skip_balances:
+                continue
+            if record.name in SieData.ident_fields:
+                self._check_ident(num, record, head, ident_input)
+                continue
+            key = _field_key(record)
+            if key not in kept:
+                kept[key] = (num, record)
+                head.setdefault(record.name, []).append(record)
+            elif kept[key][1].data != record.data:
+                raise MergeConflict('{} skiljer sig mellan {} och {}: {} och {}'.format(
+                    record.name, self.names[kept[key][0]], self.names[num],
+                    kept[key][1], record))
+        return None
+
+    def _check_ident(self, num, record, head, ident_input):
+        """
+        Keep the identification records of the first input that has them,
+        check that the others agree for MATCHING_FIELDS
+        """
+        first = ident_input.setdefault(record.name, num)
+        if first == num:
+            head.setdefault(record.name, []).append(record)
+        elif record.name in MATCHING_FIELDS and record.data not in [
+                field.data for field in head[record.name]]:
+            raise MergeConflict('{} skiljer sig mellan {} och {}: {} och {}'.format(
+                record.name, self.names[first], self.names[num],
+                head[record.name][0], record))
+
+    def records(self):
+        """All records of the merged file in file order"""
+        head, kept, ident_input = {}, {}, {}
+        firsts = [self._read_header(num, head, kept, ident_input)
+                  for num in range(len(self.sources))]
+        for name in (SieData.ident_fields + SieData.account_fields
+                     + SieData.balance_fields):
+            yield from head.get(name, [])
+        previous = None
+        for key, num, ver in heapq.merge(*(self._verifications(num, first)
+                                           for num, first in enumerate(firsts))):
+            # Repeated verifications end up next to each other
+            if key == previous and is_numbered(ver.serie, ver.vernr):
+                raise MergeConflict('#VER {} {} finns flera gånger, senast i {}'.format(
+                    ver.serie, ver.vernr, self.names[num]))
+            previous = key
+            self.verification_count += 1
+            yield ver
+
+    def _verifications(self, num, first):
+        """
+        (_order_key, num, verification) for the verifications of input num
+        from first, which may be None. Raises MergeConflict if they are not
+        in order.
+        """
+        if first is None:
+            return
+        previous = None
+        for record in chain([first], self.sources[num]):
+            if record.name != '#VER':
+                if record.name in SieData.control_fields:
+                    continue
+                raise MergeConflict('{}: {} efter verifikationerna stöds inte'.format(
+                    self.names[num], record.name))
+            key = _order_key(record)
+            if previous is not None and key < previous:
+                raise MergeConflict('{} har inte verifikationerna i ordning efter serie '
+                                    'och nummer vid #VER {} {}'.format(
+                                        self.names[num], record.serie, record.vernr))
+            previous = key
+            yield key, num, record
+
+    def sie_data(self):
+        """The merged records as a SieData"""
+        sie_data = SieData()
+        for record in self.records():
+            sie_data.add_data(record)
+        return sie_data
+
+
+def merge_files(filenames, output, overwrite=False, skip_balances=False):
+    """Merge the SIE files filenames into output, returns the SieMerge"""
+    merge = SieMerge([SieParser(filename).iter_records() for filename in filenames],
+                     skip_balances, filenames)
+    SieIO.writeSie(merge.records(), output, overwrite)
+    return merge
+
+if __name__ == "__main__":
+    ARGPARSER = argparse.ArgumentParser(
+        description='Slå ihop flera SIE-filer till en, med verifikationerna i ordning '
+        'efter serie och nummer')
+    ARGPARSER.add_argument('output', help='The SIE file to write')
+    ARGPARSER.add_argument('siefiles', nargs='+', help='The SIE files to merge')
+    ARGPARSER.add_argument('--overwrite', action='store_true',
+                           help='Replace output if it exists')
+    ARGPARSER.add_argument('--skip-balances', action='store_true',
+                           help='Leave out #IB, #UB, #RES, #PSALDO and the like')
+    ARGS = ARGPARSER.parse_args()
+    MERGE = merge_files(ARGS.siefiles, ARGS.output, ARGS.overwrite,
+                        ARGS.skip_balances)
+    print('{} verifikationer från {} filer'.format(MERGE.verification_count,
+                                                   len(ARGS.siefiles)))
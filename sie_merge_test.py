@@ -0,0 +1,100 @@
+"""Tests for merging SIE files"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+import generate_data
+from sie_merge import SieMerge, MergeConflict, merge_files
+from sie_parse import SieParser
+
+def _write(filename, chart, verifications, seed, serie='A', replace=()):
+    lines = generate_data.sie_lines(verifications, 3, chart, seed=seed)
+    with open(filename, 'w', encoding='cp437') as siefile:
+        for line in lines:
+            line = line.replace('#VER A ', '#VER {} '.format(serie))
+            for old, new in replace:
+                line = line.replace(old, new)
+            siefile.write(line)
+
+def test_merge_series():
+    """Verifications are merged by series and number, headers once"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        first, second, output = [os.path.join(directory, name)
+                                 for name in ['a.si', 'b.si', 'merged.si']]
+        _write(first, chart, 30, 1)
+        _write(second, chart, 20, 2, 'B',
+               [('#KONTO 1930 ', '#OBJEKT 1 K0099 "Ny"\n#KONTO 1930 ')])
+        merge = merge_files([first, second], output)
+        assert merge.verification_count == 50
+        parser = SieParser(output)
+        parser.parse()
+        result = parser.result
+        keys = [(ver.serie, int(ver.vernr)) for ver in result.get_data('#VER')]
+        assert keys == sorted(keys)
+        assert len(result.get_data('#FNAMN')) == 1
+        assert len(result.get_data('#KONTO')) == 10
+        assert len(result.get_data('#OBJEKT')) == 3 + 4 + 1
+
+def test_merge_conflicts():
+    """Headers that disagree, repeated verifications and disorder are refused"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        first, second = [os.path.join(directory, name) for name in ['a.si', 'b.si']]
+        _write(first, chart, 10, 1)
+        def sources():
+            return [SieParser(name).iter_records() for name in [first, second]]
+
+        _write(second, chart, 10, 2, 'B', [('Syntetiska', 'Andra')])
+        with pytest.raises(MergeConflict, match='#FNAMN'):
+            list(SieMerge(sources()).records())
+        _write(second, chart, 10, 2, 'B', [('"Konto 1930"', '"Bank"')])
+        with pytest.raises(MergeConflict, match='#KONTO'):
+            list(SieMerge(sources()).records())
+        _write(second, chart, 10, 2)
+        with pytest.raises(MergeConflict, match='#VER A 1 finns flera gånger'):
+            list(SieMerge(sources()).records())
+        _write(second, chart, 10, 2, 'B', [('#VER B 4 ', '#VER B 3 ')])
+        with pytest.raises(MergeConflict, match='#VER B 3 finns flera gånger'):
+            list(SieMerge(sources()).records())
+        _write(second, chart, 10, 2, 'B', [('#VER B 5 ', '#VER B 3 ')])
+        with pytest.raises(MergeConflict, match='inte verifikationerna i ordning'):
+            list(SieMerge(sources()).records())
+
+def test_merge_unordered_dates():
+    """Verifications dated out of order are kept in the order of their numbers"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        first, second = [os.path.join(directory, name) for name in ['a.si', 'b.si']]
+        _write(first, chart, 10, 1)
+        _write(second, chart, 10, 2, 'B', [('#VER B 3 20170315', '#VER B 3 20170101')])
+        merge = SieMerge([SieParser(name).iter_records() for name in [first, second]])
+        verifications = [record for record in merge.records() if record.name == '#VER']
+        assert len(verifications) == merge.verification_count == 20
+        keys = [(ver.serie, int(ver.vernr)) for ver in verifications]
+        assert keys == sorted(keys)
+        assert verifications[12].verdatum.packed == 20170101
+
+def test_merge_streams():
+    """The inputs are read as the merge is written, not all at once"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        first, second = [os.path.join(directory, name) for name in ['a.si', 'b.si']]
+        _write(first, chart, 50, 1)
+        _write(second, chart, 50, 2, 'B')
+        read = []
+        def counted(filename):
+            for record in SieParser(filename).iter_records():
+                read.append(record.name)
+                yield record
+
+        merged = SieMerge([counted(first), counted(second)]).records()
+        for record in merged:
+            if record.name == '#VER':
+                break
+        # The header and the first verification of each input
+        assert read.count('#VER') == 2
+        assert sum(1 for record in merged if record.name == '#VER') == 99
+        assert read.count('#VER') == 100
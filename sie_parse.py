@@ -3,90 +3,293 @@
 """Läs in en verifikationsfil i .si-format för att kunna exportera till något
 annat format"""
 
+import os
+import re
 import sys
 import argparse
-import shlex
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 
 from accounting_data import SieData, Verification, Transaction, DataField
-from accounting_data import SieIO
+from accounting_data import SieIO, PROGRESS_INTERVAL
+from accounting_data import ChecksumMismatch, checksum_bytes, format_checksum, _escape
 from petra_output import PetraOutput
+from export_state import is_numbered
+import stats
+
+# Ett citerat fält, en objektlista ({ eller }) eller ett vanligt ord
+_TOKEN_RE = re.compile(r'("(?:[^"\\]|\\.)*")|([{}])|([^\s"{}]+)')
+_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+def split_line(line):
+    """
+    Dela upp en rad i en .si-fil i fält i ett enda pass.
+    Citerade fält returneras utan citattecken och objektlistor, som {1 "K1"},
+    returneras som en lista med strängar. Ex.
+    '#TRANS 1930 {1 "K1"} -50 "" "A B"' blir
+    ['#TRANS', '1930', ['1', 'K1'], '-50', '', 'A B']
+    En ensam { eller } ger en tom lista respektive '}'.
+    """
+    if '"' not in line and '{' not in line:
+        return line.split()
+    tokens = []
+    target = tokens
+    for quoted, brace, word in _TOKEN_RE.findall(line):
+        if word:
+            target.append(word)
+        elif quoted:
+            text = quoted[1:-1]
+            if '\\' in text:
+                text = _ESCAPE_RE.sub(r'\1', text)
+            target.append(text)
+        elif brace == '{':
+            target = []
+            tokens.append(target)
+        elif target is not tokens:
+            target = tokens
+        else:
+            tokens.append(brace)
+    return tokens
+
+def _checksum_tokens(tokens, crc):
+    """
+    Uppdatera kontrollsumman med fälten från split_line, med \\ och " som
+    de står i filen
+    """
+    return checksum_bytes(''.join(
+        ''.join(map(_escape, token)) if token.__class__ is list else _escape(token)
+        for token in tokens), crc)
+
+# Ungefärligt antal rader som varje process tolkar åt gången i parse_parallel
+CHUNK_LINES = 20000
+
+# Antal bitar per process som är lästa men inte tolkade i parse_parallel
+CHUNKS_PER_PROCESS = 2
+
+def _split_chunks(lines, chunk_lines):
+    """Dela upp rader i bitar om minst chunk_lines rader som slutar med }"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines and line.strip() == '}':
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _parse_chunk(lines):
+    """Tolka en bit av en fil som börjar med #VER, returnera posterna i den"""
+    # pylint: disable=protected-access
+    parser = SieParser(None)
+    records = []
+    for parser.current_line in lines:
+        record = parser._parse_next()
+        if record is not None:
+            records.append(record)
+    return records
 
 class SieParser:
     """Parser för ekonomifiler i .si-format"""
     # pylint: disable=too-few-public-methods
 
-    def __init__(self, siefile):
+    def __init__(self, siefile, skip=None, strict_checksum=False):
+        # pylint: disable=too-many-instance-attributes
         self.siefile = siefile
+        # (serie, vernr) för verifikationer som hoppas över utan att tolkas,
+        # till exempel ExportState.exported_verifications(). Verifikationer
+        # utan serie eller nummer hoppas aldrig över. Stöds inte av
+        # parse_parallel.
+        self.skip = skip
+        self.skipped = 0
+        self._skipping = False
+        # Om filen har #KSUMMA räknas kontrollsumman fram under inläsningen.
+        # checksum_ok blir True eller False, och checksum_error beskriver
+        # felet. Med strict_checksum kastas ChecksumMismatch i stället.
+        # Gäller inte parse_parallel.
+        self.strict_checksum = strict_checksum
+        self.checksum_ok = None
+        self.checksum_error = None
+        self._crc = None
         self.parse_result = None
         self.current_line = None
         self.current_verification = None
         self.result = None
 
-    def parse(self):
-        """Läs in filen och tolka den. Spara tolkade objekt till result."""
+    @stats.timed('SieParser.parse')
+    def parse(self, progress=None):
+        """
+        Läs in filen och tolka den. Spara tolkade objekt till result.
+        progress anropas som i iter_records.
+        """
+        self.parse_result = SieData()
+        for record in self.iter_records(progress):
+            self.parse_result.add_data(record)
+        self.result = self.parse_result
+
+    @stats.timed('SieParser.parse_parallel')
+    def parse_parallel(self, processes=None, chunk_lines=CHUNK_LINES):
+        """
+        Som parse, men verifikationerna tolkas i flera processer.
+        Posterna före första #VER tolkas direkt, resten delas upp vid } i
+        bitar om ungefär chunk_lines rader. Resultatet är detsamma som för parse.
+        Filen läses inte längre än CHUNKS_PER_PROCESS bitar per process före
+        tolkningen. skip stöds inte.
+        """
+        if self.skip:
+            raise ValueError('parse_parallel stöder inte skip')
+        processes = processes or os.cpu_count() or 1
+        self.parse_result = SieData()
         if self.siefile:
-            self.result = self._parse_sie(SieIO.readSie(self.siefile))
+            lines = SieIO.iterSie(self.siefile)
         else:
-            self.result = self._parse_sie(sys.stdin)
+            lines = iter(sys.stdin)
+        for self.current_line in lines:
+            if self.current_line.lstrip().startswith('#VER'):
+                lines = chain([self.current_line], lines)
+                break
+            record = self._parse_next()
+            if record is not None:
+                self.parse_result.add_data(record)
+        with ProcessPoolExecutor(processes) as executor:
+            pending = deque()
+            for chunk in _split_chunks(lines, chunk_lines):
+                if len(pending) >= processes * CHUNKS_PER_PROCESS:
+                    self._add_records(pending.popleft().result())
+                pending.append(executor.submit(_parse_chunk, chunk))
+            while pending:
+                self._add_records(pending.popleft().result())
+        self.result = self.parse_result
+
+    def _add_records(self, records):
+        """Lägg till poster från _parse_chunk i parse_result"""
+        for record in records:
+            self.parse_result.add_data(record)
+
+    def iter_records(self, progress=None):
+        """
+        Läs filen rad för rad och generera varje DataField och varje färdig
+        Verification så snart den avslutande } har lästs. Hela filen hålls
+        aldrig i minnet.
+        progress(rader, None) anropas var PROGRESS_INTERVAL:e rad och kan
+        kasta ConversionCancelled för att avbryta.
+        """
+        split = split_line
+        if self.siefile:
+            handle = SieIO.iterSie(self.siefile)
+        else:
+            handle = sys.stdin
+        # Tidtagningen kostar något per rad och läggs bara till när
+        # statistik samlas in
+        if stats.enabled:
+            split = stats.timed('SieParser tokenizing')(split)
+        self._split = split
+        count = records = 0
+        for count, self.current_line in enumerate(handle, 1):
+            if progress is not None and not count % PROGRESS_INTERVAL:
+                progress(count, None)
+            record = self._parse_next()
+            if record is not None:
+                records += 1
+                yield record
+        stats.count('SIE lines read', count)
+        stats.count('SIE records read', records)
+        if self._crc is not None:
+            self._checksum_failed('#KSUMMA saknas i slutet av {}, filen kan vara '
+                                  'avkortad'.format(self.siefile))
 
     def write_result(self, filename):
         """Skriv resultatet till en fil, med rätt teckenkodning"""
         SieIO.writeSie(self.result, filename, True)
 
-    def _parse_sie(self, handle):
-        self.parse_result = SieData()
-        for self.current_line in handle:
-            self._parse_next()
-        return self.parse_result
-
     def _parse_next(self):
-        tokens = shlex.split(self.current_line)
-        if tokens and tokens[0] == '#VER':
-            self.current_verification = Verification(*tokens[1:])
-        elif tokens and tokens[0] == '{':
-            pass
-        elif tokens and tokens[0] == '}':
-            self.parse_result.add_data(self.current_verification)
-        elif tokens and tokens[0] == '#TRANS':
+        """Tolka current_line, returnera en post om den är färdig"""
+        if self._skipping:
+            # Raderna i en verifikation som hoppas över delas inte ens upp,
+            # utom när de behövs till kontrollsumman
+            tokens = self._split(self.current_line) if self._crc is not None else None
+            if tokens and tokens[0] != '}':
+                self._crc = _checksum_tokens(tokens, self._crc)
+            if self.current_line.strip() == '}':
+                self._skipping = False
+            return None
+        tokens = self._split(self.current_line)
+        if not tokens:
+            return None
+        tag = tokens[0]
+        if tag == '#KSUMMA':
+            self._read_checksum(tokens)
+        elif self._crc is not None and tag != '}':
+            # En ensam } avslutar en verifikation och räknas inte
+            self._crc = _checksum_tokens(tokens, self._crc)
+        if tag == '#TRANS':
             self.current_verification.add_trans(self._parse_trans(tokens))
-        elif tokens:
-            self.parse_result.add_data(DataField(tokens))
+        elif tag == '#VER':
+            if (self.skip is not None and is_numbered(tokens[1], tokens[2])
+                    and (tokens[1], tokens[2]) in self.skip):
+                self._skipping = True
+                self.skipped += 1
+                return None
+            self.current_verification = Verification(*tokens[1:])
+        elif tag == '}':
+            return self.current_verification
+        elif isinstance(tag, list):
+            pass # { som inleder transaktionerna
         else:
-            pass
+            return DataField(tokens)
+        return None
+
+    def _read_checksum(self, tokens):
+        """#KSUMMA utan värde startar kontrollsumman, med värde jämförs den"""
+        if len(tokens) == 1:
+            self._crc = 0
+        elif self._crc is not None:
+            computed = format_checksum(self._crc)
+            self._crc = None
+            try:
+                in_file = format_checksum(int(tokens[1]))
+            except ValueError:
+                in_file = tokens[1]
+            if in_file == computed:
+                self.checksum_ok = True
+            else:
+                self._checksum_failed(
+                    'Kontrollsumman #KSUMMA stämmer inte i {}: {} i filen, {} '
+                    'beräknat'.format(self.siefile, tokens[1], computed))
+
+    def _checksum_failed(self, message):
+        self._crc = None
+        self.checksum_ok = False
+        self.checksum_error = message
+        stats.count('SIE checksum errors')
+        if self.strict_checksum:
+            raise ChecksumMismatch(message)
+
+    # Ersätts med en tidtagande split_line när statistik samlas in
+    _split = staticmethod(split_line)
 
     @staticmethod
     def _parse_trans(tokens):
-        args = tokens[1:2]
-
-        if tokens[2] == '{}':
-            args = args + [[]] + tokens[3:]
-        else:
-            if tokens[2].endswith('}'):
-                objekt = [tokens[2][1:-1]]
-                args = args + [objekt] + tokens[3:]
-            else:
-                objekt = [tokens[2][1:]]
-                for idx, token in enumerate(tokens[3:]):
-                    if token.endswith('}'):
-                        objekt.append(token[:-1])
-                        args = args + [objekt] + tokens[4+idx:]
-                        break
-                    else:
-                        objekt.append(token)
-        return Transaction(*args)
+        """Skapa en Transaction av en rad som delats upp med split_line"""
+        return Transaction(*tokens[1:])
 
 if __name__ == "__main__":
     ARGPARSER = argparse.ArgumentParser(
         description='Tolka en verifikationsfil i .si-format')
     ARGPARSER.add_argument('siefile', metavar='siefile',
                            help='The file to read, defaults to stdin')
+    ARGPARSER.add_argument('--strict-checksum', action='store_true',
+                           help='Stop if #KSUMMA does not match the file')
+    stats.add_arguments(ARGPARSER)
     ARGS = ARGPARSER.parse_args()
     FILENAME = '.'.join(ARGS.siefile.split('/')[-1].split('.')[:-1])
-    PARSER = SieParser(ARGS.siefile)
-    PARSER.parse()
-    # print(PARSER.result)
-    P_OUTPUT = PetraOutput(PARSER.result, 'TABELLER/Kta_Acct.csv',
-            'TABELLER/Re_CC.csv', 'TABELLER/Proj_CC.csv')
-    P_OUTPUT.populate_output_table()
-    # P_OUTPUT.print_output()
-    P_OUTPUT.write_output('CSV/' + FILENAME + '.csv')
+
+    def convert():
+        """Convert the SIE file to a Petra csv file"""
+        parser = SieParser(ARGS.siefile, strict_checksum=ARGS.strict_checksum)
+        p_output = PetraOutput(parser.iter_records(), 'TABELLER/Kto_Acct.csv',
+                'TABELLER/Re_CC.csv', 'TABELLER/Proj_CC.csv')
+        p_output.write_stream('CSV/' + FILENAME + '.csv')
+        if parser.checksum_error:
+            print('Varning: ' + parser.checksum_error, file=sys.stderr)
+    stats.run(ARGS, convert)
@@ -1,11 +1,12 @@
 """Tests for sie parsing"""
 
-import shlex
 from tempfile import NamedTemporaryFile
 import filecmp
 
-from sie_parse import SieParser
-from accounting_data import Transaction
+import pytest
+
+from sie_parse import SieParser, split_line
+from accounting_data import Transaction, DataField, SieIO, ChecksumMismatch
 
 def test_parse_trans():
     """Tests _parse_trans"""
@@ -14,39 +15,57 @@ def test_parse_trans():
     trans = ['dummy']
     test.append("#TRANS 1 {} 50")
     trans.append(Transaction('1', [], '50'))
-    assert SieParser._parse_trans(shlex.split(test[1])) == trans[1]
+    assert SieParser._parse_trans(split_line(test[1])) == trans[1]
 
     test.append("#TRANS 1 {2} 50")
     trans.append(Transaction('1', ['2'], '50'))
-    assert SieParser._parse_trans(shlex.split(test[2])) == trans[2]
+    assert SieParser._parse_trans(split_line(test[2])) == trans[2]
 
     test.append("#TRANS 1 {2 3} 50")
     trans.append(Transaction('1', ['2', '3'], '50'))
-    assert SieParser._parse_trans(shlex.split(test[3])) == trans[3]
+    assert SieParser._parse_trans(split_line(test[3])) == trans[3]
 
     test.append("#TRANS 2 {} 50 20160806")
     trans.append(Transaction('2', [], '50', '20160806'))
-    assert SieParser._parse_trans(shlex.split(test[4])) == trans[4]
+    assert SieParser._parse_trans(split_line(test[4])) == trans[4]
 
     test.append('#TRANS 2 {} 50 20160806 "Transaction 1"')
     trans.append(Transaction('2', [], '50', '20160806', 'Transaction 1'))
-    assert SieParser._parse_trans(shlex.split(test[5])) == trans[5]
+    assert SieParser._parse_trans(split_line(test[5])) == trans[5]
 
     test.append('#TRANS 2 {} 50 20160806 "Transaction 1" 2')
     trans.append(Transaction('2', [], '50', '20160806', 'Transaction 1', '2'))
-    assert SieParser._parse_trans(shlex.split(test[6])) == trans[6]
+    assert SieParser._parse_trans(split_line(test[6])) == trans[6]
 
     test.append('#TRANS 2 {} 50 20160806 "Transaction 1" 2 "person"')
     trans.append(Transaction('2', [], '50', '20160806', 'Transaction 1', '2', 'person'))
-    assert SieParser._parse_trans(shlex.split(test[7])) == trans[7]
+    assert SieParser._parse_trans(split_line(test[7])) == trans[7]
 
     test.append('#TRANS 2 {P-12345} 50')
     trans.append(Transaction('2', ['P-12345'], '50'))
-    assert SieParser._parse_trans(shlex.split(test[8])) == trans[8]
+    assert SieParser._parse_trans(split_line(test[8])) == trans[8]
 
     test.append('#TRANS 2 {"10" P-12345} 50')
     trans.append(Transaction('2', ['10', 'P-12345'], '50'))
-    assert SieParser._parse_trans(shlex.split(test[9])) == trans[9]
+    assert SieParser._parse_trans(split_line(test[9])) == trans[9]
+
+def test_split_line():
+    """Tests split_line"""
+    assert split_line('#VER "" "" 20120425 "A \\"B\\"" 20120926\n') == [
+        '#VER', '', '', '20120425', 'A "B"', '20120926']
+    assert split_line('#PROGRAM "Visma 100" "2012.1 "') == [
+        '#PROGRAM', 'Visma 100', '2012.1 ']
+    assert split_line('#TRANS 1930 {1 "K 1" 6 P-1} -50') == [
+        '#TRANS', '1930', ['1', 'K 1', '6', 'P-1'], '-50']
+    assert split_line('{\n') == [[]]
+    assert split_line('}\n') == ['}']
+    assert split_line('   \n') == []
+
+def test_data_field_objects():
+    """Object lists in other fields than #TRANS are written back as lists"""
+    line = '#PSALDO 0 201201 3010 {1 "K 1"} -100'
+    assert repr(DataField(split_line(line))) == line
+    assert repr(DataField(split_line('#OIB 0 3010 {} 5'))) == '#OIB 0 3010 {} 5'
 
 def test_parse_and_write():
     """Parsing the output of write_result should yield the same output"""
@@ -59,3 +78,87 @@ def test_parse_and_write():
             parser2.parse()
             parser2.write_result(file2.name)
             assert filecmp.cmp(file1.name, file2.name, shallow=False)
+
+def test_iter_records():
+    """Streaming the records gives the same data and output as parse"""
+    parser = SieParser('tests/testfile.si')
+    parser.parse()
+    records = list(SieParser('tests/testfile.si').iter_records())
+    assert [r.name for r in records].count('#VER') == 1
+    assert records[-1].trans_list == parser.result.get_data('#VER')[0].trans_list
+    with NamedTemporaryFile() as stream_file:
+        # The stream is written in file order, not SieData's field order
+        SieIO.writeSie(SieParser('tests/testfile.si').iter_records(),
+                       stream_file.name, True)
+        parser2 = SieParser(stream_file.name)
+        parser2.parse()
+        assert repr(parser2.result) == repr(parser.result)
+
+def test_parse_parallel():
+    """Parsing in several processes gives the same result as parse"""
+    with open('tests/testfile.si', encoding='cp437') as testfile:
+        lines = testfile.readlines()
+    header, ver = lines[:16], lines[16:]
+    with NamedTemporaryFile(mode='w', encoding='cp437') as siefile:
+        siefile.writelines(header)
+        for vernr in range(10):
+            siefile.writelines([ver[0].replace('""', str(vernr), 2)] + ver[1:])
+        siefile.write('#KSUMMA 0\n')
+        siefile.flush()
+        parser = SieParser(siefile.name)
+        parser.parse()
+        parallel = SieParser(siefile.name)
+        parallel.parse_parallel(processes=2, chunk_lines=25)
+        assert len(parallel.result.get_data('#VER')) == 10
+        assert repr(parallel.result) == repr(parser.result)
+        more = SieParser(siefile.name)
+        more.parse_parallel(processes=1, chunk_lines=1)
+        assert repr(more.result) == repr(parser.result)
+        with pytest.raises(ValueError):
+            SieParser(siefile.name, skip={('A', '1')}).parse_parallel()
+
+def test_checksum():
+    """#KSUMMA is written with the file and checked when it is read"""
+    with NamedTemporaryFile() as written:
+        SieIO.writeSie(SieParser('tests/Lön.si').iter_records(), written.name, True)
+        with open(written.name, encoding='cp437') as siefile:
+            lines = siefile.readlines()
+        assert lines[1] == '#KSUMMA\n' and lines[-1].startswith('#KSUMMA ')
+        parser = SieParser(written.name)
+        parser.parse()
+        assert parser.checksum_ok and parser.checksum_error is None
+        # The parsed data is written in SieData's order with a new checksum
+        SieIO.writeSie(parser.result, written.name, True)
+        reparsed = SieParser(written.name)
+        reparsed.parse()
+        assert reparsed.checksum_ok
+
+    changed = [line.replace('Lön', 'Lon', 1) if line.startswith('#VER')
+               else line for line in lines]
+    for broken in [changed, lines[:-1]]:
+        with NamedTemporaryFile(mode='w', encoding='cp437') as siefile:
+            siefile.writelines(broken)
+            siefile.flush()
+            parser = SieParser(siefile.name)
+            parser.parse()
+            assert parser.checksum_ok is False
+            assert '#KSUMMA' in parser.checksum_error
+            with pytest.raises(ChecksumMismatch):
+                SieParser(siefile.name, strict_checksum=True).parse()
+
+def test_write_quotes_and_backslashes():
+    """Fields with " or \\ are escaped when written and read back unchanged"""
+    records = list(SieParser('tests/Lön.si').iter_records())
+    ver = next(record for record in records if record.name == '#VER')
+    ver.vertext = 'Lön "april"'
+    ver.trans_list[0].transtext = 'C:\\löner\\'
+    ver.trans_list[0].objekt = ['1', 'K "1"']
+    with NamedTemporaryFile() as written:
+        SieIO.writeSie(records, written.name, True)
+        parser = SieParser(written.name)
+        parser.parse()
+    assert parser.checksum_ok
+    reread = parser.result.get_data('#VER')[0]
+    assert reread.vertext == 'Lön "april"'
+    assert reread.trans_list[0].transtext == 'C:\\löner\\'
+    assert reread.trans_list[0].objekt == ['1', 'K "1"']
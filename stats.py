@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Timing and counters for conversions, off by default.
+Instrumented code checks stats.enabled before counting, so the cost is a
+single attribute lookup when statistics are not collected.
+"""
+
+import sys
+import json
+import time
+import cProfile
+import pstats
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+
+enabled = False
+timings = defaultdict(float)
+counters = defaultdict(int)
+
+
+def enable(on=True):
+    """Start (or stop) collecting statistics"""
+    global enabled # pylint: disable=global-statement,invalid-name
+    enabled = on
+
+def reset():
+    """Forget everything collected so far"""
+    timings.clear()
+    counters.clear()
+
+@contextmanager
+def stage(name):
+    """Add the wall time of the with block to the stage name"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] += time.perf_counter() - start
+
+def timed(name):
+    """Decorator that adds the wall time of each call to the stage name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            # Without stage, since this is also used for functions called
+            # once per line
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[name] += time.perf_counter() - start
+        return wrapper
+    return decorator
+
+def count(name, number=1):
+    """Add number to the counter name"""
+    if enabled:
+        counters[name] += number
+
+def _date_caches():
+    # Imported here since accounting_data itself uses this module
+    from accounting_data import parse_sie_date, format_date
+    return {func.__name__: func.cache_info()._asdict()
+            for func in [parse_sie_date, format_date]}
+
+def as_dict():
+    """All statistics as a dict that can be saved as json"""
+    return {'stages': dict(timings), 'counters': dict(counters),
+            'date_caches': _date_caches()}
+
+def report(out=sys.stderr):
+    """Print the statistics as a table"""
+    print('{:<44}{:>12}'.format('Stage', 'Seconds'), file=out)
+    for name, seconds in timings.items():
+        print('{:<44}{:>12.3f}'.format(name, seconds), file=out)
+    print('{:<44}{:>12}'.format('Counter', 'Count'), file=out)
+    for name in sorted(counters):
+        print('{:<44}{:>12,}'.format(name, counters[name]), file=out)
+    for name, info in _date_caches().items():
+        print('{:<44}{:>12}'.format(
+            'cache ' + name, '{hits}/{misses}'.format(**info)), file=out)
+
+def add_arguments(argparser):
+    """Add --stats, --stats-json and --profile to a command line parser"""
+    argparser.add_argument('--stats', action='store_true',
+                           help='Print time per stage and counters to stderr')
+    argparser.add_argument('--stats-json', metavar='FILE',
+                           help='Save time per stage and counters as json')
+    argparser.add_argument('--profile', metavar='FILE',
+                           help='Run under cProfile and save the profile')
+
+def run(args, func, *func_args):
+    """
+    Run func(*func_args) with the statistics asked for by the arguments from
+    add_arguments, and return its result.
+    """
+    if args.stats or args.stats_json:
+        enable()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            result = profiler.runcall(func, *func_args)
+        else:
+            result = func(*func_args)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                'cumulative').print_stats(20)
+        if args.stats:
+            report()
+        if args.stats_json:
+            with open(args.stats_json, 'w') as json_file:
+                json.dump(as_dict(), json_file, indent=2)
+    return result
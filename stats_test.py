@@ -0,0 +1,59 @@
+"""Tests for the conversion statistics"""
+
+import os
+import json
+import argparse
+from tempfile import TemporaryDirectory
+
+import stats
+import generate_data
+from sie_parse import SieParser
+from petra_output import PetraOutput
+from accounting_data import parse_sie_date
+
+def test_stats_off_by_default():
+    """Nothing is collected unless statistics are enabled"""
+    stats.reset()
+    with stats.stage('stage'):
+        stats.count('counter')
+    assert not stats.timings and not stats.counters
+
+def test_run_collects_stages_and_counters():
+    """A conversion run with --stats-json saves times and counters"""
+    with TemporaryDirectory() as directory:
+        chart = generate_data.Chart(accounts=10, cost_centers=3, projects=4)
+        tables = dict(zip(generate_data.TABLE_FILES,
+                          generate_data.write_tables(directory, chart)))
+        siefile = os.path.join(directory, 'test.si')
+        generate_data.write_sie(siefile, 20, 3, chart)
+        json_file = os.path.join(directory, 'stats.json')
+
+        def convert():
+            p_output = PetraOutput(SieParser(siefile).iter_records(),
+                                   tables['Kto_Acct.csv'], tables['Re_CC.csv'],
+                                   tables['Proj_CC.csv'])
+            p_output.populate_output_table()
+            p_output.write_output(os.path.join(directory, 'out.csv'))
+            return len(p_output.table)
+
+        argparser = argparse.ArgumentParser()
+        stats.add_arguments(argparser)
+        args = argparser.parse_args(['--stats-json', json_file])
+        stats.reset()
+        # Only dates that are not cached are timed
+        parse_sie_date.cache_clear()
+        try:
+            assert stats.run(args, convert) == 2 + 20 * 4
+        finally:
+            stats.enable(False)
+        with open(json_file) as saved:
+            result = json.load(saved)
+    assert set(result['stages']) >= {'CSVDict load',
+                                     'PetraOutput.populate_output_table',
+                                     'PetraOutput.write_output',
+                                     'SieParser tokenizing', 'Date parsing'}
+    assert result['counters']['Verifications translated'] == 20
+    assert result['counters']['SIE records read'] > 20
+    assert result['counters']['Lookups Kto_Acct.csv'] == 20 * 3
+    assert result['counters']['Petra bytes written'] > 0
+    assert 'parse_sie_date' in result['date_caches']
@@ -10,17 +10,14 @@ konto = CSVDict('TABELLER_old/Konto.csv')
 proj_cc = CSVDict('TABELLER/Proj_CC.csv')
 projekt = CSVDict('TABELLER_old/Projekt.csv')
 
-for k,v in projekt.items():
-    if k not in proj_cc:
-        proj_cc[k] = ['', v['P_Kst_P']]
+proj_cc.update_many((k, ['', v['P_Kst_P']]) for k,v in projekt.items()
+                    if k not in proj_cc)
 
-for k,v in konto.items():
-    if k not in kto_acct:
-        kto_acct[k] = {'P_Acct': v['P_Kto']}
+kto_acct.update_many((k, {'P_Acct': v['P_Kto']}) for k,v in konto.items()
+                     if k not in kto_acct)
 
-for k,v in costcenter.items():
-    if k not in re_cc:
-        re_cc[k] = {'P_CC': v['P_Kst']}
+re_cc.update_many((k, {'P_CC': v['P_Kst']}) for k,v in costcenter.items()
+                  if k not in re_cc)
 
 parser = SieParser('SIE/VtP_201710_1.si')
 parser.parse()
@@ -4,94 +4,188 @@
 import os
 import sys
 import csv
+import hashlib
 from datetime import datetime
+from contextlib import closing
+from itertools import chain
 from accounting_data import SieData, SieField, Verification, Transaction, DataField, SieIO
-from csv_dict import CSVDict
+from accounting_data import petra_to_sie_date, NothingToExport, PROGRESS_INTERVAL
+from accounting_data import parse_ore, _format_ore
+from csv_dict import MissingKeys, open_table
+from balances import Balances
+import stats
+
+def batch_key(batch):
+    """
+    What identifies a batch from iter_batches in ExportState. The csv export
+    has no batch number and descriptions like "Imported from Visma 2017-01"
+    are reused, so the key is the description and effective date of the B
+    row with a digest of all rows of the batch.
+    """
+    digest = hashlib.sha1()
+    for row in chain([batch['data']], *(
+            [journal['data']] + journal['transactions']
+            for journal in batch['journals'])):
+        digest.update(';'.join(row).encode('utf_8') + b'\n')
+    return '{} {} {}'.format(batch['data'][1], batch['data'][3],
+                             digest.hexdigest()[:16])
+
+
+def _journal_key(journal):
+    """A hash of the rows of a journal, to see if it has changed in the file"""
+    return hash((tuple(journal['data']),) + tuple(map(tuple, journal['transactions'])))
+
 
 class PetraParser:
-    """Form an output file based on a Petra CSV file and translation tables"""
+    """
+    Form an output file based on a Petra CSV file and translation tables.
+    The CSV is read one batch at a time each time make_sie_data is called,
+    and closed before it returns. Translated journals are kept, so calling
+    make_sie_data again after adding missing keys only translates the
+    journals that failed, or that have changed in the file. The header
+    records are made from the current tables every time. The tables are
+    file names or already loaded CSVDicts.
+    Batches with a batch_key in skip_batches are not translated, see
+    ExportState. The keys of the batches that are read are listed in batches.
+    """
     def __init__(self, petra_csv, acct_kto_file, cc_re_proj_file, sie_defaults_file,
-            sie_dims_file, sie_units_file, kto_acct_file, re_cc_file, proj_cc_file):
+            sie_dims_file, sie_units_file, kto_acct_file, re_cc_file, proj_cc_file,
+            skip_batches=None):
         self.sie_data = SieData()
-        self.petra_batches = []
-        self.read_petra_csv(petra_csv)
-        self.acct_kto = CSVDict(acct_kto_file)
-        self.cc_re_proj = CSVDict(cc_re_proj_file)
-        self.sie_defaults = CSVDict(sie_defaults_file)
-        self.sie_dims = CSVDict(sie_dims_file)
-        self.sie_units = CSVDict(sie_units_file)
-        self.kto_acct = CSVDict(kto_acct_file)
-        self.sie_objects = {'1': CSVDict(re_cc_file),
-                            '6': CSVDict(proj_cc_file)}
+        self.skip_batches = skip_batches
+        self.batches = []
+        self.petra_csv = petra_csv
+        self.acct_kto = open_table(acct_kto_file)
+        self.cc_re_proj = open_table(cc_re_proj_file)
+        self.sie_defaults = open_table(sie_defaults_file)
+        self.sie_dims = open_table(sie_dims_file)
+        self.sie_units = open_table(sie_units_file)
+        self.kto_acct = open_table(kto_acct_file)
+        self.sie_objects = {'1': open_table(re_cc_file),
+                            '6': open_table(proj_cc_file)}
         self.table = []
+        self.missing = None
+        # [Verification or None if a key is missing, _journal_key(journal)]
+        # for each journal in the file
+        self._journals = []
 
-    def read_petra_csv(self, petra_csv):
-        """Reads a petra csv export to self.petra_batches"""
-        with open(petra_csv, 'r', encoding='latin1') as petra_csv_file:
+    def iter_batches(self):
+        """Read the petra csv export one batch at a time"""
+        with open(self.petra_csv, 'r', encoding='latin1') as petra_csv_file:
             petra_reader = csv.reader(petra_csv_file, delimiter=';')
-            batch = {}
-            journal = {}
+            batch = None
+            journal = None
             for row in petra_reader:
                 if row and row[0] == 'B':
                     if batch:
-                        if journal:
-                            batch['journals'].append(journal)
-                            journal = {}
-                        self.petra_batches.append(batch)
+                        yield batch
                     batch = {'data': row, 'journals': []}
                 elif row and row[0] == 'J':
-                    if journal:
-                        batch['journals'].append(journal)
                     journal = {'data': row, 'transactions': []}
+                    batch['journals'].append(journal)
                 elif row and row[0] == 'T':
                     journal['transactions'].append(row)
-            if journal:
-                batch['journals'].append(journal)
-                self.petra_batches.append(batch)
-    
-    def make_sie_data(self):
-        """Put Petra batches in a SieData object to be exported"""
+            if batch:
+                yield batch
+
+    def _iter_journals(self):
+        """The journals of the batches that are not skipped, lists batches"""
+        self.batches = []
+        with closing(self.iter_batches()) as batches:
+            for batch in batches:
+                key = batch_key(batch)
+                if self.skip_batches is not None and key in self.skip_batches:
+                    continue
+                self.batches.append(key)
+                yield from batch['journals']
+
+    @stats.timed('PetraParser.make_sie_data')
+    def make_sie_data(self, collect_missing=False, progress=None, balances=False):
+        """
+        Put Petra batches in a SieData object to be exported.
+        If collect_missing is True, translation continues past missing keys
+        and a CSVKeysMissing with all of them is raised at the end, instead of
+        a CSVKeyMissing for the first one.
+        progress(journals, None) is called every PROGRESS_INTERVAL journals
+        and may raise ConversionCancelled to stop.
+        Raises NothingToExport if there are no journals, or all were skipped.
+        If balances is True, #RES and #PSALDO records for the result accounts
+        are added. The export has no opening balances, so there are no records
+        for balance accounts.
+        """
+        self.missing = MissingKeys() if collect_missing else None
+
+        count = 0
+        with closing(self._iter_journals()) as journals:
+            for count, journal in enumerate(journals, 1):
+                if progress is not None and not count % PROGRESS_INTERVAL:
+                    progress(count, None)
+                key = _journal_key(journal)
+                if count > len(self._journals):
+                    self._journals.append([None, key])
+                entry = self._journals[count - 1]
+                if entry[0] is None or entry[1] != key:
+                    entry[:] = [self._translate_journal(journal), key]
+        del self._journals[count:]
+        stats.count('Journals translated', count)
+        if self.missing:
+            self.missing.raise_if_missing()
+        if not self._journals:
+            raise NothingToExport("Inga journaler att exportera")
+
         sie_data = SieData()
+        for record in self._header_records():
+            sie_data.add_data(record)
+        for ver, _ in self._journals:
+            sie_data.add_data(ver)
+        if balances:
+            Balances(sie_data).add_to(sie_data, result_only=True)
+        self.sie_data = sie_data
 
+    def _header_records(self):
+        """The records before the verifications, from the current tables"""
         for name, value in self.sie_defaults.items():
-            sie_data.add_data(DataField(['#' + name] + value['Data'].split(',')))
-        sie_data.add_data(SieField('#GEN', datetime.now().strftime("%Y%m%d")))
+            yield DataField(['#' + name] + value['Data'].split(','))
+        yield SieField('#GEN', datetime.now().strftime("%Y%m%d"))
 
         for idx, data in self.sie_dims.items():
-            sie_data.add_data(DataField(['#DIM', idx, data['Name']]))
+            yield DataField(['#DIM', idx, data['Name']])
         for idx, data in self.sie_units.items():
-            sie_data.add_data(DataField(['#ENHET', idx, data['Name']]))
+            yield DataField(['#ENHET', idx, data['Name']])
         for idx, data in self.kto_acct.items():
             for field in ['KONTO', 'KTYP', 'SRU']:
                 if data[field]:
-                    sie_data.add_data(DataField(['#' + field, idx, data[field]]))
+                    yield DataField(['#' + field, idx, data[field]])
         for dim in ['1', '6']:
             for idx, data in self.sie_objects[dim].items():
-                sie_data.add_data(DataField(['#OBJEKT', dim, idx, data['Name']]))
+                yield DataField(['#OBJEKT', dim, idx, data['Name']])
 
-        for batch in self.petra_batches:
-            for journal in batch['journals']:
-                serie = 'P'
-                vernr = '0'
-                transdat = journal['transactions'][0][5]
-                verdatum = transdat[6:10] + transdat[3:5] + transdat[:2]
-                vertext = journal['data'][1]
-                ver = Verification(serie, vernr, verdatum, vertext, verdatum)
-                for trans in journal['transactions']:
-                    kontonr = self.acct_kto[trans[2]]['V_Kto']
-                    objekt = ['1', self.cc_re_proj[trans[1]]['V_Re'], '6',
-                            self.cc_re_proj[trans[1]]['V_Proj']]
-                    belopp = float(trans[6].replace(',', '.')) - float(trans[7].replace(',', '.'))
-                    transdat = trans[5][6:10] + trans[5][3:5] + trans[5][:2]
-                    transtext = trans[3]
-                    transaction = Transaction(kontonr, objekt, belopp, transdat, transtext)
-                    ver.add_trans(transaction)
-                sie_data.add_data(ver)
-        self.sie_data = sie_data
+    def _translate_journal(self, journal):
+        """A Verification for the journal, None if a key is missing"""
+        serie = 'P'
+        vernr = '0'
+        verdatum = petra_to_sie_date(journal['transactions'][0][5])
+        vertext = journal['data'][1]
+        ver = Verification(serie, vernr, verdatum, vertext, verdatum)
+        complete = True
+        for trans in journal['transactions']:
+            kontonr = self.acct_kto.lookup(trans[2], 'V_Kto', self.missing)
+            objekt = ['1', self.cc_re_proj.lookup(trans[1], 'V_Re', self.missing),
+                    '6', self.cc_re_proj.lookup(trans[1], 'V_Proj', self.missing)]
+            if kontonr is None or None in objekt:
+                complete = False
+                continue
+            belopp = _format_ore(parse_ore(trans[6].replace(',', '.'))
+                                 - parse_ore(trans[7].replace(',', '.')))
+            transdat = petra_to_sie_date(trans[5])
+            transtext = trans[3]
+            transaction = Transaction(kontonr, objekt, belopp, transdat, transtext)
+            ver.add_trans(transaction)
+        return ver if complete else None
 
     def print_output(self):
         """Print petra batches to stdout"""
-        for batch in self.petra_batches:
+        for batch in self.iter_batches():
             print('B:', batch['data'][1:])
             for journal in batch['journals']:
                 print('J:', journal['data'][1:])
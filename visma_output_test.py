@@ -0,0 +1,100 @@
+"""Tests for PetraParser"""
+
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+import pytest
+
+from visma_output import PetraParser
+from csv_dict import CSVKeyMissing, CSVKeysMissing
+from accounting_data import NothingToExport
+
+PETRA_CSV = """B;Batch 1;150;31/01/2017
+J;Gåva;GL
+T;3200;1000;Gåva 1;;05/01/2017;0;100
+T;3200;4000;Gåva 1;;05/01/2017;100;0
+J;Hyra;GL
+T;3300;1000;Hyra;;06/01/2017;0;50
+T;3300;5000;Hyra;;06/01/2017;50;0
+B;Batch 2;10;28/02/2017
+J;Ränta;GL
+T;3200;1000;Ränta;;01/02/2017;10;0
+T;3200;8000;Ränta;;01/02/2017;0;10
+"""
+
+TABLES = {
+    'Acct_Kto.csv': 'P_Acct;V_Kto\n1000;1930\n4000;3010\n5000;5010\n',
+    'CC_Re_Proj.csv': 'P_CC;V_Re;V_Proj\n3200;K1;P-1\n',
+    'SIE_defaults.csv': 'Name;Data\nFLAGGA;0\nPROGRAM;Petra,1.0\nFORMAT;PC8\n'
+                        'SIETYP;4\nFNAMN;Test\n',
+    'SIE_dims.csv': 'Dim;Name\n1;Resultatenhet\n6;Projekt\n',
+    'SIE_units.csv': 'Unit;Name\n',
+    'Kto_Acct.csv': 'V_Kto;P_Acct;KONTO;KTYP;SRU\n1930;1000;Bank;;\n',
+    'Re_CC.csv': 'V_Re;P_CC;Name\nK1;3200;Kontor\n',
+    'Proj_CC.csv': 'V_Proj;P_CC;Name\n',
+}
+
+def _petra_parser(directory):
+    """A PetraParser for PETRA_CSV with tables that lack 8000 and 3300"""
+    path = Path(directory)
+    for name, content in TABLES.items():
+        with open(str(path / name), 'w') as table:
+            table.write(content)
+    with open(str(path / 'petra.csv'), 'w', encoding='latin1') as petra_csv:
+        petra_csv.write(PETRA_CSV)
+    return PetraParser(*[str(path / name) for name in [
+        'petra.csv', 'Acct_Kto.csv', 'CC_Re_Proj.csv', 'SIE_defaults.csv',
+        'SIE_dims.csv', 'SIE_units.csv', 'Kto_Acct.csv', 'Re_CC.csv',
+        'Proj_CC.csv']])
+
+def test_retry_only_translates_failed_journals(monkeypatch):
+    """After adding missing keys, only the journals that lacked them are redone"""
+    with TemporaryDirectory() as directory:
+        parser = _petra_parser(directory)
+        with pytest.raises(CSVKeysMissing) as error:
+            parser.make_sie_data(collect_missing=True)
+        assert [keys for _, keys in error.value.missing] == [['3300'], ['8000']]
+        parser.cc_re_proj['3300'] = {'V_Re': 'K2', 'V_Proj': ''}
+
+        translated = []
+        original = PetraParser._translate_journal
+        def counting(self, journal):
+            translated.append(journal['data'][1])
+            return original(self, journal)
+        monkeypatch.setattr(PetraParser, '_translate_journal', counting)
+
+        with pytest.raises(CSVKeyMissing) as error:
+            parser.make_sie_data()
+        assert error.value.key == '8000'
+        assert translated == ['Hyra', 'Ränta']
+
+        parser.acct_kto['8000'] = {'V_Kto': '8310'}
+        parser.make_sie_data()
+        assert translated == ['Hyra', 'Ränta', 'Ränta']
+        vers = parser.sie_data.get_data('#VER')
+        assert [v.vertext for v in vers] == ['Gåva', 'Hyra', 'Ränta']
+        assert vers[1].trans_list[0].objekt == ['1', 'K2', '6', '']
+        assert vers[2].trans_list[1].kontonr == '8310'
+        assert parser.sie_data.is_complete()
+
+        # The header follows the tables and the file is read again
+        parser.kto_acct['8310'] = {'P_Acct': '8000', 'KONTO': 'Ränteintäkter',
+                                   'KTYP': '', 'SRU': ''}
+        with open(parser.petra_csv, 'a', encoding='latin1') as petra_csv:
+            petra_csv.write('J;Ränta 2;GL\n'
+                            'T;3200;1000;Ränta;;02/02/2017;10;0\n'
+                            'T;3200;8000;Ränta;;02/02/2017;0;10\n')
+        parser.make_sie_data()
+        assert translated == ['Hyra', 'Ränta', 'Ränta', 'Ränta 2']
+        assert len(parser.sie_data.get_data('#VER')) == 4
+        assert [field.data[0] for field in parser.sie_data.get_data('#KONTO')] == [
+            '1930', '8310']
+
+def test_empty_export():
+    """An export without journals has nothing to export, skipped or not"""
+    with TemporaryDirectory() as directory:
+        parser = _petra_parser(directory)
+        with open(parser.petra_csv, 'w', encoding='latin1') as petra_csv:
+            petra_csv.write('B;Batch 1;0;31/01/2017\n')
+        with pytest.raises(NothingToExport):
+            parser.make_sie_data()
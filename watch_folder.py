@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Convert SIE files and Petra exports as they are dropped into folders. The
+folders are polled, so nothing platform specific is needed, and a file is
+converted when it is new or has changed and then stayed the same for one
+poll, so files that are still being written are left alone.
+Outputs go where batch_convert puts them, a SIE file in SIE/ to a sibling
+CSV/. Each output gets the modification time of its input, which is how a
+converted file is recognised as up to date, also after a restart. The outputs
+that have been written are kept in ExportState and never taken as inputs, and
+a file whose output would be another watched file is refused, like in
+batch_convert.
+The translation tables are loaded once into a pool of worker processes and
+only reloaded when a table file changes. A file that fails is logged and
+tried again when it or the tables change.
+Needs Python 3.7 or later for asyncio.run.
+Run with: python watch_folder.py SIE/ PETRA/ --tables TABELLER
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from batch_convert import TABLES, Tables, find_files, output_filename
+from batch_convert import convert_file, missing_message, check_jobs, path_key
+from csv_dict import CSVKeyMissing
+from export_state import ExportState
+
+# Seconds between polls of the folders
+POLL_INTERVAL = 2.0
+
+LOG = logging.getLogger('watch_folder')
+
+
+def _signature(filename):
+    """(modification time in ns, size) of a file, None if it is gone"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def is_up_to_date(filename, output):
+    """True if output exists and is at least as new as filename"""
+    signature, converted = _signature(filename), _signature(output)
+    return (signature is not None and converted is not None
+            and converted[0] >= signature[0])
+
+
+_WORKER_TABLES = None
+
+def _init_worker(tables):
+    global _WORKER_TABLES # pylint: disable=global-statement
+    _WORKER_TABLES = tables
+
+def _convert_job(job):
+    """
+    Convert in a worker process and give the output the modification time
+    of the input as it was when the job was made. Returns (verifications,
+    seconds, error message or None), since exceptions may not pickle.
+    """
+    filename, output, mtime_ns = job
+    start = time.perf_counter()
+    count, error = 0, None
+    try:
+        count, _ = convert_file(_WORKER_TABLES, filename, output, True)
+        os.utime(output, ns=(mtime_ns, mtime_ns))
+    except CSVKeyMissing as csverr:
+        error = missing_message(csverr)
+    except Exception as err: # pylint: disable=broad-except
+        error = str(err) or type(err).__name__
+    return count, time.perf_counter() - start, error
+
+
+class Watcher:
+    """
+    Watch directories for files to convert with the tables in table_dir.
+    At most processes files are converted at a time.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, directories, table_dir, output_dir=None, processes=None,
+                 interval=POLL_INTERVAL):
+        self.directories = directories
+        self.table_dir = table_dir
+        self.output_dir = output_dir
+        self.processes = processes or os.cpu_count() or 1
+        self.interval = interval
+        self.converted = 0
+        self.failed = 0
+        self.tables = None
+        self._table_signature = None
+        self._executor = None
+        self._slots = None
+        self._state = None
+        # path_key of the outputs that have been written, never inputs
+        self._outputs = set()
+        # filename: (signature, monotonic time) of changed files, from the
+        # poll where the change was first seen
+        self._changed = {}
+        # filename: signature of the last conversion, or of an up to date file
+        self._handled = {}
+        self._failed = set()
+        # filename: output of the files being converted
+        self._running = {}
+        self._tasks = set()
+
+    def _table_files(self):
+        return [os.path.join(self.table_dir, name) for _, name in TABLES]
+
+    def load_tables(self):
+        """
+        Load the tables if they have changed since they were loaded, and
+        start a new worker pool with them. Files that failed are tried again
+        with the new tables. Also starts the pool if there is none.
+        """
+        signature = [_signature(name) for name in self._table_files()]
+        if signature == self._table_signature and self._executor is not None:
+            return
+        changed = signature != self._table_signature
+        if changed:
+            try:
+                tables = Tables(self.table_dir)
+            except Exception as err: # pylint: disable=broad-except
+                if self.tables is None:
+                    raise
+                LOG.error('Kunde inte läsa om tabellerna, de gamla används: %s', err)
+                tables = self.tables
+            else:
+                if self.tables is not None:
+                    LOG.info('Tabellerna i %s har ändrats och lästs om', self.table_dir)
+            self.tables = tables
+            self._table_signature = signature
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                             initargs=(self.tables,))
+        if changed:
+            for filename in self._failed:
+                self._handled.pop(filename, None)
+            self._failed.clear()
+
+    def scan(self):
+        """
+        Files that are new or changed since they were last handled and have
+        stayed the same since the previous poll, as (filename, output,
+        signature, monotonic time when the change was seen).
+        """
+        now = time.monotonic()
+        busy = {path_key(filename) for filename in
+                list(self._running) + list(self._running.values())}
+        jobs = [(filename, output_filename(filename, self.output_dir), True)
+                for filename in find_files(self.directories)
+                if path_key(filename) not in self._outputs]
+        rejected = check_jobs(jobs)
+        ready = []
+        for filename, output, _ in jobs:
+            signature = _signature(filename)
+            if (signature is None or path_key(filename) in busy
+                    or path_key(output) in busy
+                    or self._handled.get(filename) == signature):
+                continue
+            if filename in rejected:
+                self._handled[filename] = signature
+                self._changed.pop(filename, None)
+                self.failed += 1
+                LOG.error('FEL    %s: %s', filename, rejected[filename])
+                continue
+            if is_up_to_date(filename, output):
+                self._handled[filename] = signature
+                self._changed.pop(filename, None)
+                continue
+            changed = self._changed.get(filename)
+            if changed is None or changed[0] != signature:
+                self._changed[filename] = (signature, now)
+            else:
+                del self._changed[filename]
+                ready.append((filename, output, signature, changed[1]))
+        return ready
+
+    async def _convert(self, filename, output, signature, seen):
+        """Convert one file in the pool and log how it went"""
+        async with self._slots:
+            if self._executor is None:
+                self.load_tables()
+            executor = self._executor
+            loop = asyncio.get_running_loop()
+            try:
+                count, seconds, error = await loop.run_in_executor(
+                    executor, _convert_job, (filename, output, signature[0]))
+            except BrokenProcessPool:
+                # The broken pool is shut down without waiting for its
+                # processes, and a new one is started when it is needed
+                if self._executor is executor:
+                    executor.shutdown(wait=False)
+                    self._executor = None
+                count, seconds, error = 0, 0.0, 'arbetsprocessen avbröts'
+        del self._running[filename]
+        self._handled[filename] = signature
+        latency = time.monotonic() - seen
+        if error is None:
+            self.converted += 1
+            self._outputs.add(path_key(output))
+            if self._state is not None:
+                self._state.add_outputs([path_key(output)])
+            LOG.info('OK     %s -> %s (%d verifikationer, %.2f s, %.2f s sedan ändringen)',
+                     filename, output, count, seconds, latency)
+        else:
+            self.failed += 1
+            self._failed.add(filename)
+            LOG.error('FEL    %s: %s (%.2f s sedan ändringen)', filename, error, latency)
+
+    def poll(self):
+        """Start converting the files that are ready"""
+        if not self._running or self._executor is None:
+            self.load_tables()
+        for filename, output, signature, seen in self.scan():
+            self._running[filename] = output
+            task = asyncio.ensure_future(self._convert(filename, output, signature, seen))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def run(self, rounds=None):
+        """
+        Poll the directories until cancelled, or rounds times. The
+        conversions that have started are finished before returning.
+        """
+        self._slots = asyncio.Semaphore(self.processes)
+        self._state = ExportState.in_directory(self.table_dir)
+        self._outputs |= self._state.written_outputs()
+        LOG.info('Bevakar %s, tabeller i %s', ', '.join(self.directories),
+                 self.table_dir)
+        try:
+            count = 0
+            while rounds is None or count < rounds:
+                self.poll()
+                count += 1
+                await asyncio.sleep(self.interval)
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._state.close()
+            self._state = None
+
+def main(argv=None):
+    """Watch the folders until interrupted"""
+    argparser = argparse.ArgumentParser(
+        description='Bevaka mappar och konvertera nya SIE-filer till Petra '
+        'och Petra-filer till SIE')
+    argparser.add_argument('directories', nargs='+', help='Directories to watch')
+    argparser.add_argument('--tables', default='TABELLER',
+                           help='Directory with the translation tables')
+    argparser.add_argument('--output', metavar='DIR',
+                           help='Write all converted files to DIR')
+    argparser.add_argument('--processes', type=int,
+                           help='Worker processes, defaults to the number of CPUs')
+    argparser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                           help='Seconds between polls')
+    args = argparser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    watcher = Watcher(args.directories, args.tables, args.output,
+                      args.processes, args.interval)
+    try:
+        asyncio.run(watcher.run())
+    except KeyboardInterrupt:
+        LOG.info('Avslutar, %d filer konverterade och %d misslyckade',
+                 watcher.converted, watcher.failed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
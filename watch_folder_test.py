@@ -0,0 +1,97 @@
+"""Tests for the watch folder conversion"""
+
+import os
+import asyncio
+import logging
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+
+import generate_data
+from batch_convert_test import _setup
+import watch_folder
+from watch_folder import Watcher
+
+def test_watch_converts_new_files(caplog):
+    """New files are converted once, a bad file is logged and skipped"""
+    caplog.set_level(logging.INFO, 'watch_folder')
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        sie_dir = os.path.join(directory, 'SIE')
+        petra_dir = os.path.join(directory, 'PETRA')
+        os.mkdir(petra_dir)
+        generate_data.write_sie(os.path.join(sie_dir, 'a.si'), 20, 3, chart)
+        generate_data.write_petra(os.path.join(petra_dir, 'p.csv'), 20, 3, chart)
+        other = generate_data.Chart(accounts=10, seed=1)
+        generate_data.write_sie(os.path.join(sie_dir, 'bad.si'), 5, 3, other)
+
+        watcher = Watcher([sie_dir, petra_dir], tables, processes=2, interval=0)
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (2, 1)
+        assert os.listdir(os.path.join(directory, 'CSV')) == ['a.csv']
+        assert sorted(os.listdir(petra_dir)) == ['p.SI', 'p.csv']
+        assert 'FEL    ' + os.path.join(sie_dir, 'bad.si') + ': saknas i' in caplog.text
+
+        # Bad files are not retried until they change
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (2, 1)
+
+        # Outputs are up to date after a restart, which forgets the failures
+        watcher = Watcher([sie_dir, petra_dir], tables, processes=2, interval=0)
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (0, 1)
+
+        # A changed file is converted again
+        siefile = os.path.join(sie_dir, 'a.si')
+        generate_data.write_sie(siefile, 30, 3, chart, seed=2)
+        stat = os.stat(siefile)
+        os.utime(siefile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (1, 1)
+
+        # Written outputs are never inputs, also after a restart
+        petra_file = os.path.join(petra_dir, 'p.csv')
+        generate_data.write_petra(petra_file, 25, 3, chart, seed=2)
+        stat = os.stat(petra_file)
+        os.utime(petra_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        watcher = Watcher([sie_dir, petra_dir], tables, processes=2, interval=0)
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (1, 1)
+        assert sorted(os.listdir(petra_dir)) == ['p.SI', 'p.csv']
+
+def test_watch_refuses_outputs_that_are_inputs(caplog):
+    """x.si and x.csv next to each other would overwrite each other"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        petra_dir = os.path.join(directory, 'PETRA')
+        os.mkdir(petra_dir)
+        generate_data.write_sie(os.path.join(petra_dir, 'x.si'), 5, 3, chart)
+        generate_data.write_petra(os.path.join(petra_dir, 'x.csv'), 5, 3, chart)
+
+        watcher = Watcher([petra_dir], tables, processes=1, interval=0)
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (0, 2)
+        assert sorted(os.listdir(petra_dir)) == ['x.csv', 'x.si']
+        assert 'är också en infil' in caplog.text
+
+def _crash(job):
+    os._exit(1)
+
+def test_broken_pool_is_shut_down(caplog, monkeypatch):
+    """A worker that dies fails its file, and the broken pool is shut down"""
+    with TemporaryDirectory() as directory:
+        chart, tables = _setup(directory)
+        generate_data.write_sie(os.path.join(directory, 'SIE', 'a.si'), 5, 3, chart)
+        shutdowns = []
+        original = ProcessPoolExecutor.shutdown
+        def shutdown(executor, wait=True, **kwargs):
+            shutdowns.append(wait)
+            original(executor, wait, **kwargs)
+        monkeypatch.setattr(ProcessPoolExecutor, 'shutdown', shutdown)
+        monkeypatch.setattr(watch_folder, '_convert_job', _crash)
+
+        watcher = Watcher([os.path.join(directory, 'SIE')], tables,
+                          processes=1, interval=0)
+        asyncio.run(watcher.run(rounds=3))
+        assert (watcher.converted, watcher.failed) == (0, 1)
+        assert 'arbetsprocessen avbröts' in caplog.text
+        assert False in shutdowns